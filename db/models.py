@@ -43,6 +43,22 @@ class TakerWallet(WalletModel):
     pass
 
 
+class WalletKey(BaseModel):
+    # pre-derived keypool entry of a MakerWallet/TakerWallet
+    wallet_table = CharField()
+    wallet_id = IntegerField()
+    key_index = IntegerField()
+    pubkey = CharField()
+    pubkey_hash = CharField()
+    address = CharField()
+    status = CharField(default='AVAILABLE')  # AVAILABLE / RESERVED / USED
+
+    class Meta:
+        indexes = (
+            (('wallet_table', 'wallet_id', 'key_index'), True),
+        )
+
+
 class P2PNode(BaseModel):
     pubkey = CharField()
     p2p_endpoint = CharField()
@@ -51,7 +67,7 @@ class P2PNode(BaseModel):
 
 def initialize_db():
     db.connect()
-    db.create_tables([Swap, MakerWallet, TakerWallet], safe=True)
+    db.create_tables([Swap, MakerWallet, TakerWallet, WalletKey], safe=True)
 
 
 initialize_db()
@@ -0,0 +1,152 @@
+import os
+import logging
+
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger('crypto_backend')
+
+# force a backend by name, otherwise the first available one of BACKEND_PREFERENCE is used
+BACKEND_ENV = 'KLIB_CRYPTO_BACKEND'
+BACKEND_PREFERENCE = ('coincurve', 'python', 'reference')
+
+
+class CryptoBackend(ABC):
+    # Schnorr (BIP340) implementation used by klib, picked once at import. Hashing always uses hashlib.
+    name = None
+    # True when batch_verify is faster than verifying one signature at a time
+    native_batch = False
+
+    @abstractmethod
+    def sign(self, msg_hash, priv_key, aux_rand=None):
+        pass
+
+    @abstractmethod
+    def verify(self, signature, msg_hash, pubkey):
+        pass
+
+    def batch_verify(self, items):
+        # [(signature, msg_hash, pubkey), ...] -> [bool, ...], a malformed item is just invalid
+        return [self.safe_verify(*item) for item in items]
+
+    def safe_verify(self, signature, msg_hash, pubkey):
+        try:
+            return bool(self.verify(signature, msg_hash, pubkey))
+        except (ValueError, TypeError) as e:
+            logger.debug(f"Invalid signature or pubkey: {e}")
+            return False
+
+    def info(self):
+        return {'name': self.name, 'native_batch': self.native_batch}
+
+
+class CoincurveBackend(CryptoBackend):
+    name = 'coincurve'
+
+    def __init__(self):
+        from coincurve import PrivateKey, PublicKeyXOnly
+        self.PrivateKey = PrivateKey
+        self.PublicKeyXOnly = PublicKeyXOnly
+
+    def sign(self, msg_hash, priv_key, aux_rand=None):
+        return self.PrivateKey(priv_key).sign_schnorr(msg_hash, aux_randomness=aux_rand or os.urandom(32))
+
+    def verify(self, signature, msg_hash, pubkey):
+        return self.PublicKeyXOnly(data=pubkey).verify(signature, msg_hash)
+
+
+class PythonBackend(CryptoBackend):
+    # klib.schnorr_fast, verifies batches with a single multi-scalar multiplication
+    name = 'python'
+    native_batch = True
+
+    def __init__(self):
+        from . import schnorr_fast
+        self.engine = schnorr_fast
+
+    def sign(self, msg_hash, priv_key, aux_rand=None):
+        return self.engine.schnorr_sign(msg_hash, priv_key, aux_rand or os.urandom(32))
+
+    def verify(self, signature, msg_hash, pubkey):
+        return self.engine.schnorr_verify(msg_hash, pubkey, signature)
+
+    def batch_verify(self, items):
+        if len(items) <= 2:
+            return super().batch_verify(items)
+        try:
+            if self.engine.schnorr_batch_verify([(msg_hash, pubkey, signature)
+                                                 for signature, msg_hash, pubkey in items]):
+                return [True] * len(items)
+        except (ValueError, TypeError):
+            pass
+        # at least one bad signature, split until it's found
+        half = len(items) // 2
+        return self.batch_verify(items[:half]) + self.batch_verify(items[half:])
+
+
+class ReferenceBackend(PythonBackend):
+    # the BIP reference code, slow, only useful to cross-check the other backends
+    name = 'reference'
+    native_batch = False
+
+    def __init__(self):
+        from . import schnorr_signature
+        self.engine = schnorr_signature
+
+    def batch_verify(self, items):
+        return CryptoBackend.batch_verify(self, items)
+
+
+BACKENDS = {
+    'coincurve': CoincurveBackend,
+    'python': PythonBackend,
+    'reference': ReferenceBackend
+}
+
+
+def load_backend(name):
+    return BACKENDS[name]()
+
+
+def available_backends():
+    available = []
+    for name in BACKENDS:
+        try:
+            load_backend(name)
+        except ImportError:
+            continue
+        available.append(name)
+    return available
+
+
+def select_backend(name=None):
+    names = [name] if name else list(BACKEND_PREFERENCE)
+    for backend_name in names:
+        if backend_name not in BACKENDS:
+            raise ValueError(f"Unknown crypto backend {backend_name}, available: {', '.join(BACKENDS)}")
+        try:
+            return load_backend(backend_name)
+        except ImportError as e:
+            if name:
+                raise
+            logger.debug(f"Crypto backend {backend_name} unavailable: {e}")
+    raise RuntimeError('No crypto backend available')
+
+
+backend = select_backend(os.getenv(BACKEND_ENV) or None)
+logger.debug(f"Using crypto backend {backend.name}")
+
+
+def get_backend():
+    return backend
+
+
+def set_backend(name):
+    # switch backend at runtime, e.g. from a config file read after import
+    global backend
+    backend = select_backend(name)
+    logger.info(f"Using crypto backend {backend.name}")
+    return backend
+
+
+def backend_info():
+    return {**backend.info(), 'available': available_backends()}
@@ -0,0 +1,313 @@
+import json
+import asyncio
+import logging
+import itertools
+
+import aiohttp
+
+logger = logging.getLogger('krpc')
+
+# kaspad wRPC with JSON encoding (--rpclisten-json), default mainnet port
+DEFAULT_WRPC_PORT = 18110
+UTXOS_CHANGED_NOTIFICATION = 'utxosChangedNotification'
+
+
+class KaspaRpcError(Exception):
+    pass
+
+
+def rpc_url(server=None):
+    # accept a full ws:// url, a host:port pair or a bare host (KAS_RPC_SERVER)
+    if not server:
+        server = '127.0.0.1'
+    if server.startswith('ws://') or server.startswith('wss://'):
+        return server
+    if ':' not in server:
+        server = f"{server}:{DEFAULT_WRPC_PORT}"
+    return f"ws://{server}"
+
+
+def parse_script_public_key(script_public_key):
+    # wRPC encodes scriptPublicKey as a hex string prefixed by the 2 bytes version,
+    # the swapper uses the kaspactl layout {'version', 'scriptPublicKey'}
+    if isinstance(script_public_key, str):
+        return {'version': int(script_public_key[:4], 16), 'scriptPublicKey': script_public_key[4:]}
+    return script_public_key
+
+
+def format_script_public_key(script_public_key):
+    if isinstance(script_public_key, dict):
+        return f"{int(script_public_key['version']):04x}{script_public_key['scriptPublicKey']}"
+    return script_public_key
+
+
+def normalize_utxo_entry(entry):
+    # reshape a wRPC utxo entry to the kaspactl layout used across the swapper
+    utxo_entry = dict(entry['utxoEntry'])
+    utxo_entry['scriptPublicKey'] = parse_script_public_key(utxo_entry['scriptPublicKey'])
+    return {**entry, 'utxoEntry': utxo_entry}
+
+
+def wrpc_transaction(rpc_transaction):
+    # gen_rpc_transaction_dict builds the kaspactl layout, wRPC names the output amount value
+    # and encodes scriptPublicKey like the utxo entries
+    outputs = [
+        {'value': int(output['value'] if 'value' in output else output['amount']),
+         'scriptPublicKey': format_script_public_key(output['scriptPublicKey'])}
+        for output in rpc_transaction.get('outputs', [])
+    ]
+    return {**rpc_transaction, 'outputs': outputs, 'mass': rpc_transaction.get('mass', 0)}
+
+
+class KaspaRpcClient:
+    # Single long-lived websocket to kaspad, every request is multiplexed on it by id.
+    # Point it to any server speaking the same JSON framing to test it locally, see tests/wrpc_standin.py.
+    def __init__(self, url=None, request_timeout=30):
+        self.url = rpc_url(url)
+        self.request_timeout = request_timeout
+        self.loop = None
+        self.session = None
+        self.ws = None
+        self.reader_task = None
+        self.pending = {}
+        self.listeners = {UTXOS_CHANGED_NOTIFICATION: [self.on_utxos_changed]}
+        self.utxo_listeners = {}
+        self.msg_ids = itertools.count(1)
+        self.connect_lock = None
+
+    @property
+    def connected(self):
+        return self.ws is not None and not self.ws.closed
+
+    async def connect(self):
+        if self.connect_lock is None:
+            self.loop = asyncio.get_running_loop()
+            self.connect_lock = asyncio.Lock()
+        async with self.connect_lock:
+            if self.connected:
+                return
+            if self.session is None or self.session.closed:
+                self.session = aiohttp.ClientSession()
+            try:
+                self.ws = await self.session.ws_connect(self.url, heartbeat=30, max_msg_size=0)
+            except (aiohttp.ClientError, OSError) as e:
+                raise KaspaRpcError(f"Unable to connect to {self.url}: {e}") from e
+            self.reader_task = asyncio.create_task(self.read_loop(self.ws))
+            logger.debug(f"Connected to {self.url}")
+            if self.utxo_listeners:
+                # subscriptions don't survive the connection, renew them
+                try:
+                    await self.request('notifyUtxosChanged',
+                                       {'addresses': list(self.utxo_listeners), 'command': 'Start'})
+                except KaspaRpcError as e:
+                    logger.error(f"Unable to renew utxo subscriptions: {e}")
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.reader_task is not None:
+            await asyncio.gather(self.reader_task, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+        self.ws = None
+        self.reader_task = None
+        self.session = None
+
+    async def read_loop(self, ws):
+        try:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    self.dispatch(msg.data)
+                elif msg.type == aiohttp.WSMsgType.ERROR:
+                    logger.error(f"wRPC connection error: {ws.exception()}")
+                    break
+        finally:
+            # fail in-flight requests, the next request reconnects
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(KaspaRpcError('Connection to kaspad lost'))
+            self.pending.clear()
+            logger.debug(f"Disconnected from {self.url}")
+
+    def dispatch(self, raw_message):
+        try:
+            data = json.loads(raw_message)
+        except json.JSONDecodeError:
+            logger.error(f"Invalid wRPC message: {raw_message[:100]}")
+            return
+        msg_id = data.get('id')
+        if msg_id is not None and msg_id in self.pending:
+            future = self.pending.pop(msg_id)
+            if future.done():
+                return
+            if error := data.get('error'):
+                if isinstance(error, dict):
+                    error = error.get('message', error)
+                future.set_exception(KaspaRpcError(error))
+            else:
+                future.set_result(data.get('params') or {})
+        elif data.get('method'):
+            for callback in list(self.listeners.get(data['method'], [])):
+                try:
+                    callback(data.get('params') or {})
+                except Exception as e:
+                    logger.error(e, exc_info=True)
+
+    async def request(self, method, params=None):
+        if not self.connected:
+            await self.connect()
+        msg_id = next(self.msg_ids)
+        future = self.loop.create_future()
+        self.pending[msg_id] = future
+        try:
+            await self.ws.send_str(json.dumps({'id': msg_id, 'method': method, 'params': params or {}}))
+            return await asyncio.wait_for(future, self.request_timeout)
+        except asyncio.TimeoutError:
+            raise KaspaRpcError(f"{method} timed out after {self.request_timeout} seconds")
+        except (aiohttp.ClientError, ConnectionError) as e:
+            raise KaspaRpcError(f"{method} failed: {e}") from e
+        finally:
+            self.pending.pop(msg_id, None)
+
+    async def get_utxos_by_addresses(self, addresses):
+        res = await self.request('getUtxosByAddresses', {'addresses': list(addresses)})
+        return [normalize_utxo_entry(entry) for entry in res.get('entries', [])]
+
+    async def submit_transaction(self, rpc_transaction, allow_orphan=False):
+        if isinstance(rpc_transaction, str):
+            rpc_transaction = json.loads(rpc_transaction)
+        res = await self.request('submitTransaction', {'transaction': wrpc_transaction(rpc_transaction),
+                                                       'allowOrphan': allow_orphan})
+        return res['transactionId']
+
+    async def subscribe_utxos_changed(self, addresses, callback):
+        # callback(address, added, removed) is called for every change of a watched address
+        new_addresses = [address for address in addresses if not self.utxo_listeners.get(address)]
+        for address in addresses:
+            self.utxo_listeners.setdefault(address, []).append(callback)
+        if not new_addresses:
+            return
+        try:
+            await self.request('notifyUtxosChanged', {'addresses': new_addresses, 'command': 'Start'})
+        except KaspaRpcError:
+            self.remove_utxo_listener(addresses, callback)
+            raise
+
+    async def unsubscribe_utxos_changed(self, addresses, callback):
+        stale_addresses = self.remove_utxo_listener(addresses, callback)
+        if not stale_addresses or not self.connected:
+            return
+        try:
+            await self.request('notifyUtxosChanged', {'addresses': stale_addresses, 'command': 'Stop'})
+        except KaspaRpcError as e:
+            logger.debug(f"Unable to stop utxo notifications: {e}")
+
+    def remove_utxo_listener(self, addresses, callback):
+        stale_addresses = []
+        for address in addresses:
+            callbacks = self.utxo_listeners.get(address, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self.utxo_listeners.pop(address, None)
+                stale_addresses.append(address)
+        return stale_addresses
+
+    def on_utxos_changed(self, params):
+        changes = {}
+        for key in ('added', 'removed'):
+            for entry in params.get(key) or []:
+                entry = normalize_utxo_entry(entry)
+                changes.setdefault(entry['address'], {'added': [], 'removed': []})[key].append(entry)
+        for address, change in changes.items():
+            for callback in list(self.utxo_listeners.get(address, [])):
+                callback(address, change['added'], change['removed'])
+
+    def utxo_subscription(self, addresses, callback=None):
+        return UtxoSubscription(self, addresses, callback)
+
+
+class UtxoSubscription:
+    # Utxo notifications of some addresses between start() and stop(), or for the block when used as context manager.
+    # Changes go to callback(address, added, removed), without callback they are collected for wait()/pop_changes().
+    # If kaspad refuses the subscription, active is False and the owner keeps polling.
+    def __init__(self, client, addresses, callback=None):
+        self.client = client
+        self.addresses = list(addresses)
+        self.callback = callback
+        self.active = False
+        self.changed = asyncio.Event()
+        self.added = []
+        self.removed = []
+
+    async def start(self):
+        try:
+            await self.client.subscribe_utxos_changed(self.addresses, self.notify)
+            self.active = True
+        except KaspaRpcError as e:
+            logger.warning(f"UTXO notifications unavailable for {', '.join(self.addresses)}, polling: {e}")
+        return self.active
+
+    async def stop(self):
+        if self.active:
+            self.active = False
+            await self.client.unsubscribe_utxos_changed(self.addresses, self.notify)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    def notify(self, address, added, removed):
+        if self.callback is not None:
+            self.callback(address, added, removed)
+            return
+        self.added += added
+        self.removed += removed
+        self.changed.set()
+
+    def pop_changes(self):
+        added, removed = self.added, self.removed
+        self.added, self.removed = [], []
+        self.changed.clear()
+        return added, removed
+
+    async def wait(self, timeout):
+        # True if a notification arrived, False when timeout expires
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+# one client per server and event loop, shared by every swap of the process
+rpc_clients = {}
+
+
+def get_rpc_client(server=None):
+    url = rpc_url(server)
+    loop = asyncio.get_running_loop()
+    client = rpc_clients.get(url)
+    if client is None or (client.loop is not None and client.loop is not loop):
+        client = KaspaRpcClient(url)
+        rpc_clients[url] = client
+    return client
+
+
+async def close_rpc_clients():
+    for url, client in list(rpc_clients.items()):
+        await client.close()
+        del rpc_clients[url]
+
+
+def run_sync(coro):
+    # run a coroutine from blocking code (scripts), closing the clients bound to the temporary loop
+    async def runner():
+        try:
+            return await coro
+        finally:
+            await close_rpc_clients()
+    return asyncio.run(runner())
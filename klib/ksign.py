@@ -3,12 +3,13 @@ import os
 import hashlib
 import struct
 import logging
+import threading
+import concurrent.futures
 
-try:
-    from coincurve import PrivateKey, PublicKeyXOnly
-except ImportError:
-    from .schnorr_signature import schnorr_sign, schnorr_verify
+from collections import OrderedDict
 
+# schnorr implementation, selected once at import (coincurve, else the pure-Python engine)
+from . import crypto_backend
 from .kdatatype import (SigHashType, OutPoint, ScriptPublicKey, UtxoEntry, Input,
                         Output, Transaction, Subnetworks, SighashReusedValues)
 
@@ -25,41 +26,82 @@ heavyHashDomain = "HeavyHash"
 merkleBranchDomain = "MerkleBranchHash"
 
 
+# fixed width fields of the signature hash, little endian
+UINT8 = struct.Struct('<B')
+UINT16 = struct.Struct('<H')
+UINT32 = struct.Struct('<I')
+UINT64 = struct.Struct('<Q')
+# script public key version and script length
+SCRIPT_HEADER = struct.Struct('<HQ')
+# output value, script public key version and script length
+OUTPUT_HEADER = struct.Struct('<QHQ')
+# amount, sequence and sig op count of the input being signed
+INPUT_FIELDS = struct.Struct('<QQB')
+# locktime, subnetwork id and gas
+TX_FIELDS = struct.Struct('<Q20sQ')
+
+# sign_inputs: below this many inputs the pool costs more than it saves, inputs sent to a worker per call
+PARALLEL_SIGN_MIN_INPUTS = 8
+SIGN_CHUNK_SIZE = 16
+
+# verified (pubkey, msg_hash, signature) kept in memory, makers resend the same signed pings over and over
+VERIFY_CACHE_SIZE = 4096
+
+
+class VerificationCache:
+    # Bounded LRU of signatures already verified as valid, shared by the worker threads of klib.kverify.
+    # Only valid triples are stored, random invalid signatures can't evict the useful entries.
+    def __init__(self, size=VERIFY_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def check(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        with self.lock:
+            self.entries[key] = True
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+verify_cache = VerificationCache()
+
+
 def new_transaction_signing_hash_writer() -> hashlib:
     key = bytes(transactionSigningDomain, 'utf-8')
     return hashlib.blake2b(key=key, digest_size=32)
 
 
-def hash_data(hash_writer, data, dtype=None):
-    # update the provided hash_writer with formatted data
-    if dtype == 'bytes':
-        hash_data(hash_writer, len(data), 'uint64')
-    elif dtype == 'raw_bytes':
-        pass
-    elif dtype in ['int16', 'uint16']:
-        data = struct.pack('<H', data)
-    elif dtype in ['int32', 'uint32']:
-        data = struct.pack('<I', data)
-    elif dtype in ['int64', 'uint64']:
-        data = struct.pack('<Q', data)
-    elif dtype == 'uint8':
-        data = struct.pack('<B', data)
-    elif dtype == 'bool':
-        data = struct.pack('?', data)
-    elif dtype == 'domain_hash':
-        pass
-    elif dtype == 'domain_transaction_id':
-        pass
-    elif dtype == 'domain_subnetwork_id':
-        _data = bytearray(20)
-        _data[0] = data
-        data = bytes(_data)
-    elif dtype is None:
-        if isinstance(data, str):
-            data = bytes.fromhex(data)
-    else:
-        logger.warning('The fuck!?')
-    hash_writer.update(data)
+def subnetwork_id_bytes(subnetwork_id):
+    # 20 bytes subnetwork id from the builtin subnetwork number
+    if isinstance(subnetwork_id, int):
+        return bytes([subnetwork_id]) + bytes(19)
+    return bytes(subnetwork_id)
+
+
+def tx_id_bytes(tx_id):
+    return bytes.fromhex(tx_id) if isinstance(tx_id, str) else bytes(tx_id)
 
 
 def get_previous_outputs_hash(tx: Transaction, hash_type: SigHashType, reused_values: SighashReusedValues) -> bytes:
@@ -68,9 +110,8 @@ def get_previous_outputs_hash(tx: Transaction, hash_type: SigHashType, reused_va
 
     if reused_values.previous_outputs_hash is None:
         hash_writer = new_transaction_signing_hash_writer()
-        for tx_input in tx.inputs:
-            hash_data(hash_writer, tx_input.previous_outpoint.tx_id)
-            hash_data(hash_writer, tx_input.previous_outpoint.index, 'uint32')
+        hash_writer.update(b''.join(tx_id_bytes(tx_input.previous_outpoint.tx_id) +
+                                    UINT32.pack(tx_input.previous_outpoint.index) for tx_input in tx.inputs))
         reused_values.previous_outputs_hash = hash_writer.digest()
 
     return reused_values.previous_outputs_hash
@@ -82,8 +123,7 @@ def get_sequence_hash(tx, hash_type, reused_values):
 
     if reused_values.sequence_hash is None:
         hash_writer = new_transaction_signing_hash_writer()
-        for tx_input in tx.inputs:
-            hash_data(hash_writer, tx_input.sequence, 'uint64')
+        hash_writer.update(b''.join(UINT64.pack(tx_input.sequence) for tx_input in tx.inputs))
         reused_values.sequence_hash = hash_writer.digest()
 
     return reused_values.sequence_hash
@@ -95,34 +135,32 @@ def get_sig_op_count_hash(tx, hash_type, reused_values):
 
     if reused_values.sig_op_count_hash is None:
         hash_writer = new_transaction_signing_hash_writer()
-        for tx_input in tx.inputs:
-            sig_op_count = int.from_bytes(tx_input.sig_op_count, byteorder='little')
-            hash_data(hash_writer, sig_op_count, 'uint8')
+        hash_writer.update(b''.join(UINT8.pack(int.from_bytes(tx_input.sig_op_count, byteorder='little'))
+                                    for tx_input in tx.inputs))
         reused_values.sig_op_count_hash = hash_writer.digest()
 
     return reused_values.sig_op_count_hash
 
 
+def serialize_output_for_signing(tx_output):
+    script = bytes(tx_output.script_public_key.script)
+    return OUTPUT_HEADER.pack(tx_output.value, tx_output.script_public_key.version, len(script)) + script
+
+
 def get_output_hash(tx, idx, hash_type, reused_values):
     if hash_type.is_sig_hash_none():
         return bytes(32)
 
     if hash_type.is_sig_hash_single():
-        if idx > len(tx.outputs):
+        if idx >= len(tx.outputs):
             return bytes(32)
         hash_writer = new_transaction_signing_hash_writer()
-        tx_output = tx.outputs[idx]
-        hash_data(hash_writer, tx_output.value, 'uint64')
-        hash_data(hash_writer, tx_output.script_public_key.version, 'uint16')
-        hash_data(hash_writer, tx_output.script_public_key.script, 'bytes')
+        hash_writer.update(serialize_output_for_signing(tx.outputs[idx]))
         return hash_writer.digest()
 
     if reused_values.output_hash is None:
         hash_writer = new_transaction_signing_hash_writer()
-        for tx_output in tx.outputs:
-            hash_data(hash_writer, tx_output.value, 'uint64')
-            hash_data(hash_writer, tx_output.script_public_key.version, 'uint16')
-            hash_data(hash_writer, tx_output.script_public_key.script, 'bytes')
+        hash_writer.update(b''.join(serialize_output_for_signing(tx_output) for tx_output in tx.outputs))
         reused_values.output_hash = hash_writer.digest()
 
     return reused_values.output_hash
@@ -134,95 +172,153 @@ def get_payload_hash(tx, reused_values):
 
     if reused_values.payload_hash is None:
         hash_writer = new_transaction_signing_hash_writer()
-        hash_data(hash_writer, tx.payload, 'raw_bytes')
+        hash_writer.update(tx.payload)
         reused_values.payload_hash = hash_writer.digest()
 
     return reused_values.payload_hash
 
 
-def calculate_signature_hash(tx, idx, txin, prevscriptpk, hashtype, reused_values):
-
-    hash_writer = new_transaction_signing_hash_writer()
-
-    # tx version
-    hash_data(hash_writer, tx.version, 'uint16')
-
-    # previous output hash (get_previous_outpoint_hash)
-    previous_outpoint_hash = get_previous_outputs_hash(tx, hashtype, reused_values)
-    hash_data(hash_writer, previous_outpoint_hash, 'raw_bytes')
-
-    # sequence hash
-    sequence_hash = get_sequence_hash(tx, hashtype, reused_values)
-    hash_data(hash_writer, sequence_hash, 'raw_bytes')
-
-    # sig op count hash
-    sig_op_count_hash = get_sig_op_count_hash(tx, hashtype, reused_values)
-    hash_data(hash_writer, sig_op_count_hash, 'raw_bytes')
-
-    # outpoint hash
-    hash_data(hash_writer, txin.previous_outpoint.tx_id)
-    hash_data(hash_writer, txin.previous_outpoint.index, 'uint32')
-
-    # prevscriptpk
-    hash_data(hash_writer, prevscriptpk.version, 'uint16')
-    hash_data(hash_writer, bytes(prevscriptpk.script), 'bytes')
-
-    # txin
-    hash_data(hash_writer, txin.utxo_entry.amount, 'uint64')
-    hash_data(hash_writer, txin.sequence, 'uint64')
-    sig_op_count = int.from_bytes(txin.sig_op_count, byteorder='little')
-    hash_data(hash_writer, sig_op_count, 'uint8')
-
-    # output hash
-    output_hash = get_output_hash(tx, idx, hashtype, reused_values)
-    hash_data(hash_writer, output_hash, 'raw_bytes')
-
-    # locktime, subnetwork, gas
-    hash_data(hash_writer, tx.locktime, 'uint64')
-    hash_data(hash_writer, tx.subnetwork_id, 'domain_subnetwork_id')
-    hash_data(hash_writer, tx.gas, 'uint64')
+class SigningContext:
+    # Signature hashes of the inputs of one transaction, create it once the inputs and outputs are final.
+    # The sub-hashes over all inputs and outputs are computed once per transaction instead of once per input
+    # and the writer state after the fields shared by every input is copied, signing k inputs is O(k).
+    def __init__(self, tx, reused_values=None):
+        self.tx = tx
+        self.reused_values = reused_values if reused_values is not None else SighashReusedValues()
+        # hash type flag -> (writer after the shared prefix, bytes after the output hash)
+        self.prepared = {}
+
+    def prepare(self, hashtype):
+        prepared = self.prepared.get(hashtype.flag)
+        if prepared is None:
+            tx, reused_values = self.tx, self.reused_values
+            prefix = new_transaction_signing_hash_writer()
+            prefix.update(UINT16.pack(tx.version) +
+                          get_previous_outputs_hash(tx, hashtype, reused_values) +
+                          get_sequence_hash(tx, hashtype, reused_values) +
+                          get_sig_op_count_hash(tx, hashtype, reused_values))
+            suffix = (TX_FIELDS.pack(tx.locktime, subnetwork_id_bytes(tx.subnetwork_id), tx.gas) +
+                      get_payload_hash(tx, reused_values) + UINT8.pack(hashtype.flag))
+            prepared = (prefix, suffix)
+            self.prepared[hashtype.flag] = prepared
+        return prepared
+
+    def signature_hash(self, idx, hashtype, txin=None, prevscriptpk=None):
+        txin = txin or self.tx.inputs[idx]
+        prevscriptpk = prevscriptpk or txin.utxo_entry.script_public_key
+        prefix, suffix = self.prepare(hashtype)
+        script = bytes(prevscriptpk.script)
+        hash_writer = prefix.copy()
+        hash_writer.update(b''.join((
+            tx_id_bytes(txin.previous_outpoint.tx_id),
+            UINT32.pack(txin.previous_outpoint.index),
+            SCRIPT_HEADER.pack(prevscriptpk.version, len(script)),
+            script,
+            INPUT_FIELDS.pack(txin.utxo_entry.amount, txin.sequence,
+                              int.from_bytes(txin.sig_op_count, byteorder='little')),
+            get_output_hash(self.tx, idx, hashtype, self.reused_values),
+            suffix
+        )))
+        return hash_writer.digest()
 
-    # payload hash
-    payload_hash = get_payload_hash(tx, reused_values)
-    hash_data(hash_writer, payload_hash, 'raw_bytes')
+    def sign_input(self, idx, hashtype, priv_key):
+        # signature followed by the hash type, ready for the signature script
+        msg_hash = self.signature_hash(idx, hashtype)
+        if not priv_key:
+            logger.info(f"Msg hash: {msg_hash.hex()}")
+            logger.info('External signing, you can use the schnorr_signature.py script included in klib')
+            signature = bytes.fromhex(input('Insert signature (in hex): ').strip())
+        else:
+            signature = sign_hash(msg_hash, priv_key)
+            logger.debug(f"Signature: {signature.hex()}")
+        return signature + UINT8.pack(hashtype.flag)
 
-    # hashtype
-    hash_data(hash_writer, hashtype.flag, 'uint8')
 
-    return hash_writer.digest()
+def calculate_signature_hash(tx, idx, txin, prevscriptpk, hashtype, reused_values):
+    return SigningContext(tx, reused_values).signature_hash(idx, hashtype, txin, prevscriptpk)
 
 
 def raw_tx_in_signature(tx, idx, hashtype, priv_key, reused_values):
-    msg_hash = calculate_signature_hash(tx, idx, tx.inputs[idx], tx.inputs[idx].utxo_entry.script_public_key, hashtype, reused_values)
-    if not priv_key:
-        logger.info(f"Msg hash: {msg_hash.hex()}")
-        logger.info('External signing, you can use the schnorr_signature.py script included in klib')
-        signature = bytes.fromhex(input('Insert signature (in hex): ').strip())
-    else:
-        signature = sign_hash(msg_hash, priv_key)
-        logger.debug(f"Signature: {signature.hex()}")
-    return signature + struct.pack('<B', hashtype.flag)
+    # signing several inputs of the same tx: use one SigningContext
+    return SigningContext(tx, reused_values).sign_input(idx, hashtype, priv_key)
 
 
 def sign_hash(msg_hash, priv_key):
-    try:
-        signing_key = PrivateKey(priv_key)
-        signature = signing_key.sign_schnorr(msg_hash, aux_randomness=os.urandom(32))
-    except NameError:
-        signature = schnorr_sign(msg_hash, priv_key, os.urandom(32))
-    return signature
-
-
-def verify_signature(signature, msg_hash, pubkey):
-    try:
-        xonly_pubkey = PublicKeyXOnly(data=pubkey)
-        sig_verify = xonly_pubkey.verify(signature, msg_hash)
-    except NameError:
-        logger.error(f"Coincurve schnorrsig verify failed, reverting to internal signing")
-        sig_verify = schnorr_verify(msg_hash, pubkey, signature)
+    return crypto_backend.backend.sign(msg_hash, priv_key, os.urandom(32))
+
+
+def sign_hashes(items):
+    # [(msg_hash, priv_key), ...] -> [signature, ...], module level so a process pool can pickle it
+    return [sign_hash(msg_hash, priv_key) for msg_hash, priv_key in items]
+
+
+def sign_inputs(tx, keys, hashtype=None, executor=None, script_builder=None):
+    # Sign many inputs of one transaction: keys is [(input index, priv key), ...], the result follows its order.
+    # The signature hashes are computed up front from one SigningContext, the schnorr signatures in executor.
+    # coincurve releases the GIL so a thread pool is enough, the pure-Python backend needs a ProcessPoolExecutor.
+    # Without executor a temporary thread pool is used from PARALLEL_SIGN_MIN_INPUTS inputs.
+    # Returns signatures followed by the hash type, or script_builder(input index, signature) when given.
+    # Inputs without priv key are signed externally in the calling thread, like raw_tx_in_signature.
+    hashtype = hashtype or SigHashType(1)
+    signing_context = SigningContext(tx)
+    signatures = [None] * len(keys)
+    todo = []
+    for i, (idx, priv_key) in enumerate(keys):
+        if priv_key:
+            todo.append((i, (signing_context.signature_hash(idx, hashtype), priv_key)))
+        else:
+            signatures[i] = signing_context.sign_input(idx, hashtype, priv_key)
+
+    if todo:
+        items = [item for _, item in todo]
+        chunks = [items[start:start + SIGN_CHUNK_SIZE] for start in range(0, len(items), SIGN_CHUNK_SIZE)]
+        if executor is not None:
+            results = executor.map(sign_hashes, chunks)
+        elif len(items) >= PARALLEL_SIGN_MIN_INPUTS:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(chunks), os.cpu_count() or 1),
+                                                       thread_name_prefix='ksign') as pool:
+                results = list(pool.map(sign_hashes, chunks))
+        else:
+            results = [sign_hashes(items)]
+        flag = UINT8.pack(hashtype.flag)
+        chunk_signatures = (signature for chunk in results for signature in chunk)
+        for (i, _), signature in zip(todo, chunk_signatures):
+            signatures[i] = signature + flag
+
+    if script_builder is None:
+        return signatures
+    return [script_builder(idx, signature) for (idx, _), signature in zip(keys, signatures)]
+
+
+def verify_signature(signature, msg_hash, pubkey, check_cache=True):
+    cache_key = (bytes(pubkey), bytes(msg_hash), bytes(signature))
+    if check_cache and verify_cache.check(cache_key):
+        return True
+    sig_verify = crypto_backend.backend.verify(signature, msg_hash, pubkey)
+    if sig_verify:
+        verify_cache.add(cache_key)
     return sig_verify
 
 
+def verify_signatures(items, check_cache=True):
+    # [(signature, msg_hash, pubkey), ...] -> [bool, ...], a malformed item is just invalid
+    items = [(bytes(signature), bytes(msg_hash), bytes(pubkey)) for signature, msg_hash, pubkey in items]
+    results = [False] * len(items)
+    todo = []
+    for i, (signature, msg_hash, pubkey) in enumerate(items):
+        if check_cache and verify_cache.check((pubkey, msg_hash, signature)):
+            results[i] = True
+        else:
+            todo.append(i)
+    verified = crypto_backend.backend.batch_verify([items[i] for i in todo])
+    for i, sig_verify in zip(todo, verified):
+        results[i] = sig_verify
+        if sig_verify:
+            signature, msg_hash, pubkey = items[i]
+            verify_cache.add((pubkey, msg_hash, signature))
+    return results
+
+
 # Providing functionality for demonstration
 if __name__ == "__main__":
     inputs = [
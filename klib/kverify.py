@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import functools
+import concurrent.futures
+
+from .ksign import verify_signatures, verify_cache
+
+logger = logging.getLogger('kverify')
+
+# signatures verified together in one worker call
+MAX_BATCH = 64
+
+
+class SignatureVerifier:
+    # Off-loop schnorr verification for inbound messages.
+    # verify() returns a future, requests queued in the same loop iteration (e.g. a gossip burst read from
+    # one socket chunk) are verified as one batch in a worker, so the event loop only queues and resolves.
+    # Pass a ProcessPoolExecutor to keep the pure-Python fallback from competing with the loop for the GIL.
+    def __init__(self, executor=None, max_batch=MAX_BATCH):
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=2,
+                                                                          thread_name_prefix='kverify')
+        self.max_batch = max_batch
+        self.loop = None
+        self.pending = []
+        self.flush_handle = None
+
+    def verify(self, signature, msg_hash, pubkey):
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+        future = loop.create_future()
+        signature, msg_hash, pubkey = bytes(signature), bytes(msg_hash), bytes(pubkey)
+        # a message seen before costs a dict lookup, no trip to the worker
+        if verify_cache.check((pubkey, msg_hash, signature)):
+            future.set_result(True)
+            return future
+        self.pending.append(((signature, msg_hash, pubkey), future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_soon(self.flush)
+        return future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        items = [item for item, _ in batch]
+        futures = [future for _, future in batch]
+        worker = self.loop.run_in_executor(self.executor, functools.partial(verify_signatures, items,
+                                                                            check_cache=False))
+        worker.add_done_callback(lambda done: self.resolve(items, futures, done))
+
+    @staticmethod
+    def resolve(items, futures, worker):
+        if worker.cancelled():
+            results = [False] * len(futures)
+        elif worker.exception() is not None:
+            logger.error(f"Signature verification failed: {worker.exception()}")
+            results = [False] * len(futures)
+        else:
+            results = worker.result()
+        for (signature, msg_hash, pubkey), future, result in zip(items, futures, results):
+            if result:
+                # a process pool worker fills its own copy of the cache
+                verify_cache.add((pubkey, msg_hash, signature))
+            if not future.done():
+                future.set_result(result)
+
+    def close(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        for _, future in self.pending:
+            future.cancel()
+        self.pending = []
+        self.executor.shutdown(wait=False)
+
+
+# one verifier per event loop
+verifiers = {}
+
+
+def get_verifier():
+    loop = asyncio.get_running_loop()
+    verifier = verifiers.get(loop)
+    if verifier is None:
+        for stale_loop in [stale for stale in verifiers if stale.is_closed()]:
+            verifiers.pop(stale_loop).close()
+        verifier = SignatureVerifier()
+        verifiers[loop] = verifier
+    return verifier
+
+
+async def async_verify_signature(signature, msg_hash, pubkey):
+    return await get_verifier().verify(signature, msg_hash, pubkey)
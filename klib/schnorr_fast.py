@@ -0,0 +1,267 @@
+# Fast pure-Python BIP340, used when coincurve is not installed.
+# Same interface and results as schnorr_signature.py (the BIP reference code), which stays as the oracle:
+# tests/test_schnorr_fast.py cross-checks both implementations.
+#
+# - Jacobian coordinates, one modular inversion per scalar multiplication instead of one per addition
+# - k*G with a fixed-base comb table (64 windows of 4 bits, no doublings)
+# - s*G - e*P with Strauss-Shamir: one shared doubling chain, wNAF digits for G and P
+# - tagged hashes resume from the sha256 midstate of the tag prefix
+# - batch verification of many signatures with a single multi-scalar multiplication
+
+import os
+import hashlib
+
+from .schnorr_signature import p, n, G, lift_x, bytes_from_int, int_from_bytes, xor_bytes
+
+COMB_BITS = 4
+COMB_WINDOWS = 256 // COMB_BITS
+G_WNAF_WIDTH = 8
+P_WNAF_WIDTH = 5
+BATCH_WNAF_WIDTH = 4
+
+INFINITY = (1, 1, 0)
+
+_tag_midstates = {}
+
+
+def tagged_hash(tag: str, msg: bytes) -> bytes:
+    midstate = _tag_midstates.get(tag)
+    if midstate is None:
+        tag_hash = hashlib.sha256(tag.encode()).digest()
+        midstate = hashlib.sha256(tag_hash + tag_hash)
+        _tag_midstates[tag] = midstate
+    hash_writer = midstate.copy()
+    hash_writer.update(msg)
+    return hash_writer.digest()
+
+
+def jacobian_double(P1):
+    X1, Y1, Z1 = P1
+    if not Z1 or not Y1:
+        return INFINITY
+    YY = Y1 * Y1 % p
+    S = 4 * X1 * YY % p
+    M = 3 * X1 * X1 % p
+    X3 = (M * M - 2 * S) % p
+    Y3 = (M * (S - X3) - 8 * YY * YY) % p
+    Z3 = 2 * Y1 * Z1 % p
+    return X3, Y3, Z3
+
+
+def jacobian_add_affine(P1, x2, y2):
+    # P1 jacobian + (x2, y2) affine
+    X1, Y1, Z1 = P1
+    if not Z1:
+        return x2, y2, 1
+    Z1Z1 = Z1 * Z1 % p
+    H = (x2 * Z1Z1 - X1) % p
+    r = (y2 * Z1 * Z1Z1 - Y1) % p
+    if not H:
+        return jacobian_double(P1) if not r else INFINITY
+    HH = H * H % p
+    HHH = H * HH % p
+    V = X1 * HH % p
+    X3 = (r * r - HHH - 2 * V) % p
+    Y3 = (r * (V - X3) - Y1 * HHH) % p
+    Z3 = Z1 * H % p
+    return X3, Y3, Z3
+
+
+def to_affine(P1):
+    X1, Y1, Z1 = P1
+    if not Z1:
+        return None
+    z_inv = pow(Z1, -1, p)
+    z_inv2 = z_inv * z_inv % p
+    return X1 * z_inv2 % p, Y1 * z_inv2 * z_inv % p
+
+
+def batch_to_affine(points):
+    # Montgomery trick, one inversion for the whole list (no point at infinity allowed)
+    products = []
+    acc = 1
+    for _, _, Z in points:
+        products.append(acc)
+        acc = acc * Z % p
+    acc_inv = pow(acc, -1, p)
+    affine = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        X, Y, Z = points[i]
+        z_inv = acc_inv * products[i] % p
+        acc_inv = acc_inv * Z % p
+        z_inv2 = z_inv * z_inv % p
+        affine[i] = (X * z_inv2 % p, Y * z_inv2 * z_inv % p)
+    return affine
+
+
+def odd_multiples(P1, count):
+    # [P, 3P, 5P, ...] in jacobian coordinates, P affine
+    doubled = to_affine(jacobian_double((P1[0], P1[1], 1)))
+    multiples = [(P1[0], P1[1], 1)]
+    for _ in range(count - 1):
+        multiples.append(jacobian_add_affine(multiples[-1], *doubled))
+    return multiples
+
+
+def wnaf(k, width):
+    # width-w non adjacent form, least significant digit first
+    digits = []
+    window = 1 << width
+    half = window >> 1
+    while k:
+        if k & 1:
+            digit = k & (window - 1)
+            if digit >= half:
+                digit -= window
+            k -= digit
+        else:
+            digit = 0
+        digits.append(digit)
+        k >>= 1
+    return digits
+
+
+_comb_table = None
+_g_wnaf_table = None
+
+
+def comb_table():
+    # table[i][j] = j * 2^(4i) * G, affine, j = 1..15
+    global _comb_table
+    if _comb_table is None:
+        points = []
+        base = (G[0], G[1], 1)
+        for _ in range(COMB_WINDOWS):
+            base_affine = to_affine(base)
+            multiple = base
+            points.append(multiple)
+            for _ in range((1 << COMB_BITS) - 2):
+                multiple = jacobian_add_affine(multiple, *base_affine)
+                points.append(multiple)
+            for _ in range(COMB_BITS):
+                base = jacobian_double(base)
+        affine = batch_to_affine(points)
+        size = (1 << COMB_BITS) - 1
+        _comb_table = [[None] + affine[i * size:(i + 1) * size] for i in range(COMB_WINDOWS)]
+    return _comb_table
+
+
+def g_wnaf_table():
+    global _g_wnaf_table
+    if _g_wnaf_table is None:
+        _g_wnaf_table = batch_to_affine(odd_multiples(G, 1 << (G_WNAF_WIDTH - 2)))
+    return _g_wnaf_table
+
+
+def g_mul(k):
+    # k * G, jacobian
+    table = comb_table()
+    R = INFINITY
+    mask = (1 << COMB_BITS) - 1
+    for i in range(COMB_WINDOWS):
+        digit = (k >> (i * COMB_BITS)) & mask
+        if digit:
+            R = jacobian_add_affine(R, *table[i][digit])
+    return R
+
+
+def multi_mul(terms):
+    # sum of k_i * P_i with a shared doubling chain (Strauss), terms are (k, affine odd multiples table, width)
+    digit_lists = [(wnaf(k, width), table) for k, table, width in terms if k]
+    if not digit_lists:
+        return INFINITY
+    R = INFINITY
+    for i in range(max(len(digits) for digits, _ in digit_lists) - 1, -1, -1):
+        R = jacobian_double(R)
+        for digits, table in digit_lists:
+            if i < len(digits) and digits[i]:
+                digit = digits[i]
+                x2, y2 = table[abs(digit) >> 1]
+                R = jacobian_add_affine(R, x2, y2 if digit > 0 else p - y2)
+    return R
+
+
+def pubkey_gen(seckey: bytes) -> bytes:
+    d0 = int_from_bytes(seckey)
+    if not (1 <= d0 <= n - 1):
+        raise ValueError('The secret key must be an integer in the range 1..n-1.')
+    return bytes_from_int(to_affine(g_mul(d0))[0])
+
+
+def schnorr_sign(msg: bytes, seckey: bytes, aux_rand: bytes) -> bytes:
+    # unlike the reference code the signature is not verified again, the tests check g_mul and the signatures
+    # against the reference instead
+    d0 = int_from_bytes(seckey)
+    if not (1 <= d0 <= n - 1):
+        raise ValueError('The secret key must be an integer in the range 1..n-1.')
+    if len(aux_rand) != 32:
+        raise ValueError('aux_rand must be 32 bytes instead of %i.' % len(aux_rand))
+    P = to_affine(g_mul(d0))
+    d = d0 if P[1] % 2 == 0 else n - d0
+    t = xor_bytes(bytes_from_int(d), tagged_hash("BIP0340/aux", aux_rand))
+    pubkey = bytes_from_int(P[0])
+    k0 = int_from_bytes(tagged_hash("BIP0340/nonce", t + pubkey + msg)) % n
+    if k0 == 0:
+        raise RuntimeError('Failure. This happens only with negligible probability.')
+    R = to_affine(g_mul(k0))
+    k = n - k0 if R[1] % 2 else k0
+    r = bytes_from_int(R[0])
+    e = int_from_bytes(tagged_hash("BIP0340/challenge", r + pubkey + msg)) % n
+    return r + bytes_from_int((k + e * d) % n)
+
+
+def schnorr_verify(msg: bytes, pubkey: bytes, sig: bytes) -> bool:
+    if len(pubkey) != 32:
+        raise ValueError('The public key must be a 32-byte array.')
+    if len(sig) != 64:
+        raise ValueError('The signature must be a 64-byte array.')
+    P = lift_x(int_from_bytes(pubkey))
+    r = int_from_bytes(sig[0:32])
+    s = int_from_bytes(sig[32:64])
+    if (P is None) or (r >= p) or (s >= n):
+        return False
+    e = int_from_bytes(tagged_hash("BIP0340/challenge", sig[0:32] + pubkey + msg)) % n
+    p_table = batch_to_affine(odd_multiples(P, 1 << (P_WNAF_WIDTH - 2)))
+    R = multi_mul([(s, g_wnaf_table(), G_WNAF_WIDTH), (n - e, p_table, P_WNAF_WIDTH)])
+    X, Y, Z = R
+    if not Z:
+        return False
+    # x(R) == r without inverting Z, then the parity of y needs the affine point
+    ZZ = Z * Z % p
+    if X != r * ZZ % p:
+        return False
+    return (Y * pow(ZZ * Z % p, -1, p) % p) % 2 == 0
+
+
+def schnorr_batch_verify(items) -> bool:
+    # items: [(msg, pubkey, sig), ...], True when every signature is valid (BIP340 batch verification)
+    # sum(a_i * s_i) * G - sum(a_i * R_i) - sum(a_i * e_i * P_i) == 0 with random a_i, a_0 = 1
+    g_scalar = 0
+    terms = []
+    points = []
+    for i, (msg, pubkey, sig) in enumerate(items):
+        if len(pubkey) != 32 or len(sig) != 64:
+            return False
+        P = lift_x(int_from_bytes(pubkey))
+        r = int_from_bytes(sig[0:32])
+        s = int_from_bytes(sig[32:64])
+        R = lift_x(r)
+        if P is None or R is None or s >= n:
+            return False
+        e = int_from_bytes(tagged_hash("BIP0340/challenge", sig[0:32] + pubkey + msg)) % n
+        a = 1 if i == 0 else 1 + int_from_bytes(os.urandom(16))
+        g_scalar = (g_scalar + a * s) % n
+        terms.append(((n - a) % n, len(points)))
+        points.append(R)
+        terms.append(((n - a * e % n) % n, len(points)))
+        points.append(P)
+    if not points:
+        return True
+    size = 1 << (BATCH_WNAF_WIDTH - 2)
+    jacobian = [multiple for point in points for multiple in odd_multiples(point, size)]
+    affine = batch_to_affine(jacobian)
+    scalars = [(g_scalar, g_wnaf_table(), G_WNAF_WIDTH)]
+    for k, index in terms:
+        scalars.append((k, affine[index * size:(index + 1) * size], BATCH_WNAF_WIDTH))
+    return not multi_mul(scalars)[2]
+
@@ -1,7 +1,11 @@
 
 import json
+import hashlib
 
 from . import kdatatype as kdt
+from .krpc import parse_script_public_key
+from .ksign import (transactionIDDomain, transactionHashDomain, subnetwork_id_bytes, tx_id_bytes,
+                    UINT8, UINT16, UINT32, UINT64)
 # from .wallet_pb2 import (
 #     PartiallySignedTransaction,
 #     TransactionMessage,
@@ -23,7 +27,7 @@ from . import kdatatype as kdt
 # This code is mostly unused
 
 
-def gen_rpc_transaction(tx):
+def gen_rpc_transaction_dict(tx):
     rpc_tx = {}
     rpc_tx["version"] = tx.version
     rpc_tx["inputs"] = [
@@ -43,10 +47,142 @@ def gen_rpc_transaction(tx):
         for o in tx.outputs
     ]
     rpc_tx['lockTime'] = tx.locktime
-    rpc_tx['subnetworkId'] = '00'*20
+    rpc_tx['subnetworkId'] = subnetwork_id_bytes(tx.subnetwork_id).hex()
     rpc_tx['gas'] = tx.gas
     rpc_tx['payload'] = tx.payload.hex()
-    return json.dumps(rpc_tx)
+    return rpc_tx
+
+
+def gen_rpc_transaction(tx):
+    return json.dumps(gen_rpc_transaction_dict(tx))
+
+
+def subnetwork_id_from_bytes(subnetwork_id):
+    # builtin subnetworks back to their number, like kdt.Subnetworks
+    return subnetwork_id[0] if not any(subnetwork_id[1:]) else subnetwork_id
+
+
+def transaction_from_rpc_dict(rpc_tx):
+    # inverse of gen_rpc_transaction_dict, also reads the wRPC layout of transactions from mempool entries
+    # or block notifications (outputs with value and a hex scriptPublicKey)
+    outputs = []
+    for o in rpc_tx.get('outputs', []):
+        script_public_key = parse_script_public_key(o['scriptPublicKey'])
+        outputs.append(kdt.Output(int(o['value'] if 'value' in o else o['amount']),
+                                  kdt.ScriptPublicKey(int(script_public_key.get('version', 0)),
+                                                      bytes.fromhex(script_public_key['scriptPublicKey']))))
+    tx = kdt.Transaction(
+        [kdt.Input(kdt.OutPoint(i['previousOutpoint']['transactionId'], int(i['previousOutpoint'].get('index', 0))),
+                   None,
+                   int(i.get('sequence', 0)),
+                   bytes([int(i.get('sigOpCount', 0))]),
+                   bytes.fromhex(i.get('signatureScript', '')))
+         for i in rpc_tx.get('inputs', [])],
+        outputs,
+        int(rpc_tx.get('version', 0)),
+        int(rpc_tx.get('lockTime', 0)),
+        subnetwork_id_from_bytes(bytes.fromhex(rpc_tx.get('subnetworkId') or '00' * 20)),
+        int(rpc_tx.get('gas', 0)),
+        bytes.fromhex(rpc_tx.get('payload', ''))
+    )
+    tx.tx_id = (rpc_tx.get('verboseData') or {}).get('transactionId') or transaction_id(tx)
+    return tx
+
+
+# Binary encoding of a transaction, the one kaspad hashes for the transaction id and hash:
+# little endian integers, u64 length before variable length fields, utxo entries are not part of it.
+
+def serialize_transaction(tx, exclude_signature_script=False):
+    chunks = [UINT16.pack(tx.version), UINT64.pack(len(tx.inputs))]
+    for tx_input in tx.inputs:
+        chunks.append(tx_id_bytes(tx_input.previous_outpoint.tx_id))
+        chunks.append(UINT32.pack(tx_input.previous_outpoint.index))
+        if exclude_signature_script:
+            chunks.append(UINT64.pack(0))
+        else:
+            signature_script = tx_input.signature_script or b''
+            chunks.append(UINT64.pack(len(signature_script)))
+            chunks.append(signature_script)
+            chunks.append(UINT8.pack(int.from_bytes(tx_input.sig_op_count, byteorder='little')))
+        chunks.append(UINT64.pack(tx_input.sequence))
+    chunks.append(UINT64.pack(len(tx.outputs)))
+    for tx_output in tx.outputs:
+        script = bytes(tx_output.script_public_key.script)
+        chunks.append(UINT64.pack(tx_output.value))
+        chunks.append(UINT16.pack(tx_output.script_public_key.version))
+        chunks.append(UINT64.pack(len(script)))
+        chunks.append(script)
+    chunks.append(UINT64.pack(tx.locktime))
+    chunks.append(subnetwork_id_bytes(tx.subnetwork_id))
+    chunks.append(UINT64.pack(tx.gas))
+    chunks.append(UINT64.pack(len(tx.payload)))
+    chunks.append(tx.payload)
+    return b''.join(chunks)
+
+
+class TransactionReader:
+    # cursor over a serialized transaction, ValueError when it's truncated
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def read(self, size):
+        if self.offset + size > len(self.data):
+            raise ValueError(f"Truncated transaction, {size} bytes needed at offset {self.offset}")
+        chunk = bytes(self.data[self.offset:self.offset + size])
+        self.offset += size
+        return chunk
+
+    def unpack(self, fmt):
+        return fmt.unpack(self.read(fmt.size))[0]
+
+    def read_var_bytes(self):
+        return self.read(self.unpack(UINT64))
+
+
+def deserialize_transaction(data):
+    # full encoding only (with signature scripts), inputs come back without utxo entry
+    reader = TransactionReader(data)
+    version = reader.unpack(UINT16)
+    inputs = []
+    for _ in range(reader.unpack(UINT64)):
+        outpoint = kdt.OutPoint(reader.read(32).hex(), reader.unpack(UINT32))
+        signature_script = reader.read_var_bytes()
+        sig_op_count = reader.read(1)
+        inputs.append(kdt.Input(outpoint, None, reader.unpack(UINT64), sig_op_count, signature_script))
+    outputs = []
+    for _ in range(reader.unpack(UINT64)):
+        value = reader.unpack(UINT64)
+        spk_version = reader.unpack(UINT16)
+        outputs.append(kdt.Output(value, kdt.ScriptPublicKey(spk_version, reader.read_var_bytes())))
+    locktime = reader.unpack(UINT64)
+    subnetwork_id = subnetwork_id_from_bytes(reader.read(20))
+    gas = reader.unpack(UINT64)
+    payload = reader.read_var_bytes()
+    if reader.offset != len(reader.data):
+        raise ValueError(f"{len(reader.data) - reader.offset} trailing bytes after the transaction")
+    tx = kdt.Transaction(inputs, outputs, version, locktime, subnetwork_id, gas, payload)
+    tx.tx_id = transaction_id(tx)
+    return tx
+
+
+def is_coinbase(tx):
+    return tx.subnetwork_id in (kdt.Subnetworks.subnetwork_id_coinbase, subnetwork_id_bytes(1))
+
+
+def transaction_id(tx):
+    # txid as returned by kaspad, signature scripts are left out (except for coinbase) so it's known before signing
+    hash_writer = hashlib.blake2b(key=bytes(transactionIDDomain, 'utf-8'), digest_size=32)
+    hash_writer.update(serialize_transaction(tx, exclude_signature_script=not is_coinbase(tx)))
+    return hash_writer.hexdigest()
+
+
+def transaction_hash(tx):
+    # hash of the full transaction, signatures included (the mass committed by the node is not, it's 0 here)
+    hash_writer = hashlib.blake2b(key=bytes(transactionHashDomain, 'utf-8'), digest_size=32)
+    hash_writer.update(serialize_transaction(tx))
+    return hash_writer.hexdigest()
+
 
 #
 # def deserialize_partially_signed_transaction():
@@ -0,0 +1,266 @@
+import bisect
+import random
+import logging
+import itertools
+
+from collections import namedtuple
+
+logger = logging.getLogger('orderbook')
+
+SIDES = ('sat2kas', 'kas2sat')
+
+# one row of an orderbook snapshot, total is the sum of the max amounts at that price
+PriceLevel = namedtuple('PriceLevel', ['price', 'total', 'min_amount', 'max_amount', 'makers'])
+
+
+class IntervalNode:
+    __slots__ = ('key', 'priority', 'left', 'right', 'max_end', 'value')
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.max_end = key[1]
+
+    def update(self):
+        self.max_end = self.key[1]
+        if self.left is not None and self.left.max_end > self.max_end:
+            self.max_end = self.left.max_end
+        if self.right is not None and self.right.max_end > self.max_end:
+            self.max_end = self.right.max_end
+
+
+class IntervalTree:
+    # Treap of (start, end, ...) keys ordered by start, every node knows the largest end of its subtree.
+    # insert/remove are O(log n), stab(x) returns the k intervals containing x in O(log n + k).
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, key, value=None):
+        self.root = self._insert(self.root, IntervalNode(key, value))
+        self.size += 1
+
+    def _insert(self, node, new):
+        if node is None:
+            return new
+        if new.key < node.key:
+            node.left = self._insert(node.left, new)
+            if node.left.priority > node.priority:
+                node = self._rotate_right(node)
+        else:
+            node.right = self._insert(node.right, new)
+            if node.right.priority > node.priority:
+                node = self._rotate_left(node)
+        node.update()
+        return node
+
+    def remove(self, key):
+        size = self.size
+        self.root = self._remove(self.root, key)
+        return self.size < size
+
+    def _remove(self, node, key):
+        if node is None:
+            return None
+        if key < node.key:
+            node.left = self._remove(node.left, key)
+        elif key > node.key:
+            node.right = self._remove(node.right, key)
+        else:
+            self.size -= 1
+            return self._merge(node.left, node.right)
+        node.update()
+        return node
+
+    def _merge(self, left, right):
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = self._merge(left.right, right)
+            left.update()
+            return left
+        right.left = self._merge(left, right.left)
+        right.update()
+        return right
+
+    @staticmethod
+    def _rotate_right(node):
+        left = node.left
+        node.left = left.right
+        left.right = node
+        node.update()
+        left.update()
+        return left
+
+    @staticmethod
+    def _rotate_left(node):
+        right = node.right
+        node.right = right.left
+        right.left = node
+        node.update()
+        right.update()
+        return right
+
+    def stab(self, x):
+        # (key, value) of every interval with start <= x <= end
+        result = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None or node.max_end < x:
+                continue
+            stack.append(node.left)
+            if node.key[0] <= x:
+                if x <= node.key[1]:
+                    result.append((node.key, node.value))
+                stack.append(node.right)
+        return result
+
+
+class OrderBook:
+    # Price levels per side, kept up to date offer by offer.
+    # update_maker() only touches the levels whose offers changed, the per-level totals are recomputed lazily
+    # for those levels, so a render costs O(changed offers) instead of a rebuild from every server payload.
+    def __init__(self):
+        # side -> price -> maker_id -> offers of that maker at that price
+        self.levels = {side: {} for side in SIDES}
+        # side -> level prices, ascending
+        self.prices = {side: [] for side in SIDES}
+        # maker_id -> side -> offers currently indexed
+        self.maker_offers = {}
+        # maker_id -> server entry ({'transport', 'last_ping', 'payload'})
+        self.servers = {}
+        # side -> price -> (total, min_amount, max_amount), missing when the level changed
+        self.summaries = {side: {} for side in SIDES}
+        # side -> offer amount ranges, to find the offers able to fill a given amount
+        self.amount_index = {side: IntervalTree() for side in SIDES}
+        # side -> maker_id -> keys of the maker offers in amount_index
+        self.amount_keys = {side: {} for side in SIDES}
+        self.offer_ids = itertools.count()
+        self.version = 0
+        # selected_amount -> snapshot, valid for snapshots_version
+        self.snapshots = {}
+        self.snapshots_version = 0
+
+    def __getitem__(self, side):
+        return self.levels[side]
+
+    def update_maker(self, maker_id, server):
+        self.servers[maker_id] = server
+        payload = server.get('payload') or {}
+        old_offers = self.maker_offers.get(maker_id, {})
+        new_offers = {side: list(payload.get(side) or []) for side in SIDES}
+        if old_offers == new_offers:
+            return False
+        for side in SIDES:
+            if old_offers.get(side, []) != new_offers[side]:
+                self.reindex(side, maker_id, old_offers.get(side, []), new_offers[side])
+        self.maker_offers[maker_id] = new_offers
+        self.version += 1
+        return True
+
+    def remove_maker(self, maker_id):
+        self.servers.pop(maker_id, None)
+        old_offers = self.maker_offers.pop(maker_id, None)
+        if old_offers is None:
+            return False
+        for side in SIDES:
+            self.reindex(side, maker_id, old_offers.get(side, []), [])
+        self.version += 1
+        return True
+
+    def reindex(self, side, maker_id, old_offers, new_offers):
+        levels = self.levels[side]
+        for offer in old_offers:
+            price = offer['price']
+            makers = levels.get(price)
+            if makers is None or maker_id not in makers:
+                continue
+            del makers[maker_id]
+            self.summaries[side].pop(price, None)
+            if not makers:
+                del levels[price]
+                del self.prices[side][bisect.bisect_left(self.prices[side], price)]
+        for offer in new_offers:
+            price = offer['price']
+            if price not in levels:
+                levels[price] = {}
+                bisect.insort(self.prices[side], price)
+            levels[price].setdefault(maker_id, []).append(offer)
+            self.summaries[side].pop(price, None)
+        # amount ranges
+        for key in self.amount_keys[side].pop(maker_id, []):
+            self.amount_index[side].remove(key)
+        keys = []
+        for offer in new_offers:
+            key = (offer['min_amount'], offer['max_amount'], next(self.offer_ids))
+            self.amount_index[side].insert(key, (offer['price'], maker_id, offer))
+            keys.append(key)
+        if keys:
+            self.amount_keys[side][maker_id] = keys
+
+    def makers(self, side, price):
+        # server entries of the makers offering at price
+        return [self.servers[maker_id] for maker_id in self.levels[side].get(price, {})]
+
+    def level_offers(self, side, price):
+        for offers in self.levels[side].get(price, {}).values():
+            yield from offers
+
+    def summary(self, side, price):
+        summary = self.summaries[side].get(price)
+        if summary is None:
+            offers = list(self.level_offers(side, price))
+            summary = (
+                sum(offer['max_amount'] for offer in offers),
+                min(offer['min_amount'] for offer in offers),
+                max(offer['max_amount'] for offer in offers)
+            )
+            self.summaries[side][price] = summary
+        return summary
+
+    def sorted_prices(self, side):
+        # best first: lowest ask for sat2kas, highest bid for kas2sat
+        return list(reversed(self.prices[side])) if side == 'kas2sat' else list(self.prices[side])
+
+    def fillable(self, side, amount):
+        # price -> [(maker_id, offer)] for the offers accepting amount, levels best first
+        matches = {}
+        for _, (price, maker_id, offer) in self.amount_index[side].stab(amount):
+            matches.setdefault(price, []).append((maker_id, offer))
+        return dict(sorted(matches.items(), reverse=(side == 'kas2sat')))
+
+    def snapshot(self, selected_amount=0):
+        # {side: [PriceLevel, ...] best first}, rebuilt only after the book changed
+        if self.snapshots_version != self.version:
+            self.snapshots = {}
+            self.snapshots_version = self.version
+        snapshot = self.snapshots.get(selected_amount)
+        if snapshot is None:
+            snapshot = {side: self.side_levels(side, selected_amount) for side in SIDES}
+            self.snapshots[selected_amount] = snapshot
+        return snapshot
+
+    def side_levels(self, side, selected_amount=0):
+        if not selected_amount:
+            return [PriceLevel(price, *self.summary(side, price), tuple(self.levels[side][price]))
+                    for price in self.sorted_prices(side)]
+        levels = []
+        for price, offers in self.fillable(side, selected_amount).items():
+            amounts = [offer for _, offer in offers]
+            levels.append(PriceLevel(
+                price,
+                sum(offer['max_amount'] for offer in amounts),
+                min(offer['min_amount'] for offer in amounts),
+                max(offer['max_amount'] for offer in amounts),
+                tuple(dict.fromkeys(maker_id for maker_id, _ in offers))
+            ))
+        return levels
@@ -4,9 +4,17 @@ import json
 import os
 import time
 import logging
-import itertools
 
 from python_socks.async_.asyncio import Proxy
+
+try:
+    from p2p.orderbook import OrderBook
+    from p2p.quote_engine import fill_plan, spare_legs
+    from p2p import wire
+except ImportError:
+    from orderbook import OrderBook
+    from quote_engine import fill_plan, spare_legs
+    import wire
 # from dotenv import load_dotenv
 
 # load_dotenv()
@@ -15,6 +23,82 @@ logger = logging.getLogger('p2p_node')
 logger.setLevel(logging.DEBUG)
 
 
+# JSON lines bigger than this are dropped and the connection stays usable, a bigger binary frame closes it
+MAX_FRAME_SIZE = 1024 * 1024
+# biggest message of a peer without newlines parsed out of the buffer, bigger ones need the newline
+MAX_UNTERMINATED_SIZE = 64 * 1024
+
+
+class StreamFramer:
+    # Frames out of a TCP byte stream: newline delimited JSON, or length prefixed binary frames starting
+    # with wire.MAGIC (a byte JSON text can't start with), so both encodings can share the connection.
+    # Newlines are found with bytearray.find, bytes already scanned are not scanned again,
+    # and a frame can span any number of chunks. A malformed or oversized binary header raises wire.WireError,
+    # the stream can't be resynchronised after it.
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.discarding = False
+
+    def feed(self, data):
+        # list of (flags, body) for binary frames and (None, text) for JSON lines
+        self.buffer += data
+        frames = []
+        pos = 0
+        buffer = self.buffer
+        while pos < len(buffer):
+            if buffer[pos] == wire.MAGIC and not self.discarding:
+                try:
+                    size, body_start = wire.read_varint(buffer, pos + 2)
+                except wire.WireTruncated:
+                    break
+                if size > self.max_frame_size:
+                    raise wire.WireError(f"Binary frame of {size} bytes")
+                if body_start + size > len(buffer):
+                    break
+                frames.append((buffer[pos + 1], bytes(buffer[body_start:body_start + size])))
+                pos = body_start + size
+                continue
+            end = buffer.find(b'\n', max(pos, self.scanned))
+            if end < 0:
+                self.scanned = len(buffer)
+                break
+            if self.discarding:
+                self.discarding = False
+            elif end - pos > self.max_frame_size:
+                logger.warning(f"Dropped frame of {end - pos} bytes")
+            else:
+                frame = bytes(buffer[pos:end]).strip()
+                if frame:
+                    frames.append((None, frame))
+            pos = end + 1
+        del buffer[:pos]
+        self.scanned = max(self.scanned - pos, 0)
+        if self.scanned > self.max_frame_size:
+            # skip the rest of the oversized line, up to the next newline
+            logger.warning(f"Dropping frame bigger than {self.max_frame_size} bytes")
+            buffer.clear()
+            self.scanned = 0
+            self.discarding = True
+        return frames
+
+    def take_unterminated(self):
+        # older peers don't end their messages with a newline, accept a buffered complete JSON object
+        # only small buffers looking like one object are parsed, not a growing frame on every chunk
+        buffer = self.buffer
+        if self.discarding or len(buffer) > MAX_UNTERMINATED_SIZE or not buffer[:16].lstrip().startswith(b'{') \
+                or not buffer[-16:].rstrip().endswith(b'}'):
+            return None
+        try:
+            message = json.loads(self.buffer)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return None
+        self.buffer.clear()
+        self.scanned = 0
+        return message
+
+
 class NodeConnection(asyncio.Protocol):
     node = None
     transport = None
@@ -24,7 +108,11 @@ class NodeConnection(asyncio.Protocol):
 
     def __init__(self, node):
         self.node = node
-        self.buffer = ''
+        self.framer = StreamFramer()
+        # encoding of our outgoing messages, switched after the hello exchange
+        self.wire = wire.WIRE_JSON
+        # encodings offered by the peer in its client_hello
+        self.remote_wire = None
 
     def connection_made(self, transport) -> None:
         peername = transport.get_extra_info('peername')
@@ -36,22 +124,46 @@ class NodeConnection(asyncio.Protocol):
         self.node.connected_peers[transport] = transport
 
     def data_received(self, data: bytes) -> None:
-        # split lines, sometimes socket is slow, so we get multiple messages at once
-        data_string = data.decode().strip()
-        splitted_lines = data_string.split('\n')
-        for line in splitted_lines:
+        # every frame is decoded once here, the node gets the parsed message
+        messages = []
+        try:
+            frames = self.framer.feed(data)
+        except wire.WireError as e:
+            logger.warning(f"Closing connection to {self.peername}: {e}")
+            self.transport.close()
+            return
+        for flags, frame in frames:
             try:
-                json.loads(line)
-            except json.JSONDecodeError:
-                if line.startswith('{"type'):
-                    self.buffer = line
-                    return
-                elif line.endswith('}'):
-                    line = self.buffer + line
-                    self.buffer = ''
+                if flags is None:
+                    messages.append(json.loads(frame))
                 else:
-                    return
-            asyncio.create_task(self.node.read_message(self.transport, line))
+                    messages.append(wire.decode_body(flags, frame, self.framer.max_frame_size))
+            except (json.JSONDecodeError, UnicodeDecodeError, RecursionError, wire.WireError) as e:
+                logger.debug(f"Invalid message from {self.peername}: {e}")
+        if (message := self.framer.take_unterminated()) is not None:
+            messages.append(message)
+        for message in messages:
+            asyncio.create_task(self.node.read_message(self.transport, message))
+
+    def negotiate(self, message):
+        # only called with hellos whose signature was verified, see Node.negotiate_wire
+        if message.get('type') == 'client_hello':
+            self.remote_wire = message['payload'].get('wire')
+        elif message.get('type') == 'server_hello' and message['payload'].get('wire') in wire.WIRE_VERSIONS:
+            # the server answered with the encoding it picked from our list
+            self.wire = message['payload']['wire']
+            logger.debug(f"Sending {self.wire} messages to {self.peername}")
+
+    def encode(self, message):
+        if self.wire != wire.WIRE_JSON:
+            try:
+                msg = json.loads(message) if isinstance(message, str) else message
+                return wire.encode_message(msg, compress=(self.wire == wire.WIRE_BINARY_ZLIB))
+            except (wire.WireError, KeyError, ValueError) as e:
+                logger.debug(f"Sending JSON, message can't be encoded: {e}")
+        if not isinstance(message, str):
+            message = json.dumps(message)
+        return message.encode() + b'\n'
 
     def connection_lost(self, exc: Exception | None) -> None:
         self.transport.close()
@@ -71,10 +183,8 @@ class Node:
         self.client_list = {}
         self.server_limit = 3
         self.loop = loop
-        self.orderbook = {
-            'sat2kas': {},
-            'kas2sat': {}
-        }
+        # price levels, updated when a server payload changes or a server goes away
+        self.orderbook = OrderBook()
         self.swapnode = swapnode
         self.endpoint = None
         self.short_pubkey = f"{self.swapnode.node_pubkey.hex()[:4]}..{self.swapnode.node_pubkey.hex()[-4:]}"
@@ -100,7 +210,7 @@ class Node:
                     peer = v['transport'] if v and v['transport'] else None
                     if peer:
                         peer.close()
-                    del self.server_list[k]
+                    self.remove_server(k)
             # await self.render_orderbook()
             if not infinite_loop:
                 break
@@ -119,8 +229,15 @@ class Node:
     #         self.connected_peers[peername] = transport
 
     async def read_message(self, *args, **kwargs):
+        # subclasses call negotiate_wire once the signature of the message is verified
         raise NotImplementedError(f"read_message must be defined in subclass")
 
+    def negotiate_wire(self, transport, message):
+        # the encoding offered or picked in a verified hello, an unsigned one can't switch the connection codec
+        connection = self.connection_of(transport)
+        if connection is not None and isinstance(message.get('payload'), dict):
+            connection.negotiate(message)
+
     async def send_message(self, *args, **kwargs):
         raise NotImplementedError(f"send_message must be defined in subclass")
 
@@ -174,19 +291,37 @@ class Node:
         if to_remove:
             key, transport = to_remove[0]
             if key in self.server_list.keys():
-                del self.server_list[key]
+                self.remove_server(key)
             if key in self.client_list.keys():
                 del self.client_list[key]
             logger.debug(f"[{self.short_pubkey}] Removed peer {key}")
 
+    @staticmethod
+    def connection_of(transport):
+        protocol = transport.get_protocol() if hasattr(transport, 'get_protocol') else None
+        return protocol if isinstance(protocol, NodeConnection) else None
+
+    def encode_message(self, transport, message):
+        # bytes to write for message (str or dict), in the encoding negotiated on this connection
+        connection = self.connection_of(transport)
+        if connection is None:
+            return (message if isinstance(message, str) else json.dumps(message)).encode() + b'\n'
+        return connection.encode(message)
+
     async def send_hello(self, transport):
+        connection = self.connection_of(transport)
+        selected_wire = None
         if self.__class__.__name__ == 'MakerNode':
             msg_type = 'server_hello'
             # this is probably bad codind, but I don't care, MakerNode subclass has the ping_message attribute
             payload = json.loads(self.ping_message)['payload']
+            if connection is not None and connection.remote_wire:
+                selected_wire = wire.negotiate(connection.remote_wire)
+                payload['wire'] = selected_wire
         elif self.__class__.__name__ == 'TakerNode':
             msg_type = 'client_hello'
-            payload = {}
+            # encodings we accept, the server picks one in its server_hello
+            payload = {'wire': list(wire.WIRE_VERSIONS)}
         else:
             raise NotImplementedError('Wrong class type')
 
@@ -199,6 +334,8 @@ class Node:
             'signature': signature.hex()
         })
         res = await self.send_message(transport, msg)
+        if selected_wire is not None:
+            connection.wire = selected_wire
 
     async def bootstrap_nodes(self):
         seed_nodes = os.getenv('P2P_SEED_NODES', None)
@@ -227,90 +364,59 @@ class Node:
                 # maker is not accepting p2p connections
                 continue
             host, port = p2p_endpoint.split(':')
-            self.server_list[k] = None
+            self.set_server(k, None)
             res = await self.connect_to_peer(host, int(port))
             if not res:
-                del self.server_list[k]
+                self.remove_server(k)
                 continue
             connected_servers[k] = self.server_list[k]
             logger.debug(f"[{self.short_pubkey}] - Connected to server: {k}")
 
+    def set_server(self, key, server):
+        # every server_list change goes through here, to keep the orderbook index in sync
+        self.server_list[key] = server
+        if server and server.get('payload') is not None:
+            self.orderbook.update_maker(key, server)
+        else:
+            self.orderbook.remove_maker(key)
+
+    def remove_server(self, key):
+        self.server_list.pop(key, None)
+        self.orderbook.remove_maker(key)
+
     async def update_orderbook(self, selected_amount=0):
-        # clear orderbook
-        self.orderbook = {
-            'sat2kas': {},
-            'kas2sat': {}
-        }
-        for key, server in self.server_list.items():
-            if server is None:
-                continue
-            if server['payload']['sat2kas']:
-                for ask in server['payload']['sat2kas']:
-                    if not selected_amount or ask['min_amount'] <= selected_amount <= ask['max_amount']:
-                        if not ask['price'] in self.orderbook['sat2kas'].keys():
-                            self.orderbook['sat2kas'][ask['price']] = []
-                        if server not in self.orderbook['sat2kas'][ask['price']]:
-                            self.orderbook['sat2kas'][ask['price']].append(server)
-                        else:
-                            s_index = self.orderbook['sat2kas'][ask['price']].index(server)
-                            self.orderbook['sat2kas'][ask['price']][s_index] = server
-            if server['payload']['kas2sat']:
-                for bid in server['payload']['kas2sat']:
-                    if not selected_amount or bid['min_amount'] <= selected_amount <= bid['max_amount']:
-                        if not bid['price'] in self.orderbook['kas2sat'].keys():
-                            self.orderbook['kas2sat'][bid['price']] = []
-                        if server not in self.orderbook['kas2sat'][bid['price']]:
-                            self.orderbook['kas2sat'][bid['price']].append(server)
-                        else:
-                            s_index = self.orderbook['kas2sat'][bid['price']].index(server)
-                            self.orderbook['kas2sat'][bid['price']][s_index] = server
-
-        # add our offers for maker nodes:
+        # the index is updated as payloads arrive, only our own offers are added here for maker nodes
         if self.__class__.__name__ == 'MakerNode':
             payload = json.loads(self.ping_message)['payload']
-            # sat2kas
-            for offer in payload['sat2kas']:
-                if offer['price'] not in self.orderbook['sat2kas']:
-                    self.orderbook['sat2kas'][offer['price']] = []
-                ask_payload = {'payload': payload}
-                self.orderbook['sat2kas'][offer['price']].append(ask_payload)
-            for offer in payload['kas2sat']:
-                if offer['price'] not in self.orderbook['kas2sat']:
-                    self.orderbook['kas2sat'][offer['price']] = []
-                bid_payload = {'payload': payload}
-                self.orderbook['kas2sat'][offer['price']].append(bid_payload)
+            self.orderbook.update_maker(self.swapnode.node_pubkey.hex(), {'payload': payload})
 
-    async def render_orderbook(self, selected_amount=0, return_bidask=False):
+    def fill_plan(self, side, amount, max_legs=None):
+        # cheapest split of amount KAS across the makers in the book, without asking them for quotes
+        return fill_plan(self.orderbook, side, amount, max_legs)
+
+    def spare_legs(self, plan):
+        return spare_legs(self.orderbook, plan)
+
+    async def orderbook_snapshot(self, selected_amount=0):
+        # numeric price levels per side, best first, see OrderBook.snapshot
         await self.update_orderbook(selected_amount=selected_amount)
-        # ask
-        asks = {}
-        bids = {}
-        for ask, servers in self.orderbook['sat2kas'].items():
-            ask_servers = list(itertools.chain(*[s['payload']['sat2kas'] for s in servers]))
-            min_amount = min([offer['min_amount'] for offer in ask_servers if offer['price'] == ask])
-            all_max = [offer['max_amount'] for offer in ask_servers if offer['price'] == ask]
-            max_amount = max(all_max)
-            full_amount = sum(all_max)
-            asks[ask] = f"{full_amount:>7d} ({min_amount}-{max_amount})"
-        for bid, servers in self.orderbook['kas2sat'].items():
-            bid_servers = list(itertools.chain(*[s['payload']['kas2sat'] for s in servers]))
-            min_amount = min([offer['min_amount'] for offer in bid_servers if offer['price'] == bid])
-            all_max = [offer['max_amount'] for offer in bid_servers if offer['price'] == bid]
-            max_amount = max(all_max)
-            full_amount = sum(all_max)
-            bids[bid] = f"{full_amount:>7d} ({min_amount}-{max_amount})"
-
-        # bids = dict(sorted(bids, reverse=True))
-        # asks = dict(sorted(asks))
+        return self.orderbook.snapshot(selected_amount)
+
+    @staticmethod
+    def format_level(level):
+        return f"{level.price:>6d} {f'{level.total:>7d} ({level.min_amount}-{level.max_amount})':<18s}"
+
+    async def render_orderbook(self, selected_amount=0, return_bidask=False):
+        snapshot = await self.orderbook_snapshot(selected_amount)
 
         bid_res = []
         ask_res = []
 
         output = f"{'BID':^25s} | {'ASK':^25s}\n"
         output += f" {'price'}  {'amount (min-max)':^17s} |  {'price'}  {'amount (min-max)':^17s}\n"
-        for bid, ask in zip(sorted(bids, reverse=True), sorted(asks)):
-            bid_str = f"{bid:>6d} {bids[bid]:<18s}"
-            ask_str = f"{ask:>6d} {asks[ask]:<18s}"
+        for bid, ask in zip(snapshot['kas2sat'], snapshot['sat2kas']):
+            bid_str = self.format_level(bid)
+            ask_str = self.format_level(ask)
             if return_bidask:
                 bid_res.append(bid_str)
                 ask_res.append(ask_str)
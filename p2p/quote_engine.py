@@ -0,0 +1,114 @@
+import heapq
+import logging
+
+from dataclasses import dataclass, field
+
+logger = logging.getLogger('quote_engine')
+
+
+@dataclass
+class FillLeg:
+    maker_id: str
+    endpoint: str
+    price: int
+    amount: int
+    min_amount: int
+    max_amount: int
+
+
+@dataclass
+class FillPlan:
+    side: str
+    amount: int
+    legs: list = field(default_factory=list)
+
+    @property
+    def filled(self):
+        return sum(leg.amount for leg in self.legs)
+
+    @property
+    def complete(self):
+        return self.filled == self.amount
+
+    @property
+    def vwap(self):
+        # volume weighted price of the plan, 0 for an empty plan
+        filled = self.filled
+        return sum(leg.price * leg.amount for leg in self.legs) / filled if filled else 0
+
+    @property
+    def makers(self):
+        return list(dict.fromkeys(leg.maker_id for leg in self.legs))
+
+
+def offers_heap(orderbook, side):
+    # lazy best-first stream of offers: the heap holds one entry per price level,
+    # a level is expanded only when the fill reaches it, so a fill only touches the levels it consumes
+    sign = -1 if side == 'kas2sat' else 1
+    heap = [(sign * price, price) for price in orderbook.prices[side]]
+    heapq.heapify(heap)
+    while heap:
+        _, price = heapq.heappop(heap)
+        # bigger offers first at the same price, fewer legs
+        level = sorted(((maker_id, offer) for maker_id, offers in orderbook.levels[side][price].items()
+                        for offer in offers), key=lambda x: -x[1]['max_amount'])
+        yield from level
+
+
+def fill_plan(orderbook, side, amount, max_legs=None):
+    # Cheapest way to fill amount KAS on side, walking the offers best price first.
+    # Every leg respects the maker min/max, when the remainder is below the next offer minimum it is
+    # made up by taking the minimum there and moving the difference away from earlier legs with room to spare.
+    plan = FillPlan(side=side, amount=amount)
+    remaining = amount
+    for maker_id, offer in offers_heap(orderbook, side):
+        if remaining <= 0 or (max_legs is not None and len(plan.legs) >= max_legs):
+            break
+        min_amount, max_amount = offer['min_amount'], offer['max_amount']
+        leg_amount = min(remaining, max_amount)
+        if leg_amount < min_amount:
+            missing = min_amount - leg_amount
+            spare = sum(leg.amount - leg.min_amount for leg in plan.legs)
+            if spare < missing:
+                continue
+            # shrink the worst legs first, they are the last ones
+            for leg in reversed(plan.legs):
+                take = min(leg.amount - leg.min_amount, missing)
+                leg.amount -= take
+                missing -= take
+                if not missing:
+                    break
+            leg_amount = min_amount
+            remaining = min_amount
+        server = orderbook.servers.get(maker_id) or {}
+        plan.legs.append(FillLeg(
+            maker_id=maker_id,
+            endpoint=(server.get('payload') or {}).get('onion'),
+            price=offer['price'],
+            amount=leg_amount,
+            min_amount=min_amount,
+            max_amount=max_amount
+        ))
+        remaining -= leg_amount
+    if not plan.complete:
+        logger.debug(f"Orderbook can fill {plan.filled} of {amount} KAS on {side}")
+    return plan
+
+
+def spare_legs(orderbook, plan):
+    # offers left out of plan, best first, to re-route the legs that fail (amount is set when used)
+    used = {(leg.maker_id, leg.price) for leg in plan.legs}
+    spare = []
+    for maker_id, offer in offers_heap(orderbook, plan.side):
+        if (maker_id, offer['price']) in used:
+            continue
+        server = orderbook.servers.get(maker_id) or {}
+        spare.append(FillLeg(
+            maker_id=maker_id,
+            endpoint=(server.get('payload') or {}).get('onion'),
+            price=offer['price'],
+            amount=0,
+            min_amount=offer['min_amount'],
+            max_amount=offer['max_amount']
+        ))
+    return spare
@@ -1,5 +1,4 @@
 
-import json
 import time
 import logging
 
@@ -18,24 +17,24 @@ class TakerNode(Node):
         super().__init__(*args, **kwargs)
         # self.loop.create_task(self.connect_to_peer2('localhost', 48888))
 
-    async def read_message(self, transport, line):
-        if not line:
+    async def read_message(self, transport, message):
+        # message is already parsed by NodeConnection
+        if not isinstance(message, dict):
             return False
         try:
-            data = json.loads(line)
+            data = message
             short_pubkey = f"{data['pubkey'][:3]}...{data['pubkey'][-3:]}"
             logger.debug(f"[{self.short_pubkey}] TakerNode.read_message: "
                          f"{data['type']}, {data['payload']}, {short_pubkey}")
 
             remote_pubkey = data['pubkey']
 
-            if not self.swapnode.verify_signature(data):
+            if not await self.swapnode.async_verify_signature(data):
                 return False
+            self.negotiate_wire(transport, data)
 
             await self.handle_incoming_message(data, remote_pubkey, transport)
 
-        except json.JSONDecodeError:
-            return False
         except Exception as e:
             logger.error(e)
             return False
@@ -44,25 +43,13 @@ class TakerNode(Node):
         if data['type'] == 'client_hello':
             pass
         elif data['type'] == 'server_hello':
-            if remote_pubkey not in self.server_list.keys():
-                self.server_list[remote_pubkey] = {
-                    'transport': peer,
-                    'last_ping': 0,
-                    'payload': data['payload']
-                }
-            elif self.server_list[remote_pubkey] is None:
-                self.server_list[remote_pubkey] = {
-                    'transport': peer,
-                    'last_ping': 0,
-                    'payload': data['payload']
-                }
-
-            elif self.server_list[remote_pubkey]['transport'] is None:
-                self.server_list[remote_pubkey] = {
+            server = self.server_list.get(remote_pubkey)
+            if server is None or server['transport'] is None:
+                self.set_server(remote_pubkey, {
                     'transport': peer,
                     'last_ping': 0,
                     'payload': data['payload']
-                }
+                })
 
             del self.connected_peers[peer]
             self.connected_peers[remote_pubkey] = peer
@@ -72,17 +59,19 @@ class TakerNode(Node):
             if remote_pubkey not in self.server_list.keys():
                 if remote_pubkey == self.swapnode.node_pubkey:
                     return
-                self.server_list[remote_pubkey] = {
+                self.set_server(remote_pubkey, {
                     'transport': None,
                     'last_ping': int(time.time()),
                     'payload': data['payload']
-                }
+                })
             else:
-                self.server_list[remote_pubkey]['payload'] = data['payload']
-                self.server_list[remote_pubkey]['last_ping'] = int(time.time())
+                server = self.server_list[remote_pubkey] or {'transport': None}
+                server['payload'] = data['payload']
+                server['last_ping'] = int(time.time())
+                self.set_server(remote_pubkey, server)
 
     async def send_message(self, transport, message):
         try:
-            transport.write(message.encode())
+            transport.write(self.encode_message(transport, message))
         except Exception as e:
             logger.error(e)
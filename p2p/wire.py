@@ -0,0 +1,202 @@
+import zlib
+import struct
+import logging
+
+logger = logging.getLogger('wire')
+
+# Binary p2p encoding, negotiated in the hello messages (payload key 'wire'), JSON lines stay the default.
+# frame: MAGIC | flags | varint body length | body
+# body:  varint type code (0 then the type string for unknown types) | pubkey | signature | payload value
+# keys and signatures travel as raw bytes with a 1 byte length, the payload is a tagged value tree
+# with varint integers, so it decodes to the same JSON payload the signature was made on.
+MAGIC = 0xB1
+FLAG_ZLIB = 0x01
+# bodies smaller than this are sent uncompressed even when compression was negotiated
+COMPRESS_MIN_SIZE = 256
+# a 64 bit integer takes 10 varint bytes, a longer varint is malformed
+MAX_VARINT_BYTES = 10
+
+WIRE_JSON = 'json'
+WIRE_BINARY = 'bin1'
+WIRE_BINARY_ZLIB = 'bin1-zlib'
+# preference order
+WIRE_VERSIONS = (WIRE_BINARY_ZLIB, WIRE_BINARY, WIRE_JSON)
+
+MSG_TYPES = ('client_hello', 'server_hello', 'server_ping')
+MSG_TYPE_CODES = {msg_type: code for code, msg_type in enumerate(MSG_TYPES, start=1)}
+
+T_NONE, T_FALSE, T_TRUE, T_UINT, T_NINT, T_FLOAT, T_STR, T_LIST, T_DICT = range(9)
+DOUBLE = struct.Struct('>d')
+
+
+class WireError(Exception):
+    pass
+
+
+class WireTruncated(WireError):
+    # more bytes are needed, the data is not malformed (yet)
+    pass
+
+
+def negotiate(offered):
+    # best version supported by both sides
+    for version in WIRE_VERSIONS:
+        if version in (offered or ()):
+            return version
+    return WIRE_JSON
+
+
+def write_varint(out, n):
+    if n >> (7 * MAX_VARINT_BYTES):
+        raise WireError('Integer too big for a varint')
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def read_varint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        if shift >= 7 * MAX_VARINT_BYTES:
+            raise WireError('Varint too long')
+        if pos >= len(data):
+            raise WireTruncated('Truncated varint')
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def write_value(out, value):
+    if value is None:
+        out.append(T_NONE)
+    elif value is True:
+        out.append(T_TRUE)
+    elif value is False:
+        out.append(T_FALSE)
+    elif isinstance(value, int):
+        out.append(T_UINT if value >= 0 else T_NINT)
+        write_varint(out, value if value >= 0 else -value)
+    elif isinstance(value, float):
+        out.append(T_FLOAT)
+        out += DOUBLE.pack(value)
+    elif isinstance(value, str):
+        raw = value.encode()
+        out.append(T_STR)
+        write_varint(out, len(raw))
+        out += raw
+    elif isinstance(value, (list, tuple)):
+        out.append(T_LIST)
+        write_varint(out, len(value))
+        for item in value:
+            write_value(out, item)
+    elif isinstance(value, dict):
+        out.append(T_DICT)
+        write_varint(out, len(value))
+        for key, item in value.items():
+            if not isinstance(key, str):
+                raise WireError(f"Unsupported key type {type(key).__name__}")
+            write_value(out, key)
+            write_value(out, item)
+    else:
+        raise WireError(f"Unsupported value type {type(value).__name__}")
+
+
+def read_value(data, pos):
+    if pos >= len(data):
+        raise WireError('Truncated value')
+    tag = data[pos]
+    pos += 1
+    if tag == T_NONE:
+        return None, pos
+    if tag == T_TRUE:
+        return True, pos
+    if tag == T_FALSE:
+        return False, pos
+    if tag in (T_UINT, T_NINT):
+        n, pos = read_varint(data, pos)
+        return (n if tag == T_UINT else -n), pos
+    if tag == T_FLOAT:
+        if pos + 8 > len(data):
+            raise WireError('Truncated float')
+        return DOUBLE.unpack_from(data, pos)[0], pos + 8
+    if tag == T_STR:
+        size, pos = read_varint(data, pos)
+        if pos + size > len(data):
+            raise WireError('Truncated string')
+        return bytes(data[pos:pos + size]).decode(), pos + size
+    if tag == T_LIST:
+        size, pos = read_varint(data, pos)
+        items = []
+        for _ in range(size):
+            item, pos = read_value(data, pos)
+            items.append(item)
+        return items, pos
+    if tag == T_DICT:
+        size, pos = read_varint(data, pos)
+        items = {}
+        for _ in range(size):
+            key, pos = read_value(data, pos)
+            items[key], pos = read_value(data, pos)
+        return items, pos
+    raise WireError(f"Unknown value tag {tag}")
+
+
+def write_bytes(out, raw):
+    if len(raw) > 255:
+        raise WireError('Key or signature too long')
+    out.append(len(raw))
+    out += raw
+
+
+def read_bytes(data, pos):
+    if pos >= len(data) or pos + 1 + data[pos] > len(data):
+        raise WireError('Truncated bytes')
+    size = data[pos]
+    return bytes(data[pos + 1:pos + 1 + size]), pos + 1 + size
+
+
+def encode_message(msg, compress=False):
+    body = bytearray()
+    code = MSG_TYPE_CODES.get(msg['type'], 0)
+    write_varint(body, code)
+    if not code:
+        write_value(body, msg['type'])
+    write_bytes(body, bytes.fromhex(msg['pubkey']))
+    write_bytes(body, bytes.fromhex(msg['signature']))
+    write_value(body, msg['payload'])
+    flags = 0
+    if compress and len(body) >= COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(body)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= FLAG_ZLIB
+    frame = bytearray((MAGIC, flags))
+    write_varint(frame, len(body))
+    frame += body
+    return bytes(frame)
+
+
+def decode_body(flags, body, max_size):
+    if flags & FLAG_ZLIB:
+        decompressor = zlib.decompressobj()
+        body = decompressor.decompress(body, max_size)
+        if decompressor.unconsumed_tail:
+            raise WireError(f"Frame bigger than {max_size} bytes once decompressed")
+    code, pos = read_varint(body, 0)
+    if code:
+        if code > len(MSG_TYPES):
+            raise WireError(f"Unknown message type {code}")
+        msg_type = MSG_TYPES[code - 1]
+    else:
+        msg_type, pos = read_value(body, pos)
+    pubkey, pos = read_bytes(body, pos)
+    signature, pos = read_bytes(body, pos)
+    payload, pos = read_value(body, pos)
+    if pos != len(body):
+        raise WireError('Trailing bytes after message')
+    return {'type': msg_type, 'payload': payload, 'pubkey': pubkey.hex(), 'signature': signature.hex()}
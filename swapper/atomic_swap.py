@@ -15,9 +15,11 @@ from klib.scripting import (build_contract_script, build_spend_script,
                             build_contract_script_short, build_spend_script_short)
 from klib.kdatatype import (Transaction, Input, Output,
                             OutPoint, UtxoEntry, ScriptPublicKey,
-                            SighashReusedValues, SigHashType)
-from klib.ksign import raw_tx_in_signature
-from klib.serialization import gen_rpc_transaction
+                            SigHashType)
+from klib.ksign import sign_inputs
+from klib.serialization import gen_rpc_transaction_dict, transaction_id
+from klib.krpc import KaspaRpcError, get_rpc_client, run_sync
+from .contract_watcher import get_contract_watcher
 
 # load_dotenv()
 
@@ -27,8 +29,10 @@ logging.getLogger('peewee').setLevel(logging.WARNING)
 logging.getLogger('asyncio').setLevel(logging.WARNING)
 logging.getLogger('aiohttp').setLevel(logging.WARNING)
 
+# kaspad rejections of a transaction it already has, e.g. resubmitted after a lost reply
+ALREADY_KNOWN_TX_ERRORS = ('already in the mempool', 'already accepted by the consensus')
+
 
-# ToDo: switch some methods to async
 # ToDo: move some methods to utils, keep the code cleaner
 class AtomicSwap:
     def __init__(self, *args, **kwargs):
@@ -71,20 +75,21 @@ class AtomicSwap:
         out, err = process.communicate()
         return out, err
 
-    def decode_ln_invoice(self, invoice=None):
-        if invoice is None:
-            invoice = self.invoice
-        lncli = os.getenv('LNCLI', None)
-        if not invoice.isalnum():
-            return False
-        if not lncli:
-            return self.internal_ln_decode()
+    @staticmethod
+    async def async_run_cmd(cmd):
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = await proc.communicate()
+        return out, err
+
+    @staticmethod
+    def lncli_decode_cmd(lncli, invoice):
         cmd = f"{lncli}"
         if ln_rpc_server := os.getenv('LN_RPC_SERVER', ''):
             cmd += f" --rpcserver {ln_rpc_server}"
         cmd += f" decodepayreq {invoice}"
-        cmd = cmd.split()
-        out, err = self.run_cmd(cmd, shell=False)
+        return cmd.split()
+
+    def load_decoded_invoice(self, out, err):
         if out:
             try:
                 out = json.loads(out.decode())
@@ -99,6 +104,28 @@ class AtomicSwap:
         self.secret_hash = bytes.fromhex(out['payment_hash'])
         return out
 
+    def decode_ln_invoice(self, invoice=None):
+        if invoice is None:
+            invoice = self.invoice
+        lncli = os.getenv('LNCLI', None)
+        if not invoice.isalnum():
+            return False
+        if not lncli:
+            return self.internal_ln_decode()
+        out, err = self.run_cmd(self.lncli_decode_cmd(lncli, invoice), shell=False)
+        return self.load_decoded_invoice(out, err)
+
+    async def async_decode_ln_invoice(self, invoice=None):
+        if invoice is None:
+            invoice = self.invoice
+        lncli = os.getenv('LNCLI', None)
+        if not invoice.isalnum():
+            return False
+        if not lncli:
+            return self.internal_ln_decode()
+        out, err = await self.async_run_cmd(self.lncli_decode_cmd(lncli, invoice))
+        return self.load_decoded_invoice(out, err)
+
     def internal_ln_decode(self):
         logger.debug('Using internal ln decoder')
         # if 'lightning-payencode-master' not in sys.path:
@@ -113,42 +140,40 @@ class AtomicSwap:
         self.timelock = (int(date) + (int(expiry))) * 1000
         self.secret_hash = bytes.fromhex(secret_hash)
 
-    def get_utxos_by_address(self, address):
-        kaspactl = os.getenv('KASPACTL', 'kaspactl')
-        cmd = f"{kaspactl} -a -s {self.kas_rpc_server} GetUtxosByAddresses '{address}'"
-        out, err = self.run_cmd(cmd, shell=True)
-        # logger.debug(out.decode(), err.decode())
-        if err:
-            logger.error(err.decode())
-        if out:
-            out = json.loads(out.decode())
-            res = out['getUtxosByAddressesResponse']['entries']
-        else:
+    @property
+    def rpc(self):
+        return get_rpc_client(self.kas_rpc_server)
+
+    async def get_utxos_by_address(self, address):
+        try:
+            res = await self.rpc.get_utxos_by_addresses([address])
+        except KaspaRpcError as e:
+            logger.error(e)
             res = []
         return res
 
-    def broadcast_transaction(self, rpc_transaction):
-        kaspactl = os.getenv('KASPACTL', 'kaspactl')
-        cmd = f"{kaspactl} -a -s {self.kas_rpc_server} SubmitTransaction '{rpc_transaction}' false"
-        out, err = self.run_cmd(cmd, shell=True)
-        try:
-            out = json.loads(out.decode())
-            if not out['submitTransactionResponse']['error']:
-                res = out['submitTransactionResponse']['transactionId']
-            else:
+    async def broadcast_transaction(self, rpc_transaction, retries=None, retry_delay=3, tx_id=None):
+        # retries=None keeps retrying until the sequence lock is met
+        # tx_id: locally computed txid, a rebroadcast of a transaction kaspad already knows returns it
+        attempt = 0
+        while True:
+            try:
+                submitted_tx_id = await self.rpc.submit_transaction(rpc_transaction)
+                if tx_id and submitted_tx_id != tx_id:
+                    logger.warning(f"kaspad returned txid {submitted_tx_id}, computed {tx_id}")
+                return submitted_tx_id
+            except KaspaRpcError as e:
+                if tx_id and any(known in str(e) for known in ALREADY_KNOWN_TX_ERRORS):
+                    logger.info(f"Transaction {tx_id} already broadcast")
+                    return tx_id
                 # ToDo: handle as many errors as possible here
-                logger.error('HEY!!!')
-                logger.error(out['submitTransactionResponse']['error'])
+                logger.error(e)
                 weird_error = 'one of the transaction sequence locks conditions was not met'
-                if weird_error in out['submitTransactionResponse']['error']['message']:
-                    logger.warning("Retrying broadcast in 3 seconds")
-                    time.sleep(3)
-                    return self.broadcast_transaction(rpc_transaction)
-                res = False
-        except json.JSONDecodeError:
-            logger.error(err.decode())
-            res = False
-        return res
+                if weird_error not in str(e) or (retries is not None and attempt >= retries):
+                    return False
+            attempt += 1
+            logger.warning(f"Retrying broadcast in {retry_delay} seconds")
+            await asyncio.sleep(retry_delay)
 
     def gen_contract_address(self):
         self.contract_script = build_contract_script(
@@ -170,57 +195,81 @@ class AtomicSwap:
         self.contract_address = p2sh_address_from_script(self.contract_script)
         logger.info(f"Short contract P2SH address: {self.contract_address}")
 
+    def utxos_total(self):
+        return sum([int(utxo['utxoEntry']['amount']) for utxo in self.utxos]) / 1e8
+
+    @property
+    def watcher(self):
+        return get_contract_watcher(self.kas_rpc_server)
+
+    def watch_contract(self, address=None):
+        # keep address registered on the shared watcher for the whole block
+        if address is None:
+            address = self.contract_address
+        return self.watcher.watch(address)
+
+    def contract_utxos_known(self, address=None):
+        # False while the watcher couldn't fetch the utxo set, self.utxos is then the last known one
+        return self.watcher.get_utxos(address or self.contract_address) is not None
+
+    async def wait_utxo_change(self, address=None, timeout=1):
+        # address must be registered on the watcher, see watch_contract
+        if address is None:
+            address = self.contract_address
+        changed = await self.watcher.wait_change(address, timeout)
+        utxos = self.watcher.get_utxos(address)
+        if utxos is None:
+            return False
+        self.utxos = utxos
+        return changed
+
+    async def await_funding(self, address, min_amount=0, timeout=True):
+        amount_notified = 0
+        while True:
+            await self.wait_utxo_change(address)
+            if self.utxos:
+                total = self.utxos_total()
+                if total >= min_amount:
+                    return True
+                elif total > amount_notified:
+                    logger.debug(f"utxo detected, but amount is too low ({total} / {min_amount} KAS)")
+                    amount_notified = total
+            if timeout and self.timelock < time.time() * 1e3:
+                logger.info('Invoice expired, leaving')
+                return False
+
     def check_utxo(self, address=None, min_amount=0, timeout=True):
-        # Check if address has any utxo
+        # blocking version for scripts, always waits for funding
         if address is None:
             address = self.contract_address
-        self.utxos = self.get_utxos_by_address(address)
-        if not self.utxos:
-            amount_notified = 0
-            logger.info(f"Address {address} has no utxo, awaiting funding...")
-            while True:
-                time.sleep(1)
-                self.utxos = self.get_utxos_by_address(address)
-                if self.utxos:
-                    total = sum([int(utxo['utxoEntry']['amount']) for utxo in self.utxos]) / 1e8
-                    if total >= min_amount:
-                        break
-                    elif total > amount_notified:
-                        logger.debug(f"utxo detected, but amount is too low ({total} / {min_amount} KAS)\r")
-                        amount_notified = total
-                if timeout and self.timelock < time.time() * 1e3:
-                    logger.info('\nInvoice expired, leaving')
-                    return False
-        total = sum([int(utxo['utxoEntry']['amount']) for utxo in self.utxos]) / 1e8
-        # logger.debug(f"Found {len(self.utxos)} UTXOs totaling {total} KAS")
-        return total
+
+        async def wait_utxo():
+            async with self.watch_contract(address):
+                self.utxos = self.watcher.get_utxos(address) or []
+                if not self.utxos:
+                    logger.info(f"Address {address} has no utxo, awaiting funding...")
+                    if not await self.await_funding(address, min_amount, timeout):
+                        return False
+            return self.utxos_total()
+
+        return run_sync(wait_utxo())
 
     async def async_check_utxo(self, address=None, min_amount=0, timeout=True):
         # Check if address has any utxo
         if address is None:
             address = self.contract_address
-        self.utxos = self.get_utxos_by_address(address)
-        if not self.utxos and timeout:
-            amount_notified = 0
-            logger.debug(f"Address {address} has no utxo, awaiting funding...")
-            while True:
-                await asyncio.sleep(1)
-                self.utxos = self.get_utxos_by_address(address)
-                if self.utxos:
-                    total = sum([int(utxo['utxoEntry']['amount']) for utxo in self.utxos]) / 1e8
-                    if total >= min_amount:
-                        break
-                    elif total > amount_notified:
-                        logger.debug(f"utxo detected, but amount is too low ({total} / {min_amount} KAS)")
-                        amount_notified = total
-                if timeout and self.timelock < time.time() * 1e3:
-                    logger.info('Invoice expired, leaving')
+        async with self.watch_contract(address):
+            # an unknown utxo set is not funded yet
+            self.utxos = self.watcher.get_utxos(address) or []
+            if not self.utxos and timeout:
+                logger.debug(f"Address {address} has no utxo, awaiting funding...")
+                if not await self.await_funding(address, min_amount, timeout):
                     return False
-        total = sum([int(utxo['utxoEntry']['amount']) for utxo in self.utxos]) / 1e8
+        total = self.utxos_total()
         # logger.debug(f"Found {len(self.utxos)} UTXOs totaling {total} KAS")
         return total
 
-    def spend_contract(self, secret=None, short_script=False):
+    def build_spend_transaction(self, secret=None, short_script=False):
         if secret is None:
             # refund path
             pubkey = self.sender_pubkey
@@ -265,26 +314,33 @@ class AtomicSwap:
         # Generate transaction
         timelock = 0 if secret else self.timelock
         self.transaction = Transaction(tx_inputs, tx_outputs, 0, timelock)
-        # Sign
-        for i, txIn in enumerate(self.transaction.inputs):
-            rv = SighashReusedValues()
-            hashtype = SigHashType(1)
-            signature = raw_tx_in_signature(self.transaction, i, hashtype, privkey, rv)
-            if short_script:
-                spend_builder = build_spend_script_short
-            else:
-                spend_builder = build_spend_script
+        # Sign, the sub-hashes shared by all the inputs are computed once, many UTXOs are signed in parallel
+        spend_builder = build_spend_script_short if short_script else build_spend_script
+
+        def spend_contract_script(idx, signature):
             if secret is None:
-                spend_contract_script = spend_builder(signature, pubkey, self.contract_script, refund=True)
-            else:
-                spend_contract_script = spend_builder(signature, pubkey, self.contract_script, secret=secret)
-            self.transaction.inputs[i].signature_script = spend_contract_script
-        # Print final tx and broadcast
-        rpc_tx = gen_rpc_transaction(self.transaction)
-        logger.debug(f"Finalized transaction, ready to broadcast:")
-        logger.debug(pformat(json.loads(rpc_tx)))
-        tx_id = self.broadcast_transaction(rpc_tx)
+                return spend_builder(signature, pubkey, self.contract_script, refund=True)
+            return spend_builder(signature, pubkey, self.contract_script, secret=secret)
+
+        keys = [(i, privkey) for i in range(len(self.transaction.inputs))]
+        scripts = sign_inputs(self.transaction, keys, SigHashType(1), script_builder=spend_contract_script)
+        for tx_input, script in zip(self.transaction.inputs, scripts):
+            tx_input.signature_script = script
+        # known before broadcast, to track the spend and recognize a rebroadcast
+        self.transaction.tx_id = transaction_id(self.transaction)
+        rpc_tx = gen_rpc_transaction_dict(self.transaction)
+        logger.debug(f"Finalized transaction {self.transaction.tx_id}, ready to broadcast:")
+        logger.debug(pformat(rpc_tx))
+        return rpc_tx
+
+    async def async_spend_contract(self, secret=None, short_script=False):
+        # signing (and the external signing prompt) runs in a thread, out of the event loop
+        rpc_tx = await asyncio.to_thread(self.build_spend_transaction, secret, short_script)
+        tx_id = await self.broadcast_transaction(rpc_tx, tx_id=self.transaction.tx_id)
         if tx_id:
             logger.debug(f"txid: {tx_id}")
         return tx_id
 
+    def spend_contract(self, secret=None, short_script=False):
+        # blocking version for scripts
+        return run_sync(self.async_spend_contract(secret, short_script))
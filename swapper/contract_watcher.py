@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import contextlib
+
+from klib.krpc import KaspaRpcError, get_rpc_client
+
+logger = logging.getLogger('contract_watcher')
+
+
+def outpoint_key(utxo):
+    return utxo['outpoint']['transactionId'], int(utxo['outpoint'].get('index', 0))
+
+
+class ContractWatcher:
+    # Process-wide watcher for the contract addresses of every active swap.
+    # All watched addresses are fetched with a single GetUtxosByAddresses per tick, utxo notifications
+    # update the cache in between, swaps await wait_change() instead of polling kaspad themselves.
+    # Registrations are reference counted: an address stays watched, with its cache and subscription,
+    # until every holder released it. Until a fetch succeeds its utxo set is unknown, not empty.
+    def __init__(self, client, poll_interval=1, resync_interval=10):
+        self.client = client
+        self.poll_interval = poll_interval
+        self.resync_interval = resync_interval
+        self.utxos = {}
+        self.registrations = {}
+        self.subscriptions = {}
+        self.waiters = {}
+        self.task = None
+        # refreshes started by poke, referenced until done so they aren't garbage collected
+        self.pokes = set()
+
+    @contextlib.asynccontextmanager
+    async def watch(self, address):
+        await self.register(address)
+        try:
+            yield self
+        finally:
+            await self.unregister(address)
+
+    async def register(self, address):
+        self.registrations[address] = self.registrations.get(address, 0) + 1
+        if self.registrations[address] > 1:
+            return
+        logger.debug(f"Watching {address}")
+        subscription = self.client.utxo_subscription([address], self.on_utxos_changed)
+        self.subscriptions[address] = subscription
+        await subscription.start()
+        # first snapshot, the subscription is already active so nothing is missed
+        await self.refresh([address])
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def unregister(self, address):
+        self.registrations[address] -= 1
+        if self.registrations[address] > 0:
+            return
+        del self.registrations[address]
+        self.utxos.pop(address, None)
+        self.wake(address)
+        subscription = self.subscriptions.pop(address, None)
+        if subscription is not None:
+            await subscription.stop()
+        if not self.registrations and self.task is not None:
+            self.task.cancel()
+            self.task = None
+        logger.debug(f"Stopped watching {address}")
+
+    def poke(self, address):
+        # refresh address now, e.g. when the counterparty says it sent a transaction
+        if address in self.registrations:
+            task = asyncio.create_task(self.refresh([address]))
+            self.pokes.add(task)
+            task.add_done_callback(self.pokes.discard)
+
+    def get_utxos(self, address):
+        # None while the utxo set is unknown (not fetched yet, kaspad unreachable), [] when address has no utxo
+        utxos = self.utxos.get(address)
+        if utxos is None:
+            return None
+        return list(utxos.values())
+
+    async def wait_change(self, address, timeout=None):
+        # True when the utxo set of address changed, False on timeout
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(address, set()).add(future)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiters.get(address, set()).discard(future)
+        return True
+
+    def wake(self, address):
+        for future in self.waiters.pop(address, set()):
+            if not future.done():
+                future.set_result(True)
+
+    async def run(self):
+        while self.registrations:
+            subscribed = all(subscription.active for subscription in self.subscriptions.values())
+            if subscribed and all(address in self.utxos for address in self.registrations):
+                await asyncio.sleep(self.resync_interval)
+            else:
+                await asyncio.sleep(self.poll_interval)
+            await self.refresh(list(self.registrations))
+
+    async def refresh(self, addresses):
+        try:
+            entries = await self.client.get_utxos_by_addresses(addresses)
+        except KaspaRpcError as e:
+            # keep the cached state, an rpc error must not look like a spent contract
+            logger.error(e)
+            return
+        fetched = {address: {} for address in addresses}
+        for entry in entries:
+            if entry['address'] in fetched:
+                fetched[entry['address']][outpoint_key(entry)] = entry
+        for address, utxos in fetched.items():
+            if address not in self.registrations:
+                continue
+            if self.utxos.get(address, {}).keys() != utxos.keys() or address not in self.utxos:
+                self.utxos[address] = utxos
+                self.wake(address)
+
+    def on_utxos_changed(self, address, added, removed):
+        if address not in self.registrations:
+            return
+        utxos = self.utxos.get(address)
+        if utxos is None:
+            # a change applied to an unknown set would look like the whole set, fetch it instead
+            self.poke(address)
+            return
+        for entry in removed:
+            utxos.pop(outpoint_key(entry), None)
+        for entry in added:
+            utxos[outpoint_key(entry)] = entry
+        self.wake(address)
+
+
+# one watcher per rpc client, so per kaspad server and event loop
+contract_watchers = {}
+
+
+def get_contract_watcher(server=None):
+    client = get_rpc_client(server)
+    watcher = contract_watchers.get(client.url)
+    if watcher is None or watcher.client is not client:
+        watcher = ContractWatcher(client)
+        contract_watchers[client.url] = watcher
+    return watcher
@@ -1,26 +1,104 @@
 
 import asyncio
 import os
+import time
 import json
 import hashlib
 import logging
+import threading
 from gc import collect as gc_collect
 
 from getpass import getpass
 from mnemonic import Mnemonic
+from bip32 import BIP32
 from bip44 import Wallet
 # from dotenv import load_dotenv
 
 from klib.kaddress import p2pk_address
 from klib.ksign import sign_hash, verify_signature
+from klib.kverify import async_verify_signature
+from .keypool import KeyPool, KEYPOOL_SIZE
 
 # load_dotenv()
 
 DERIVATION_PATH = "m/44'/111111'/0'/"
+ACCOUNT_PATH = DERIVATION_PATH.rstrip('/')
+# seconds without key usage before the wallet session locks itself
+WALLET_IDLE_TIMEOUT = 900
 logger = logging.getLogger('counterparty')
 # logging.basicConfig(level=logging.INFO)
 
 
+class WalletSession:
+    # Unlocked HD wallet: only the BIP44 account node is kept in memory, child keys are cached by index.
+    # The BIP39 seed stretching runs once per unlock instead of once per key.
+    def __init__(self, idle_timeout=WALLET_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.account = None
+        self.secret_keys = {}
+        self.public_keys = {}
+        self.last_used = 0
+        self.idle_handle = None
+
+    @property
+    def unlocked(self):
+        self.lock_if_idle()
+        return self.account is not None
+
+    def lock_if_idle(self):
+        if self.account is not None and self.idle_timeout and time.time() - self.last_used > self.idle_timeout:
+            self.lock()
+
+    def unlock(self, mnemonic, passphrase=''):
+        master = BIP32.from_seed(Mnemonic('english').to_seed(mnemonic, passphrase))
+        self.account = BIP32.from_xpriv(master.get_xpriv_from_path(ACCOUNT_PATH))
+        del master
+        self.touch()
+        logger.debug('Wallet session unlocked')
+
+    def lock(self):
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+            self.idle_handle = None
+        if self.account is None:
+            return
+        self.account = None
+        self.secret_keys.clear()
+        self.public_keys.clear()
+        gc_collect()
+        logger.debug('Wallet session locked')
+
+    def touch(self):
+        self.last_used = time.time()
+        if not self.idle_timeout:
+            return
+        # with a running loop, lock on time instead of waiting for the next key request
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+        self.idle_handle = loop.call_later(self.idle_timeout + 1, self.lock_if_idle)
+
+    def derive_secret_key(self, index):
+        if self.account is None:
+            raise Exception('Wallet session is locked')
+        self.touch()
+        if index not in self.secret_keys:
+            self.secret_keys[index] = self.account.get_privkey_from_path([index])
+        return self.secret_keys[index]
+
+    def derive_public_key(self, index):
+        # x-only public key
+        if self.account is None:
+            raise Exception('Wallet session is locked')
+        self.touch()
+        if index not in self.public_keys:
+            self.public_keys[index] = self.account.get_pubkey_from_path([index])[1:]
+        return self.public_keys[index]
+
+
 # ToDo: move methods to async
 class Counterparty:
     def __init__(
@@ -28,7 +106,9 @@ class Counterparty:
             wallet_db_table=None,
             keep_unlocked=False,
             wallet_index=1,
-            swap_endpoint=None
+            swap_endpoint=None,
+            idle_timeout=WALLET_IDLE_TIMEOUT,
+            keypool_size=KEYPOOL_SIZE
             ):
         self.swap_endpoint = swap_endpoint
         self.wallet_db_table = wallet_db_table
@@ -40,16 +120,20 @@ class Counterparty:
             self.init_wallet()
 
         self.passphrase = None
-        wallet = self.get_wallet(keep_unlocked)
-        self.node_privkey = wallet.derive_secret_key(f"{DERIVATION_PATH}0")
-        self.node_pubkey = wallet.derive_public_key(f"{DERIVATION_PATH}0")[1:]
-        self.pubkey = wallet.derive_public_key(f"{DERIVATION_PATH}{self.wallet.address_counter + 1}")[1:]
+        self.keep_unlocked = keep_unlocked
+        self.session = WalletSession(idle_timeout=idle_timeout)
+        # address_counter is saved from worker threads, it must only move forward
+        self.counter_lock = threading.RLock()
+        session = self.get_session()
+        self.node_privkey = session.derive_secret_key(0)
+        self.node_pubkey = session.derive_public_key(0)
+        self.pubkey = session.derive_public_key(self.wallet.address_counter + 1)
         self.address = p2pk_address(self.pubkey)
         # logger.info(f"address: {self.address}, db_address: {self.wallet.next_address}")
         assert self.wallet.next_address == self.address
-
-        del wallet
-        gc_collect()
+        self.keypool = KeyPool(self, size=keypool_size)
+        self.keypool.refill()
+        self.release_session()
 
     def init_wallet(self):
         logger.info('Wallet not initialized... Generating a new one!')
@@ -65,31 +149,50 @@ class Counterparty:
         del mn, passphrase
         gc_collect()
 
-    def get_wallet(self, keep_unlocked=False):
+    def get_passphrase(self):
         if self.wallet.is_encrypted:
             if self.passphrase is None:
                 passphrase = getpass("Wallet password: ").strip()
-                if keep_unlocked:
+                if self.keep_unlocked:
                     self.passphrase = passphrase
             else:
                 passphrase = self.passphrase
         else:
             passphrase = ''
-        return Wallet(self.wallet.mnemonic, passphrase=passphrase)
+        return passphrase
+
+    def get_session(self):
+        # unlock on demand, asking the password of encrypted wallets when it's not kept
+        if not self.session.unlocked:
+            self.session.unlock(self.wallet.mnemonic, self.get_passphrase())
+        return self.session
+
+    async def unlock_wallet(self):
+        # the first unlock runs the BIP39 seed stretching, keep it out of the event loop
+        if not self.session.unlocked:
+            await asyncio.to_thread(self.get_session)
+        return self.session
 
-    def get_next_pubkey(self, wallet=None, n_key=0):
-        if wallet is None:
-            wallet = self.get_wallet()
+    def release_session(self):
+        # wallets that are not kept unlocked ask the password again on the next key request
+        if not self.keep_unlocked:
+            self.session.lock()
+
+    def lock_wallet(self):
+        self.session.lock()
+        self.passphrase = None
+
+    def get_next_pubkey(self, n_key=0):
         if n_key:
             wanted_key = n_key
         else:
             wanted_key = self.wallet.address_counter + 1
-        pubkey = wallet.derive_public_key(f"{DERIVATION_PATH}{wanted_key}")[1:]
+        pubkey = self.get_session().derive_public_key(wanted_key)
         assert len(pubkey) == 32
         return pubkey
 
-    def get_next_address(self, wallet=None, n_key=0):
-        pubkey = self.get_next_pubkey(wallet, n_key)
+    def get_next_address(self, n_key=0):
+        pubkey = self.get_next_pubkey(n_key)
         return p2pk_address(pubkey)
 
     def get_secret_key(self, n_key=0):
@@ -98,23 +201,43 @@ class Counterparty:
         else:
             wanted_key = self.wallet.address_counter + 1
 
-        return self.get_wallet().derive_secret_key(f"{DERIVATION_PATH}{wanted_key}")
+        secret_key = self.get_session().derive_secret_key(wanted_key)
+        self.release_session()
+        return secret_key
 
-    def update_address_counter(self, new_counter=0, keep_unlocked=True):
-        wallet = self.get_wallet(keep_unlocked=True)
-        if new_counter:
-            self.wallet.address_counter = new_counter
-        else:
-            self.wallet.address_counter += 1
-        self.pubkey = self.get_next_pubkey(wallet)
-        self.address = p2pk_address(self.pubkey)
-        self.wallet.next_address = self.get_next_address(wallet)
-        assert self.wallet.next_address == self.address
-        self.wallet.save()
-        if not keep_unlocked:
-            self.passphrase = None
-        del wallet
-        gc_collect()
+    async def async_get_secret_key(self, n_key=0):
+        await self.unlock_wallet()
+        return self.get_secret_key(n_key)
+
+    def update_address_counter(self, new_counter=0):
+        with self.counter_lock:
+            if new_counter:
+                self.wallet.address_counter = new_counter
+            else:
+                self.wallet.address_counter += 1
+            self.pubkey = self.get_next_pubkey()
+            self.address = p2pk_address(self.pubkey)
+            self.wallet.next_address = self.address
+            self.wallet.save()
+        self.release_session()
+
+    def advance_address_counter(self, key_index):
+        # compared and saved in one step, releases finishing out of order never lower the counter
+        with self.counter_lock:
+            if key_index > self.wallet.address_counter:
+                self.update_address_counter(key_index)
+
+    async def reserve_key(self):
+        # WalletKey with key_index, pubkey, pubkey_hash and address of a key no other swap uses
+        return await self.keypool.async_reserve()
+
+    async def release_key(self, key, used=True):
+        # used keys move address_counter forward, so derivation by counter never reuses them
+        if not used:
+            await asyncio.to_thread(self.keypool.release, key)
+            return
+        await asyncio.to_thread(self.keypool.mark_used, key)
+        await asyncio.to_thread(self.advance_address_counter, key.key_index)
 
     @staticmethod
     async def gen_ln_invoice(amount, lncli=None):
@@ -181,6 +304,16 @@ class Counterparty:
         # logger.debug(f"msg_hash = {msg_hash.hex()}")
         return self.sign(msg_hash, node_key=node_key)
 
+    def signed_message(self, msg_type, payload):
+        # message to another node, signed with the node key
+        signature = self.sign_message(msg_type, payload, node_key=True)
+        return {
+            'type': msg_type,
+            'payload': payload,
+            'pubkey': self.node_pubkey.hex(),
+            'signature': signature.hex()
+        }
+
     @staticmethod
     async def fund_contract_address(address, amount=0):
         logger.info(f"Funding {address} with {amount} KAS ")
@@ -221,21 +354,46 @@ class Counterparty:
         if node_key:
             priv_key = self.node_privkey
         else:
-            priv_key = self.get_wallet().derive_secret_key(f"{DERIVATION_PATH}{self.wallet.address_counter + 1}")
+            priv_key = self.get_secret_key()
 
         signature = sign_hash(msg_hash, priv_key)
 
         return signature
 
+    def parse_signed_message(self, msg):
+        # (signature, msg_hash, pubkey) of a {'type', 'payload', 'pubkey', 'signature'} message, None when malformed
+        try:
+            if isinstance(msg, (str, bytes)):
+                msg = json.loads(msg)
+            if not isinstance(msg, dict) or not isinstance(msg.get('type'), str) or 'payload' not in msg:
+                raise ValueError('no type or payload')
+            signature = bytes.fromhex(msg['signature'])
+            pubkey = bytes.fromhex(msg['pubkey'])
+            msg_hash = self.get_msg_hash(msg['type'], msg['payload'])
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"Malformed signed message: {e}")
+            return None
+        return signature, msg_hash, pubkey
+
     def verify_signature(self, msg):
-        if isinstance(msg, str):
-            msg = json.loads(msg)
-        signature = bytes.fromhex(msg['signature'])
-        msg_hash = self.get_msg_hash(msg['type'], msg['payload'])
-        # logger.debug(f"msg_hash = {msg_hash.hex()}")
-        pubkey = bytes.fromhex(msg['pubkey'])
-        sig_verify = verify_signature(signature, msg_hash, pubkey)
+        parsed = self.parse_signed_message(msg)
+        if parsed is None:
+            return False
+        try:
+            sig_verify = verify_signature(*parsed)
+        except (TypeError, ValueError):
+            sig_verify = False
         if not sig_verify:
             logger.error('Error during signature verification')
             return False
         return True
+
+    async def async_verify_signature(self, msg):
+        # same as verify_signature, the schnorr check runs batched in a worker (klib.kverify)
+        parsed = self.parse_signed_message(msg)
+        if parsed is None:
+            return False
+        if not await async_verify_signature(*parsed):
+            logger.error('Error during signature verification')
+            return False
+        return True
@@ -0,0 +1,145 @@
+import asyncio
+import datetime
+import logging
+import threading
+
+from peewee import fn
+
+from db.models import db, WalletKey
+from klib.kaddress import p2pk_address, get_pubkey_hash
+
+logger = logging.getLogger('keypool')
+
+KEYPOOL_SIZE = 20
+
+
+class KeyPool:
+    # Swap keys derived ahead of time and stored in the WalletKey table, next to their address and pubkey hash.
+    # reserve() pops a key from memory and flags it in the db, refill runs in a worker thread when the pool runs low.
+    # available is shared by the event loop and the refill threads, it is only touched under lock.
+    def __init__(self, counterparty, size=KEYPOOL_SIZE, low_watermark=None):
+        self.counterparty = counterparty
+        self.size = size
+        self.low_watermark = size // 2 if low_watermark is None else low_watermark
+        self.wallet_table = counterparty.wallet_db_table.__name__
+        self.wallet_id = counterparty.wallet.id
+        self.available = {}
+        self.lock = threading.Lock()
+        self.refill_task = None
+        # refills run in worker threads and from reserve(), one at a time
+        self.refill_lock = threading.Lock()
+        self.load()
+
+    def wallet_keys(self, *fields):
+        return WalletKey.select(*fields).where(
+            (WalletKey.wallet_table == self.wallet_table) & (WalletKey.wallet_id == self.wallet_id))
+
+    def load(self):
+        keys = self.wallet_keys().where(WalletKey.status == 'AVAILABLE').order_by(WalletKey.key_index)
+        with self.lock:
+            self.available = {key.key_index: key for key in keys}
+
+    def count(self):
+        with self.lock:
+            return len(self.available)
+
+    def refill(self):
+        # derive keys after the last stored one (and after address_counter, for wallets older than the pool)
+        # the wallet is unlocked first, a password prompt must not hold the lock or the db write transaction
+        self.counterparty.get_session()
+        with self.refill_lock, db.atomic(lock_type='IMMEDIATE'):
+            # indices are read and the keys inserted in one write transaction, also safe with other processes
+            missing = self.size - self.count()
+            if missing <= 0:
+                return 0
+            last_index = self.wallet_keys(fn.MAX(WalletKey.key_index)).scalar() or 0
+            first_index = max(last_index, self.counterparty.wallet.address_counter) + 1
+            rows = []
+            for key_index in range(first_index, first_index + missing):
+                pubkey = self.counterparty.get_next_pubkey(n_key=key_index)
+                rows.append({
+                    'wallet_table': self.wallet_table,
+                    'wallet_id': self.wallet_id,
+                    'key_index': key_index,
+                    'pubkey': pubkey.hex(),
+                    'pubkey_hash': get_pubkey_hash(pubkey).hex(),
+                    'address': p2pk_address(pubkey)
+                })
+            WalletKey.insert_many(rows).execute()
+            new_keys = self.wallet_keys().where(WalletKey.key_index >= first_index).order_by(WalletKey.key_index)
+            with self.lock:
+                self.available.update({key.key_index: key for key in new_keys if key.status == 'AVAILABLE'})
+        self.counterparty.release_session()
+        logger.debug(f"Keypool refilled with keys {first_index}-{first_index + missing - 1}")
+        return missing
+
+    async def run_refill(self):
+        await self.counterparty.unlock_wallet()
+        return await asyncio.to_thread(self.refill)
+
+    async def async_refill(self):
+        # join the refill in flight instead of starting a second one
+        if self.refill_task is None or self.refill_task.done():
+            self.refill_task = asyncio.create_task(self.run_refill())
+        return await asyncio.shield(self.refill_task)
+
+    def schedule_refill(self):
+        # background refill only for wallets kept unlocked, the others would prompt for the password
+        if self.count() >= self.low_watermark or not self.counterparty.keep_unlocked:
+            return
+        if self.refill_task is not None and not self.refill_task.done():
+            return
+        try:
+            self.refill_task = asyncio.get_running_loop().create_task(self.run_refill())
+        except RuntimeError:
+            self.refill()
+
+    def take(self):
+        # lowest available key, None when the pool is empty
+        with self.lock:
+            if not self.available:
+                return None
+            return self.available.pop(min(self.available))
+
+    @staticmethod
+    def claim(key):
+        # the conditional update hands the key out once, even with other processes on the same db
+        return WalletKey.update(status='RESERVED', updated_at=datetime.datetime.now()).where(
+            (WalletKey.id == key.id) & (WalletKey.status == 'AVAILABLE')).execute()
+
+    def reserve(self):
+        while True:
+            key = self.take()
+            if key is None:
+                self.refill()
+            elif self.claim(key):
+                break
+        key.status = 'RESERVED'
+        self.schedule_refill()
+        return key
+
+    async def async_reserve(self):
+        # same as reserve, derivation and db writes stay off the event loop
+        while True:
+            key = self.take()
+            if key is None:
+                await self.async_refill()
+            elif await asyncio.to_thread(self.claim, key):
+                break
+        key.status = 'RESERVED'
+        self.schedule_refill()
+        return key
+
+    def set_status(self, key, status):
+        key.status = status
+        key.updated_at = datetime.datetime.now()
+        key.save()
+
+    def mark_used(self, key):
+        self.set_status(key, 'USED')
+
+    def release(self, key):
+        # the key was never used on chain, it goes back to the pool
+        self.set_status(key, 'AVAILABLE')
+        with self.lock:
+            self.available[key.key_index] = key
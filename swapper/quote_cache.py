@@ -0,0 +1,88 @@
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger('quote_cache')
+
+# quotes are refreshed in the background when they have less than this many seconds left
+QUOTE_REFRESH_AHEAD = 5
+
+
+class QuoteCache:
+    # Signed maker price payloads keyed by (endpoint, swap_type, p2p_price), served until their valid_until.
+    # A hit close to expiry schedules a refresh, so browsing the orderbook keeps quotes warm without waiting on Tor.
+    def __init__(self, fetch, refresh_ahead=QUOTE_REFRESH_AHEAD):
+        # fetch(endpoint, swap_type, p2p_price) -> verified payload with valid_until, or None
+        self.fetch = fetch
+        self.refresh_ahead = refresh_ahead
+        self.quotes = {}
+        self.refresh_tasks = {}
+
+    def get(self, endpoint, swap_type, p2p_price):
+        key = (endpoint, swap_type, p2p_price)
+        payload = self.quotes.get(key)
+        if payload is None:
+            return None
+        remaining = payload['valid_until'] - time.time()
+        if remaining <= 0:
+            del self.quotes[key]
+            return None
+        if remaining < self.refresh_ahead:
+            self.schedule_refresh(key)
+        return payload
+
+    def put(self, endpoint, swap_type, p2p_price, payload):
+        self.evict_expired()
+        if payload.get('valid_until', 0) > time.time():
+            self.quotes[(endpoint, swap_type, p2p_price)] = payload
+
+    def invalidate(self, endpoint, swap_type=None, p2p_price=None):
+        for key in [k for k in self.quotes if k[0] == endpoint and swap_type in (None, k[1]) and
+                    (p2p_price is None or p2p_price == k[2])]:
+            del self.quotes[key]
+
+    def evict_expired(self):
+        now = time.time()
+        for key in [k for k, payload in self.quotes.items() if payload['valid_until'] <= now]:
+            del self.quotes[key]
+
+    async def lookup(self, endpoint, swap_type, p2p_price, refresh=False):
+        # cached payload, or a fresh one from the maker (joining a refresh already in flight),
+        # refresh=True always sends a new request
+        key = (endpoint, swap_type, p2p_price)
+        if refresh:
+            task = asyncio.get_running_loop().create_task(self.refresh(key))
+            self.refresh_tasks[key] = task
+        else:
+            payload = self.get(*key)
+            if payload is not None:
+                return payload
+            task = self.schedule_refresh(key)
+        # shielded, an abandoned request still fills the cache
+        return await asyncio.shield(task)
+
+    def schedule_refresh(self, key):
+        task = self.refresh_tasks.get(key)
+        if task is None or task.done():
+            task = asyncio.get_running_loop().create_task(self.refresh(key))
+            self.refresh_tasks[key] = task
+        return task
+
+    async def refresh(self, key):
+        try:
+            payload = await self.fetch(*key)
+        except Exception as e:
+            logger.debug(f"Quote refresh for {key} failed: {e}")
+            payload = None
+        finally:
+            if self.refresh_tasks.get(key) is asyncio.current_task():
+                del self.refresh_tasks[key]
+        if payload:
+            self.put(*key, payload)
+        return payload
+
+    def close(self):
+        for task in self.refresh_tasks.values():
+            task.cancel()
+        self.refresh_tasks.clear()
+        self.quotes.clear()
@@ -0,0 +1,110 @@
+import time
+import asyncio
+import logging
+
+import aiohttp
+from aiohttp_socks import ProxyConnector
+
+logger = logging.getLogger('session_pool')
+
+TOR_PROXY = 'socks5://127.0.0.1:9050'
+# maker requests: building the Tor circuit to an onion can take tens of seconds, then the maker has to answer
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=120, connect=60)
+# swap channels: the websocket lives for the whole swap, SwapChannel bounds the handshake itself
+CHANNEL_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=60)
+
+
+def normalize_endpoint(endpoint):
+    if not endpoint.startswith('http') and endpoint.endswith('onion'):
+        endpoint = f"http://{endpoint}"
+    return endpoint.rstrip('/')
+
+
+class MakerSessionPool:
+    # One keep-alive aiohttp session per maker endpoint, all going through Tor.
+    # The SOCKS5 connection and the onion rendezvous are paid once per maker instead of once per message.
+    def __init__(self, proxy_url=TOR_PROXY, limit_per_endpoint=4, keepalive_timeout=120, idle_timeout=300):
+        self.proxy_url = proxy_url
+        self.limit_per_endpoint = limit_per_endpoint
+        self.keepalive_timeout = keepalive_timeout
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        # endpoint -> session of the swap channels, on its own connector: every channel keeps a connection
+        # for the whole swap, on the shared connector they would take the slots of the POST requests
+        self.channel_sessions = {}
+        self.last_used = {}
+        # endpoint -> number of holders, held sessions (e.g. under a swap channel) are never evicted
+        self.holds = {}
+        self.evict_task = None
+
+    def get(self, endpoint):
+        endpoint = normalize_endpoint(endpoint)
+        session = self.sessions.get(endpoint)
+        if session is None or session.closed:
+            session = self.new_session(self.limit_per_endpoint, REQUEST_TIMEOUT)
+            self.sessions[endpoint] = session
+            logger.debug(f"New session for {endpoint}")
+        self.last_used[endpoint] = time.time()
+        if self.evict_task is None or self.evict_task.done():
+            self.evict_task = asyncio.create_task(self.evict_idle())
+        return session
+
+    def new_session(self, limit, timeout):
+        connector = ProxyConnector.from_url(
+            self.proxy_url,
+            rdns=True,
+            limit=limit,
+            keepalive_timeout=self.keepalive_timeout
+        )
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    def hold(self, endpoint):
+        # sessions of the endpoint kept for a swap until release(), returns the one for its websocket
+        self.get(endpoint)
+        endpoint = normalize_endpoint(endpoint)
+        self.holds[endpoint] = self.holds.get(endpoint, 0) + 1
+        session = self.channel_sessions.get(endpoint)
+        if session is None or session.closed:
+            # no limit, one connection per open channel
+            session = self.new_session(0, CHANNEL_TIMEOUT)
+            self.channel_sessions[endpoint] = session
+        return session
+
+    def release(self, endpoint):
+        endpoint = normalize_endpoint(endpoint)
+        self.holds[endpoint] = self.holds.get(endpoint, 1) - 1
+        if self.holds[endpoint] <= 0:
+            del self.holds[endpoint]
+        if endpoint in self.sessions:
+            # the idle timeout starts when the last holder is done
+            self.last_used[endpoint] = time.time()
+
+    async def post(self, endpoint, data):
+        session = self.get(endpoint)
+        async with session.post(normalize_endpoint(endpoint), data=data) as res:
+            return await res.text()
+
+    async def evict_idle(self):
+        while self.sessions:
+            await asyncio.sleep(self.idle_timeout / 2)
+            now = time.time()
+            for endpoint in [e for e, last_used in self.last_used.items()
+                             if now - last_used > self.idle_timeout and e not in self.holds]:
+                await self.close_session(endpoint)
+
+    async def close_session(self, endpoint):
+        self.last_used.pop(endpoint, None)
+        session = self.sessions.pop(endpoint, None)
+        channel_session = self.channel_sessions.pop(endpoint, None)
+        if channel_session is not None:
+            await channel_session.close()
+        if session is not None:
+            await session.close()
+            logger.debug(f"Closed session for {endpoint}")
+
+    async def close(self):
+        if self.evict_task is not None:
+            self.evict_task.cancel()
+            self.evict_task = None
+        for endpoint in list(self.sessions):
+            await self.close_session(endpoint)
@@ -0,0 +1,168 @@
+import json
+import asyncio
+import logging
+import itertools
+
+import aiohttp
+
+from .session_pool import normalize_endpoint
+
+logger = logging.getLogger('swap_channel')
+
+# path of the maker websocket, next to the POST endpoint
+SWAP_CHANNEL_PATH = '/swap'
+CHANNEL_REQUEST_TIMEOUT = 60
+# seconds to connect the websocket, through Tor
+CHANNEL_CONNECT_TIMEOUT = 90
+# contract events pushed by the maker
+CONTRACT_EVENTS = ('contract_funded', 'contract_redeemed', 'contract_refunded')
+
+
+class ChannelError(Exception):
+    # sent: the message went out (or may have), the maker may have acted on it
+    def __init__(self, message, sent=False):
+        super().__init__(message)
+        self.sent = sent
+
+
+class SwapChannel:
+    # Long-lived websocket to a maker for the whole life of one swap.
+    # Messages are signed like the POST ones, requests carry an id echoed by the maker reply,
+    # messages without id are events pushed by the maker (e.g. contract_funded with its txid).
+    def __init__(self, counterparty, session, endpoint, request_timeout=CHANNEL_REQUEST_TIMEOUT):
+        self.counterparty = counterparty
+        self.session = session
+        endpoint = normalize_endpoint(endpoint)
+        self.url = f"{endpoint.replace('http://', 'ws://', 1).replace('https://', 'wss://', 1)}{SWAP_CHANNEL_PATH}"
+        self.request_timeout = request_timeout
+        self.ws = None
+        self.reader_task = None
+        self.maker_pubkey = None
+        self.pending = {}
+        self.listeners = []
+        self.msg_ids = itertools.count(1)
+        # the maker answered but doesn't offer the channel, as opposed to being unreachable
+        self.unsupported = False
+
+    @property
+    def connected(self):
+        return self.ws is not None and not self.ws.closed
+
+    async def open(self):
+        # False when the maker doesn't offer the channel, the caller keeps using POST
+        try:
+            self.ws = await asyncio.wait_for(self.session.ws_connect(self.url, heartbeat=30), CHANNEL_CONNECT_TIMEOUT)
+        except aiohttp.WSServerHandshakeError as e:
+            logger.debug(f"Swap channel not offered at {self.url}: {e.status}")
+            self.unsupported = True
+            return False
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            logger.debug(f"Swap channel unavailable at {self.url}: {e}")
+            return False
+        self.reader_task = asyncio.create_task(self.read_loop(self.ws))
+        try:
+            hello = await self.request('channel_hello', {})
+        except ChannelError as e:
+            logger.debug(f"Swap channel handshake failed: {e}")
+            await self.close()
+            return False
+        if hello.get('error') or not isinstance(hello.get('pubkey'), str):
+            logger.debug(f"Swap channel refused: {hello.get('error')}")
+            self.unsupported = True
+            await self.close()
+            return False
+        # events are only accepted from the maker that answered the handshake
+        self.maker_pubkey = hello['pubkey']
+        logger.debug(f"Swap channel open with {self.url}")
+        return True
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.reader_task is not None:
+            await asyncio.gather(self.reader_task, return_exceptions=True)
+        self.ws = None
+        self.reader_task = None
+
+    async def read_loop(self, ws):
+        try:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    try:
+                        await self.dispatch(msg.data)
+                    except Exception as e:
+                        logger.error(f"Dropped swap channel message: {e}", exc_info=True)
+                elif msg.type == aiohttp.WSMsgType.ERROR:
+                    logger.error(f"Swap channel error: {ws.exception()}")
+                    break
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ChannelError('Swap channel closed', sent=True))
+            self.pending.clear()
+
+    async def dispatch(self, raw_message):
+        # replies resolve their request, verified contract events go to the listeners, anything else is dropped
+        try:
+            data = json.loads(raw_message)
+        except json.JSONDecodeError:
+            logger.error(f"Invalid swap channel message: {raw_message[:100]}")
+            return
+        if not isinstance(data, dict):
+            logger.warning(f"Dropped malformed swap channel message: {raw_message[:100]}")
+            return
+        msg_id = data.pop('id', None)
+        if msg_id is not None:
+            future = self.pending.pop(msg_id, None) if isinstance(msg_id, int) else None
+            if future is None:
+                logger.warning(f"Dropped swap channel reply to unknown request {str(msg_id)[:20]}")
+                return
+            data.setdefault('error', None)
+            if not data['error'] and not await self.counterparty.async_verify_signature(data):
+                data['error'] = 'Signature verification failed'
+            if not future.done():
+                future.set_result(data)
+            return
+        msg_type = data.get('type')
+        if msg_type not in CONTRACT_EVENTS or not isinstance(data.get('payload'), dict) or data.get('error') \
+                or data.get('pubkey') != self.maker_pubkey:
+            logger.warning(f"Dropped swap channel event: {str(msg_type)[:50]}")
+            return
+        if not await self.counterparty.async_verify_signature(data):
+            logger.warning(f"Dropped swap channel event with invalid signature: {msg_type}")
+            return
+        for callback in list(self.listeners):
+            try:
+                callback(data)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+    def add_listener(self, callback):
+        # callback(msg) for every verified event pushed by the maker
+        self.listeners.append(callback)
+
+    async def send(self, msg):
+        if not self.connected:
+            raise ChannelError('Swap channel not connected')
+        try:
+            await self.ws.send_str(json.dumps(msg))
+        except (aiohttp.ClientError, ConnectionError) as e:
+            # part of the message may have been written
+            raise ChannelError(f"Unable to send on swap channel: {e}", sent=True) from e
+
+    async def request(self, msg_type, payload):
+        # same reply as a POST to the maker: {'error', 'type', 'payload', 'pubkey', 'signature'}
+        msg_id = next(self.msg_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[msg_id] = future
+        try:
+            await self.send({'id': msg_id, **self.counterparty.signed_message(msg_type, payload)})
+            return await asyncio.wait_for(future, self.request_timeout)
+        except asyncio.TimeoutError:
+            raise ChannelError(f"{msg_type} timed out after {self.request_timeout} seconds", sent=True)
+        finally:
+            self.pending.pop(msg_id, None)
+
+    async def notify(self, msg_type, payload):
+        # one-way message, no reply expected
+        await self.send(self.counterparty.signed_message(msg_type, payload))
@@ -1,17 +1,23 @@
-
 import os
 import time
+import asyncio
 import json
-import aiohttp
 import logging
+import itertools
+import contextlib
+
+from dataclasses import dataclass, field, replace
+from typing import Any, Optional
 
 from inputimeout import inputimeout, TimeoutOccurred
-from aiohttp_socks import ProxyConnector
 # from dotenv import load_dotenv
 
-from db.models import TakerWallet
+from db.models import TakerWallet, WalletKey
 from .counterparty import Counterparty
 from .atomic_swap import AtomicSwap
+from .session_pool import MakerSessionPool, normalize_endpoint
+from .quote_cache import QuoteCache
+from .swap_channel import SwapChannel, ChannelError, CONTRACT_EVENTS
 
 # load_dotenv()
 
@@ -22,27 +28,243 @@ logging.basicConfig(
 )
 
 
+# swaps running at the same time, more are queued
+MAX_CONCURRENT_SWAPS = 4
+# seconds given to makers to answer a price request, and before sending a second (hedged) request
+QUOTE_DEADLINE = 15
+QUOTE_HEDGE_AFTER = 5
+# seconds before trying again the swap channel of a maker that didn't offer it
+NO_CHANNEL_RETRY = 3600
+
+
+@dataclass
+class TakerSwap:
+    # state of a single swap, a Taker runs many of them concurrently
+    swap_id: int
+    swap_type: str
+    kas_amount: float
+    maker_endpoint: str
+    p2p_price: Optional[int] = None
+    price: Optional[float] = None
+    key: Optional[WalletKey] = None
+    swap: Optional[AtomicSwap] = None
+    status: str = 'QUEUED'  # QUEUED / STARTED / ACCEPTED / COMPLETED / REFUNDED / FAILED
+    # how the contract ended: REDEEMED (the swap went through) or REFUNDED (the kas went back to the sender)
+    outcome: Optional[str] = None
+    # init_swap went (or may have gone) out, the maker may know the key's address
+    init_sent: bool = False
+    result: Any = None
+    start_time: float = 0
+    task: Optional[asyncio.Task] = None
+    channel: Optional[SwapChannel] = None
+    exit_stack: contextlib.AsyncExitStack = field(default_factory=contextlib.AsyncExitStack)
+
+    @property
+    def log_prefix(self):
+        return f"[{self.swap_type} #{self.swap_id}]"
+
+
 class Taker(Counterparty):
-    def __init__(self, output_address=None, wallet_index=1):
+    def __init__(self, output_address=None, wallet_index=1, max_concurrent_swaps=MAX_CONCURRENT_SWAPS):
         super().__init__(wallet_db_table=TakerWallet, keep_unlocked=True, wallet_index=wallet_index)
-        self.start_time = 0
         self.maker_endpoint = ''
         if output_address is None:
             self.output_address = self.address
         else:
             self.output_address = output_address
-        self.swap = None
+        self.swaps = {}
+        self.swap_ids = itertools.count(1)
+        self.swap_slots = asyncio.Semaphore(max_concurrent_swaps)
+        # keep-alive Tor sessions to makers, shared by price queries and swaps
+        self.maker_sessions = MakerSessionPool()
+        # endpoint -> time the maker answered without offering the swap channel
+        self.no_channel = {}
+        # signed quotes are reused until the maker's valid_until
+        self.quotes = QuoteCache(self.fetch_quote)
+
+    def start_swap(self, swap_type, kas_amount=1, p2p_price=None, price=None, maker_endpoint=None):
+        # schedule a swap and return its state right away, await state.task for the result
+        state = TakerSwap(
+            swap_id=next(self.swap_ids),
+            swap_type=swap_type,
+            kas_amount=kas_amount,
+            maker_endpoint=maker_endpoint or self.maker_endpoint,
+            p2p_price=p2p_price,
+            price=price
+        )
+        self.swaps[state.swap_id] = state
+        state.task = asyncio.create_task(self.run_swap(state))
+        return state
+
+    async def sat2kas(self, kas_amount=1, p2p_price=None, price=None, maker_endpoint=None):
+        return await self.start_swap('sat2kas', kas_amount, p2p_price, price, maker_endpoint).task
+
+    async def kas2sat(self, kas_amount=1, p2p_price=None, price=None, maker_endpoint=None):
+        return await self.start_swap('kas2sat', kas_amount, p2p_price, price, maker_endpoint).task
+
+    async def split_swap(self, swap_type, legs, spare_legs=()):
+        # Run one swap per leg (endpoint, price, amount) concurrently, e.g. the legs of a p2p fill plan.
+        # A leg that isn't redeemed (failed, refunded, or without endpoint) is re-routed to the next spare offers
+        # from other makers, redeemed legs are kept.
+        # Returns the [(leg, result)] of the redeemed legs and the amount left unfilled.
+        spare_legs = [leg for leg in spare_legs if leg.endpoint]
+        failed_endpoints = set()
+        completed = []
+        unfilled = 0
+        pending = {}
+        new_legs = list(legs)
+        while new_legs or pending:
+            failed_legs = []
+            for leg in new_legs:
+                if leg.endpoint:
+                    state = self.start_leg(swap_type, leg)
+                    pending[state.task] = (leg, state)
+                else:
+                    # no onion in the maker announcement, start_swap would fall back to the default maker
+                    logger.warning(f"Leg of {leg.amount} KAS with maker {leg.maker_id} has no endpoint")
+                    failed_legs.append(leg)
+            if not failed_legs:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    leg, state = pending.pop(task)
+                    try:
+                        task.result()
+                    except Exception as e:
+                        logger.error(f"Leg of {leg.amount} KAS with {leg.endpoint} failed: {e}")
+                    if state.outcome == 'REDEEMED':
+                        completed.append((leg, state.result))
+                    else:
+                        failed_legs.append(leg)
+            new_legs = []
+            for leg in failed_legs:
+                failed_endpoints.add(leg.endpoint)
+                rerouted, missing = self.reroute_leg(leg, spare_legs, failed_endpoints)
+                for new_leg in rerouted:
+                    logger.info(f"Re-routing {new_leg.amount} KAS from {leg.endpoint} to {new_leg.endpoint}")
+                new_legs += rerouted
+                unfilled += missing
+        logger.info(f"Split {swap_type} swap: {len(completed)} legs completed, {unfilled} KAS unfilled")
+        return completed, unfilled
+
+    def start_leg(self, swap_type, leg):
+        return self.start_swap(swap_type, leg.amount, p2p_price=leg.price, maker_endpoint=leg.endpoint)
+
+    @staticmethod
+    def reroute_leg(leg, spare_legs, failed_endpoints):
+        # take the failed amount from the best spare offers of makers that didn't fail yet
+        amount = leg.amount
+        new_legs = []
+        for spare in list(spare_legs):
+            if not amount:
+                break
+            if spare.endpoint in failed_endpoints or amount < spare.min_amount:
+                continue
+            spare_legs.remove(spare)
+            new_leg = replace(spare, amount=min(amount, spare.max_amount))
+            new_legs.append(new_leg)
+            amount -= new_leg.amount
+        return new_legs, amount
+
+    async def run_swap(self, state):
+        # each swap takes its own key from the keypool, the key is burned once init_swap was sent:
+        # a failed request may still have been accepted, the key only goes back when it never went out
+        async with self.swap_slots:
+            state.status = 'STARTED'
+            state.start_time = time.time()
+            swap_routine = self.run_sat2kas if state.swap_type == 'sat2kas' else self.run_kas2sat
+            try:
+                state.key = await self.reserve_key()
+                async with state.exit_stack:
+                    await self.open_channel(state)
+                    state.result = await swap_routine(state)
+            except Exception:
+                state.status = 'FAILED'
+                raise
+            else:
+                state.status = {'REDEEMED': 'COMPLETED', 'REFUNDED': 'REFUNDED'}.get(state.outcome, 'FAILED')
+            finally:
+                if state.key is not None:
+                    await self.release_key(state.key, used=state.init_sent)
+                del self.swaps[state.swap_id]
+            elapsed = time.time() - state.start_time
+            logger.info(f"{state.log_prefix} Swap {state.status.lower()} in {elapsed:.2f} seconds")
+            return state.result
+
+    async def open_channel(self, state):
+        # websocket to the maker for the whole swap, POST is used when the maker doesn't offer it
+        # the pooled session is held until the swap ends, idle eviction would close the channel
+        session = self.maker_sessions.hold(state.maker_endpoint)
+        state.exit_stack.callback(self.maker_sessions.release, state.maker_endpoint)
+        endpoint = normalize_endpoint(state.maker_endpoint)
+        if time.time() - self.no_channel.get(endpoint, 0) < NO_CHANNEL_RETRY:
+            logger.debug(f"{state.log_prefix} Maker has no swap channel, using POST requests")
+            return
+        channel = SwapChannel(self, session, state.maker_endpoint)
+        if not await channel.open():
+            logger.debug(f"{state.log_prefix} No swap channel, using POST requests")
+            if channel.unsupported:
+                self.no_channel[endpoint] = time.time()
+            return
+        state.channel = channel
+        state.exit_stack.push_async_callback(channel.close)
+        channel.add_listener(lambda msg: self.on_channel_event(state, msg))
+
+    def on_channel_event(self, state, msg):
+        # the maker only gives a hint, the chain is checked right away instead of at the next poll
+        logger.info(f"{state.log_prefix} Maker event {msg.get('type')}: {msg.get('payload')}")
+        if msg.get('type') in CONTRACT_EVENTS and state.swap is not None:
+            state.swap.watcher.poke(state.swap.contract_address)
+
+    async def notify_maker(self, state, msg_type, payload):
+        # tell the maker about our progress, only possible on the swap channel
+        if state.channel is None or not state.channel.connected:
+            return
+        try:
+            await state.channel.notify(msg_type, payload)
+        except ChannelError as e:
+            logger.debug(f"{state.log_prefix} Unable to notify maker: {e}")
+
+    async def watch_contract(self, state):
+        # keep the contract registered on the shared watcher until the swap ends
+        await state.exit_stack.enter_async_context(state.swap.watch_contract())
+
+    async def swap_price(self, state):
+        # numeric price of the swap: the given one, else the maker's quote, None when there is no usable price
+        price = state.price
+        if price is None:
+            quote = await self.query_price(state.swap_type, kas_amount=state.kas_amount, p2p_price=state.p2p_price,
+                                           endpoint=state.maker_endpoint)
+            price = self.quote_price(quote[0], state.kas_amount) if quote else None
+        if isinstance(price, bool) or not isinstance(price, (int, float)) or not price > 0:
+            logger.error(f"{state.log_prefix} No valid price from maker: {price!r}")
+            return None
+        return price
+
+    @staticmethod
+    def quote_price(res, kas_amount=0):
+        # query_price result: the price, [price, min_amount, max_amount] for a p2p_price, or the offers dict
+        if isinstance(res, (list, tuple)):
+            limits = res[1:3]
+            if kas_amount and len(limits) == 2 and all(isinstance(limit, (int, float)) for limit in limits) \
+                    and not limits[0] <= kas_amount <= limits[1]:
+                logger.error(f"{kas_amount} KAS is out of the maker range {res[1]}-{res[2]}")
+                return None
+            res = res[0] if res else None
+        return None if isinstance(res, dict) else res
 
-    async def sat2kas(self, kas_amount=1, p2p_price=None, price=None):
+    async def run_sat2kas(self, state):
         # sat -> kas taker routine
-        self.start_time = time.time()
+        kas_amount = state.kas_amount
         # ping maker for price
+        price = await self.swap_price(state)
         if price is None:
-            price = await self.query_price('sat2kas', kas_amount=kas_amount, p2p_price=p2p_price)
+            return
         # ping maker with receiver address and kas amount
-        logger.info(f"Requesting sat2kas swap with receiver address {self.address}")
-        init_swap_payload = {'receiver_address': self.address, 'kas_amount': kas_amount, 'price': price}
-        init_swap_response = await self.ping_maker('init_swap', init_swap_payload)
+        logger.info(f"{state.log_prefix} Requesting sat2kas swap with receiver address {state.key.address}")
+        init_swap_payload = {'receiver_address': state.key.address, 'kas_amount': kas_amount, 'price': price}
+        state.init_sent = True
+        init_swap_response = await self.ping_maker('init_swap', init_swap_payload, state.maker_endpoint,
+                                                   state.channel)
         # receive response (swap accepted) with ln-invoice, P2SH address and sender address
         if init_swap_response['error']:
             logger.error(f"Error getting swap details from maker: {init_swap_response['error']}")
@@ -53,80 +275,87 @@ class Taker(Counterparty):
         sender_address = init_swap_response_payload['sender_address']
         maker_p2sh_address = init_swap_response_payload['p2sh_address']
         maker_short_pubkey = f"{init_swap_response['pubkey'][:3]}...{init_swap_response['pubkey'][-3:]}"
-        logger.info(f"Swap accepted by maker {maker_short_pubkey} with sender address {sender_address} "
-                    f"and invoice {ln_invoice}")
+        state.status = 'ACCEPTED'
+        logger.info(f"{state.log_prefix} Swap accepted by maker {maker_short_pubkey} "
+                    f"with sender address {sender_address} and invoice {ln_invoice}")
 
-        self.swap = AtomicSwap(
+        state.swap = AtomicSwap(
             ln_rpc_server=os.getenv('LN_RPC_SERVER', None),
             kas_rpc_server=os.getenv('KAS_RPC_SERVER', None),
             invoice=ln_invoice,
             sender_address=sender_address,
             sender_private_key=None,
-            receiver_address=self.address,
+            receiver_address=state.key.address,
             receiver_private_key=None,
             output_address=self.output_address
         )
 
         # generate contract address and verify it matched the address given by maker
-        self.swap.decode_ln_invoice()
-        assert self.swap.sat_amount == int(kas_amount * price)
-        self.swap.gen_contract_address()
-        if self.swap.contract_address != maker_p2sh_address:
+        await state.swap.async_decode_ln_invoice()
+        assert state.swap.sat_amount == int(kas_amount * price)
+        state.swap.gen_contract_address()
+        if state.swap.contract_address != maker_p2sh_address:
             logger.error(f"Error, provided p2sh ({maker_p2sh_address}) differs "
-                         f"from the one we generated ({self.swap.contract_address})")
+                         f"from the one we generated ({state.swap.contract_address})")
             return
+        await self.watch_contract(state)
         # await funding of P2SH address
-        utxo_sum = self.swap.check_utxo(min_amount=kas_amount+0.001)
+        utxo_sum = await state.swap.async_check_utxo(min_amount=kas_amount+0.001)
         if not utxo_sum:
             return
 
         # REDEEM PATH:
         # pay the invoice, retrieving the preimage
         try:
-            secret = await self.lncli_pay(self.swap.invoice, lncli=os.getenv('LNCLI', None))
+            secret = await self.lncli_pay(state.swap.invoice, lncli=os.getenv('LNCLI', None))
             if not secret:
                 raise Exception
         except Exception as e:
             logger.error(e, exc_info=True)
-            timeout = int((self.swap.timelock / 1000) - time.time())
-            logger.info(f"Pay the invoice then paste the preimage of the payment\n\n{self.swap.invoice}\n")
+            timeout = int((state.swap.timelock / 1000) - time.time())
+            logger.info(f"Pay the invoice then paste the preimage of the payment\n\n{state.swap.invoice}\n")
             try:
-                secret = inputimeout('Insert the preimage: ', timeout=timeout).strip()
+                secret = (await asyncio.to_thread(inputimeout, 'Insert the preimage: ', timeout=timeout)).strip()
             except TimeoutOccurred:
                 logger.error(f"Timeout: the invoice is expired, aborting swap")
                 return
 
         secret_bytes = bytes.fromhex(secret)
         # set private key
-        self.swap.receiver_private_key = self.get_secret_key()
+        state.swap.receiver_private_key = await self.async_get_secret_key(n_key=state.key.key_index)
         # redeem the P2SH utxo with the preimage
-        swap_result = self.swap.spend_contract(secret=secret_bytes)
+        swap_result = await state.swap.async_spend_contract(secret=secret_bytes)
         if swap_result:
-            logger.info(f"Redeem transaction broadcasted, txid: {swap_result}")
-        self.update_address_counter()
-        self.swap = None
-        logger.info(f"Swap completed in {time.time() - self.start_time:.2f} seconds")
+            state.outcome = 'REDEEMED'
+            logger.info(f"{state.log_prefix} Redeem transaction broadcasted, txid: {swap_result}")
+            await self.notify_maker(state, 'contract_redeemed',
+                                    {'p2sh_address': state.swap.contract_address, 'txid': swap_result})
         return swap_result
         # REFUND PATH:
         # invoice is not paid, maker refund after locktime expires
         # nothing to do here, we simply avoid paying the invoice
 
-    async def kas2sat(self, kas_amount=1, p2p_price=None, price=None):
+    async def run_kas2sat(self, state):
         # kas -> sat taker routine
-        self.start_time = time.time()
+        kas_amount = state.kas_amount
         # ping maker for price
+        price = await self.swap_price(state)
         if price is None:
-            price = await self.query_price('kas2sat', kas_amount=kas_amount, p2p_price=p2p_price)
+            return False
         # ping maker with ln-invoice and sender address
         sat_amount = int(kas_amount * price)
         if os.getenv('LNCLI', None):
             ln_invoice = await self.gen_ln_invoice(sat_amount, lncli=os.getenv('LNCLI', None))
         else:
-            ln_invoice = input(f"Generate a LN invoice for {sat_amount} sats and paste it here: ").strip()
+            ln_invoice = (await asyncio.to_thread(
+                input, f"Generate a LN invoice for {sat_amount} sats and paste it here: ")).strip()
 
-        logger.info(f"Requesting kas2sat swap with sender address {self.address} and invoice {ln_invoice}")
-        init_swap_payload = {'sender_address': self.address, 'ln_invoice': ln_invoice, 'price': price}
-        init_swap_response = await self.ping_maker('init_swap', init_swap_payload)
+        logger.info(f"{state.log_prefix} Requesting kas2sat swap with sender address {state.key.address} "
+                    f"and invoice {ln_invoice}")
+        init_swap_payload = {'sender_address': state.key.address, 'ln_invoice': ln_invoice, 'price': price}
+        state.init_sent = True
+        init_swap_response = await self.ping_maker('init_swap', init_swap_payload, state.maker_endpoint,
+                                                   state.channel)
         # receive response with receiver address, p2sh address and effective kas amount
         if init_swap_response['error']:
             logger.error(f"Error getting swap details from maker: {init_swap_response['error']}")
@@ -140,13 +369,15 @@ class Taker(Counterparty):
             return False
         maker_p2sh_address = init_swap_response_payload['p2sh_address']
         maker_short_pubkey = f"{init_swap_response['pubkey'][:3]}...{init_swap_response['pubkey'][-3:]}"
-        logger.info(f"Swap accepted by maker {maker_short_pubkey} with receiver address {receiver_address}")
+        state.status = 'ACCEPTED'
+        logger.info(f"{state.log_prefix} Swap accepted by maker {maker_short_pubkey} "
+                    f"with receiver address {receiver_address}")
 
-        self.swap = AtomicSwap(
+        state.swap = AtomicSwap(
             ln_rpc_server=os.getenv('LN_RPC_SERVER', None),
             kas_rpc_server=os.getenv('KAS_RPC_SERVER', None),
             invoice=ln_invoice,
-            sender_address=self.address,
+            sender_address=state.key.address,
             sender_private_key=None,
             receiver_address=receiver_address,
             receiver_private_key=None,
@@ -154,116 +385,181 @@ class Taker(Counterparty):
         )
 
         # generate contract address and verify it matched the address given by maker
-        self.swap.decode_ln_invoice()
-        self.swap.gen_contract_address()
-        if self.swap.contract_address != maker_p2sh_address:
+        await state.swap.async_decode_ln_invoice()
+        state.swap.gen_contract_address()
+        if state.swap.contract_address != maker_p2sh_address:
             logger.error(f"Error, provided p2sh ({maker_p2sh_address}) differs "
-                         f"from the one we generated ({self.swap.contract_address})")
+                         f"from the one we generated ({state.swap.contract_address})")
             return False
+        await self.watch_contract(state)
         # fund the P2SH address
         try:
-            await self.fund_contract_address(self.swap.contract_address, amount=kas_amount)
+            await self.fund_contract_address(state.swap.contract_address, amount=kas_amount)
         except Exception as e:
             logger.error(e, exc_info=True)
-            logger.info(f"Pay to {self.swap.contract_address} a minimum of {maker_kas_amount + 0.001} KAS")
-        utxo_sum = self.swap.check_utxo(min_amount=maker_kas_amount+0.001)
+            logger.info(f"Pay to {state.swap.contract_address} a minimum of {maker_kas_amount + 0.001} KAS")
+        utxo_sum = await state.swap.async_check_utxo(min_amount=maker_kas_amount+0.001)
         if not utxo_sum:
             return False
         else:
             swap_ongoing = True
+        await self.notify_maker(state, 'contract_funded',
+                                {'p2sh_address': state.swap.contract_address,
+                                 'txids': [u['outpoint']['transactionId'] for u in state.swap.utxos]})
         swap_result = None
         while swap_ongoing:
             # REDEEM PATH:
             # invoice is paid and maker redeems the P2SH utxo
             # check invoice paid if lncli of redeem tx
-            utxo_sum = await self.swap.async_check_utxo(timeout=False)
-            if not utxo_sum:
+            utxo_sum = state.swap.utxos_total()
+            # with kaspad unreachable utxo_sum is the last known total, never read as a redeemed contract
+            if not utxo_sum and state.swap.contract_utxos_known():
                 swap_ongoing = False
-                logger.info(f"Maker redeemed the contract, exiting")
+                state.outcome = 'REDEEMED'
+                logger.info(f"{state.log_prefix} Maker redeemed the contract, exiting")
                 swap_result = True
             # REFUND PATH:
             # invoice is not paid and taker refunds after locktime expires
-            if time.time() * 1000 > self.swap.timelock + 180000 and utxo_sum:
-                self.swap.sender_private_key = self.get_secret_key()
-                swap_result = self.swap.spend_contract()
+            if time.time() * 1000 > state.swap.timelock + 180000 and utxo_sum:
+                state.swap.sender_private_key = await self.async_get_secret_key(n_key=state.key.key_index)
+                swap_result = await state.swap.async_spend_contract()
                 if swap_result:
-                    logger.info(f"Refund transaction broadcasted, txid: {swap_result}")
+                    state.outcome = 'REFUNDED'
+                    logger.info(f"{state.log_prefix} Refund transaction broadcasted, txid: {swap_result}")
+                    await self.notify_maker(state, 'contract_refunded',
+                                            {'p2sh_address': state.swap.contract_address, 'txid': swap_result})
                     swap_ongoing = False
-        self.update_address_counter()
-        self.swap = None
-        logger.info(f"Swap completed in {time.time() - self.start_time:.2f} seconds")
+            if swap_ongoing:
+                await state.swap.wait_utxo_change()
         return swap_result
 
-    async def query_price(self, swap_type, kas_amount=0, p2p_price=None, endpoint=None):
+    async def fetch_quote(self, endpoint, swap_type, p2p_price=None):
+        price_response = await self.ping_maker('price', {'swap_type': swap_type, 'p2p_price': p2p_price}, endpoint)
+        if price_response['error']:
+            logger.error(f"Error getting quote from maker: {price_response['error']}")
+            return None
+        return price_response['payload']
+
+    async def query_price(self, swap_type, kas_amount=0, p2p_price=None, endpoint=None, refresh=False):
         if endpoint is None:
             endpoint = self.maker_endpoint
-        price_response = await self.ping_maker('price', {'swap_type': swap_type, 'p2p_price': p2p_price}, endpoint)
-        if not price_response['error']:
-            valid_until = price_response['payload']['valid_until']
-            if price_response['payload'].get('price'):
-                price = price_response['payload']['price']
-                res = price
-            elif price_response['payload'].get('offers'):
-                offers = price_response['payload']['offers']
-                # we don't trust the maker, so we sort the offers and select lowest price
-                # offer format is int_price: (float_price, min_amt, max_amt)
-                best_offer_key = sorted(offers,
-                                        key=lambda x: offers[x][0],
-                                        reverse=(True if swap_type == 'kas2sat' else False)
-                                        )[0]
-                best_offer = offers[best_offer_key]
-                price = best_offer[0]
-                if kas_amount and not (best_offer[1] <= kas_amount <= best_offer[2]):
-                    return False
-                if p2p_price is None:
-                    res = offers
-                else:
-                    res = price
-            else:
-                # we should not hit this
+        payload = await self.quotes.lookup(endpoint, swap_type, p2p_price, refresh=refresh)
+        if not payload:
+            return False
+        valid_until = payload['valid_until']
+        if payload.get('price'):
+            price = payload['price']
+            res = price
+        elif payload.get('offers'):
+            offers = payload['offers']
+            # we don't trust the maker, so we sort the offers and select lowest price
+            # offer format is int_price: (float_price, min_amt, max_amt)
+            best_offer_key = sorted(offers,
+                                    key=lambda x: offers[x][0],
+                                    reverse=(True if swap_type == 'kas2sat' else False)
+                                    )[0]
+            best_offer = offers[best_offer_key]
+            price = best_offer[0]
+            if kas_amount and not (best_offer[1] <= kas_amount <= best_offer[2]):
                 return False
-            logger.info(f"Maker price is {price}")
+            if p2p_price is None:
+                res = offers
+            else:
+                res = price
         else:
-            logger.error(f"Error getting quote from maker: {price_response['error']}")
+            # we should not hit this
             return False
+        logger.info(f"Maker price is {price}")
 
         return res, valid_until
 
-    async def ping_maker(self, msg_type, payload, endpoint=None):
+    async def query_price_hedged(self, swap_type, endpoint, kas_amount=0, p2p_price=None, hedge_after=None):
+        # same as query_price, with a second request racing the first one if the maker is slow to answer
+        tasks = {asyncio.create_task(self.query_price(swap_type, kas_amount, p2p_price, endpoint))}
+        try:
+            if hedge_after is not None:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    logger.debug(f"No quote from {endpoint} after {hedge_after} seconds, sending hedged request")
+                    tasks.add(asyncio.create_task(
+                        self.query_price(swap_type, kas_amount, p2p_price, endpoint, refresh=True)))
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        logger.debug(f"Price request to {endpoint} failed: {task.exception()}")
+                    elif task.result():
+                        return task.result()
+            return False
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def collect_quotes(self, swap_type, endpoints, kas_amount=0, p2p_price=None,
+                             deadline=QUOTE_DEADLINE, hedge_after=QUOTE_HEDGE_AFTER):
+        # async iterator of (endpoint, (res, valid_until)) in arrival order,
+        # makers that didn't answer within the deadline are cancelled
+        tasks = {
+            asyncio.create_task(self.query_price_hedged(swap_type, endpoint, kas_amount, p2p_price, hedge_after)):
+                endpoint
+            for endpoint in set(endpoints)
+        }
+        loop = asyncio.get_running_loop()
+        deadline_time = loop.time() + deadline
+        pending = set(tasks)
+        try:
+            while pending:
+                remaining = deadline_time - loop.time()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result():
+                        yield tasks[task], task.result()
+        finally:
+            if pending:
+                logger.debug(f"Cancelling {len(pending)} price requests after {deadline} seconds")
+            for task in pending:
+                task.cancel()
+
+    async def ping_maker(self, msg_type, payload, endpoint=None, channel=None):
         if endpoint is None:
             endpoint = self.maker_endpoint
         # msg_type is a string
         # payload is a dict
-        signature = self.sign_message(msg_type, payload, node_key=True)
-        req_msg = {
-            'type': msg_type,
-            'payload': payload,
-            'pubkey': self.node_pubkey.hex(),
-            'signature': signature.hex()
-        }
+        if channel is not None:
+            try:
+                return await channel.request(msg_type, payload)
+            except ChannelError as e:
+                if e.sent:
+                    # the maker may have processed it, a POST of e.g. init_swap could start a second swap
+                    logger.error(f"Swap channel failed after sending {msg_type}: {e}")
+                    return {'error': f"Swap channel failed: {e}"}
+                logger.warning(f"Swap channel closed, falling back to POST: {e}")
+        req_msg = self.signed_message(msg_type, payload)
         logger.debug(req_msg)
-        connector = ProxyConnector.from_url('socks5://127.0.0.1:9050', rdns=True)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            if not endpoint.startswith('http') and endpoint.endswith('onion'):
-                endpoint = f"http://{endpoint}"
-            async with session.post(endpoint, data=json.dumps(req_msg).encode()) as res:
-                response = await res.text()
-                logger.debug(f"Got response: {response}")
-                try:
-                    data = json.loads(response)
-                except Exception as e:
-                    logger.error(e, exc_info=True)
-                    # data = {'error': 'something went wrong'}
-                if not data.get('error') and not self.verify_signature(data):
-                    data['error'] = 'Signature verification failed'
-                return data
+        response = await self.maker_sessions.post(endpoint, json.dumps(req_msg).encode())
+        logger.debug(f"Got response: {response}")
+        try:
+            data = json.loads(response)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            return {'error': 'Invalid response from maker'}
+        if not data.get('error') and not await self.async_verify_signature(data):
+            data['error'] = 'Signature verification failed'
+        return data
+
+    async def close(self):
+        self.quotes.close()
+        await self.maker_sessions.close()
 
 
 async def main():
     taker = Taker(output_address='kaspa:qr2y4cg72p09fhpwfs3dxudwz5duxlx774ejwvwgvr9yf5p4a8edzdrt50e8q')
     await taker.sat2kas(1)
     # await taker.kas2sat(1)
+    await taker.close()
+
 
 if __name__ == '__main__':
-    import asyncio
     asyncio.run(main())
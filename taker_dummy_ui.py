@@ -46,18 +46,40 @@ async def draw_amount_selection_page(stdscr, swap_type, offer):
     price, min_amt, max_amt, endpoint = offer
     if not (min_amt <= amount <= max_amt):
         stdscr.addstr(3, 1, f"Amount not in range {min_amt}-{max_amt}")
+        plan = node1.fill_plan(swap_type, amount)
+        if not plan.complete:
+            stdscr.refresh()
+            await asyncio.sleep(2)
+            return
+        stdscr.addstr(4, 1, f"The orderbook fills {amount} KAS across {len(plan.makers)} makers "
+                            f"at {plan.vwap:.2f} on average")
+        stdscr.addstr(5, 1, 'Press Enter to split the swap across makers, ESC to go back')
         stdscr.refresh()
-        await asyncio.sleep(2)
+        x = stdscr.getch()
+        while x not in (27, ord('\n')):
+            await asyncio.sleep(0.1)
+            x = stdscr.getch()
+        if x == ord('\n'):
+            await split_swap_page(stdscr, swap_type, plan)
         return
     logging.info(f"Price: {price}, min-max: {min_amt}-{max_amt}, endpoint: {endpoint}")
     price = float(price)
     p2p_price = math.floor(price) if swap_type == 'kas2sat' else math.ceil(price)
     res, valid_until = await node1.swapnode.query_price(swap_type, kas_amount=0, p2p_price=p2p_price, endpoint=endpoint)
     logging.info(res)
-    node1.swapnode.maker_endpoint = endpoint
     x = stdscr.getch()
     swap_result = None
-    while x != 27:
+    swap_task = None
+    swap_finished = False
+    # the swap runs as a task, the p2p node and the UI keep running while it waits for the chain
+    while x != 27 or (swap_task and not swap_task.done()):
+        if swap_task and swap_task.done() and not swap_finished:
+            swap_finished = True
+            try:
+                swap_result = swap_task.result()
+            except Exception as e:
+                logging.error(e, exc_info=True)
+                swap_result = f"error ({e})"
         stdscr.clear()
         stdscr.addstr(1, 3, swap_type)
         if swap_type == 'sat2kas':
@@ -65,9 +87,12 @@ async def draw_amount_selection_page(stdscr, swap_type, offer):
         else:
             swap_info_text = f"Swapping {amount} KAS for {int(amount * res[0])} sats"
         stdscr.addstr(2, 1, swap_info_text)
-        if swap_result is None:
+        if swap_task is None:
             stdscr.addstr(3, 1, f"Offer valid for {int(valid_until - time.time())} seconds")
             stdscr.addstr(5, 1, "Press Enter to confirm swap, R to refresh, ESC to go back")
+        elif not swap_finished:
+            stdscr.addstr(3, 1, 'Offer accepted')
+            stdscr.addstr(7, 1, f"Swap started! Please wait... ({int(time.time() - swap_start)}s)")
         else:
             stdscr.addstr(3, 1, 'Offer accepted')
             stdscr.addstr(5, 1, ' ' * 60)
@@ -77,18 +102,13 @@ async def draw_amount_selection_page(stdscr, swap_type, offer):
             stdscr.addstr(9, 1, f"Swap completed/failed: {swap_result}")
             stdscr.addstr(10, 1, 'Check logs for more details')
         stdscr.refresh()
-        if x == ord('\n'):
-            stdscr.addstr(3, 1, 'Offer accepted' + ' ' * 20)
-            stdscr.addstr(5, 1, ' ' * 60)
-            stdscr.addstr(7, 1, f"Swap started! Please wait...")
-            stdscr.refresh()
-            if swap_type == 'sat2kas':
-                swap_result = await node1.swapnode.sat2kas(kas_amount=amount, price=res[0])
-            else:
-                swap_result = await node1.swapnode.kas2sat(kas_amount=amount, price=res[0])
+        if x == ord('\n') and swap_task is None:
+            swap_start = time.time()
+            swap_task = node1.swapnode.start_swap(swap_type, amount, price=res[0], maker_endpoint=endpoint).task
             valid_until = 0
-        elif x == ord('r'):
-            res, valid_until = await node1.swapnode.query_price(swap_type, kas_amount=0, p2p_price=p2p_price, endpoint=endpoint)
+        elif x == ord('r') and swap_task is None:
+            res, valid_until = await node1.swapnode.query_price(swap_type, kas_amount=0, p2p_price=p2p_price,
+                                                                endpoint=endpoint, refresh=True)
         elif x == curses.ERR:
             await asyncio.sleep(0.1)
 
@@ -97,6 +117,37 @@ async def draw_amount_selection_page(stdscr, swap_type, offer):
         x = stdscr.getch()
 
 
+async def split_swap_page(stdscr, swap_type, plan):
+    swap_start = time.time()
+    split_task = asyncio.create_task(node1.swapnode.split_swap(swap_type, plan.legs, node1.spare_legs(plan)))
+    x = stdscr.getch()
+    while x != 27 or not split_task.done():
+        stdscr.clear()
+        stdscr.addstr(1, 3, swap_type)
+        stdscr.addstr(2, 1, f"Splitting {plan.amount} KAS across {len(plan.makers)} makers")
+        if not split_task.done():
+            running = len(node1.swapnode.swaps)
+            stdscr.addstr(4, 1, f"{running} swaps running, please wait... ({int(time.time() - swap_start)}s)")
+        else:
+            try:
+                completed, unfilled = split_task.result()
+                stdscr.addstr(4, 1, f"Swapped {plan.amount - unfilled} of {plan.amount} KAS "
+                                    f"in {len(completed)} swaps")
+            except Exception as e:
+                logging.error(e, exc_info=True)
+                stdscr.addstr(4, 1, f"Split swap failed: {e}")
+            stdscr.addstr(5, 1, 'Press ESC to go back, check logs for more details')
+        stdscr.refresh()
+        await asyncio.sleep(0.1)
+        x = stdscr.getch()
+
+
+async def load_book():
+    # numeric price levels, best first, the snapshot is only rebuilt when the book changed
+    snapshot = await node1.orderbook_snapshot()
+    return snapshot['kas2sat'], snapshot['sat2kas']
+
+
 async def draw_orderbook_page(stdscr, bids, asks, selected_position, selected_box, bid_box, ask_box, max_row):
     stdscr.clear()
 
@@ -115,7 +166,8 @@ async def draw_orderbook_page(stdscr, bids, asks, selected_position, selected_bo
     stdscr.addstr(2, 5, 'price  amount (min-max)')
     stdscr.addstr(2, 37, 'price  amount (min-max)')
 
-    for i, (bid, ask) in enumerate(zip(bids, asks), start=1):
+    for i, (bid_level, ask_level) in enumerate(zip(bids, asks), start=1):
+        bid, ask = node1.format_level(bid_level), node1.format_level(ask_level)
         if i == selected_position:
             if selected_box == 1:
                 bid_box.addstr(i, 2, f"{bid}", selected_text)
@@ -140,19 +192,18 @@ async def draw_orderbook_page(stdscr, bids, asks, selected_position, selected_bo
     ask_box.refresh()
 
 
-async def load_offers(swap_type, p2p_price):
-    servers = node1.orderbook[swap_type][p2p_price]
+async def load_offers(swap_type, p2p_price, stdscr=None):
+    servers = node1.orderbook.makers(swap_type, p2p_price)
     endpoints = [s['payload']['onion'] for s in servers]
     logging.info(f"endpoints: {endpoints}")
 
-    tasks = [node1.swapnode.query_price(swap_type, 0, p2p_price, endpoint) for endpoint in endpoints]
-    results = await asyncio.gather(*tasks)
-
+    # quotes arrive as makers answer, dead makers are dropped at the deadline
     offers = []
-    for endpoint, result in zip(endpoints, results):
-        if result:
-            res, valid_until = result
-            offers.append((res[0], res[1], res[2], endpoint))
+    async for endpoint, (res, valid_until) in node1.swapnode.collect_quotes(swap_type, endpoints, 0, p2p_price):
+        offers.append((res[0], res[1], res[2], endpoint))
+        if stdscr is not None:
+            stdscr.addstr(6, 5, f"{len(offers)}/{len(endpoints)} offers received")
+            stdscr.refresh()
     offers = list(sorted(offers, key=lambda x: x[0], reverse=(True if swap_type == 'kas2sat' else False)))
     return offers
 
@@ -166,7 +217,7 @@ async def offers_screen(stdscr, swap_type, p2p_price):
     stdscr.addstr(5, 5, f"Loading offers for {p2p_price}")
     stdscr.refresh()
 
-    offers = await load_offers(swap_type, p2p_price)
+    offers = await load_offers(swap_type, p2p_price, stdscr)
     offers_len = len(offers)
     stdscr.clear()
     stdscr.refresh()
@@ -237,7 +288,7 @@ async def offers_screen(stdscr, swap_type, p2p_price):
 async def orderbook_screen(stdscr):
     stdscr.clear()
 
-    bids, asks = await node1.render_orderbook(return_bidask=True)
+    bids, asks = await load_book()
 
     max_row = 8
 
@@ -268,20 +319,20 @@ async def orderbook_screen(stdscr):
             if selected_box == 2:
                 selected_box = 1
         elif x == ord('\n'):
-            offer = bids[selected_position - 1] if selected_box == 1 else asks[selected_position - 1]
-            p2p_price = int(offer.strip().split()[0])
+            level = bids[selected_position - 1] if selected_box == 1 else asks[selected_position - 1]
+            p2p_price = level.price
             swap_type = 'sat2kas' if selected_box == 2 else 'kas2sat'
             await offers_screen(stdscr, swap_type, p2p_price)
             stdscr.clear()
-            bids, asks = await node1.render_orderbook(return_bidask=True)
+            bids, asks = await load_book()
             row_num = min(len(bids), len(asks), max_row)
         elif x == ord('r'):
-            bids, asks = await node1.render_orderbook(return_bidask=True)
+            bids, asks = await load_book()
             row_num = min(len(bids), len(asks), max_row)
         elif x == curses.ERR:
             refresh_counter += 1
             if refresh_counter == 50:
-                bids, asks = await node1.render_orderbook(return_bidask=True)
+                bids, asks = await load_book()
                 row_num = min(len(bids), len(asks), max_row)
                 refresh_counter = 0
             await asyncio.sleep(0.1)
@@ -307,9 +358,10 @@ async def main():
         stdscr.addstr(5, 5, f"Waiting for orderbook offers")
         stdscr.refresh()
         await asyncio.sleep(1)
-        bids, asks = await node1.render_orderbook(return_bidask=True)
+        bids, asks = await load_book()
 
     await orderbook_screen(stdscr)
+    await node1.swapnode.close()
 
     curses.endwin()
 
@@ -77,3 +77,4 @@ if confirm_swap == '' or confirm_swap.lower() == 'y':
     print(f"\nSwap result: {result}")
 else:
     print('Goodbye!')
+loop.run_until_complete(taker.close())
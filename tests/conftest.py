@@ -0,0 +1,81 @@
+import json
+import hashlib
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from swapper.taker import Taker
+
+MAKER_PUBKEY = '02' + '33' * 32
+
+
+class TakerWallet:
+    pass
+
+
+class StubCounterparty:
+    # Counterparty without wallet file, node or db: keys are derived from a hash of the index,
+    # messages are "signed" by the stub and verification only checks the pubkey
+    wallet_db_table = TakerWallet
+    keep_unlocked = True
+    pubkey = MAKER_PUBKEY
+
+    def __init__(self):
+        self.wallet = SimpleNamespace(id=1, address_counter=0)
+        self.derived_on = set()
+
+    def get_session(self):
+        return self
+
+    async def unlock_wallet(self):
+        return self
+
+    def release_session(self):
+        pass
+
+    def get_next_pubkey(self, n_key=0):
+        self.derived_on.add(threading.current_thread())
+        return hashlib.sha256(n_key.to_bytes(4, 'little')).digest()
+
+    @staticmethod
+    def signed_message(msg_type, payload):
+        return {'type': msg_type, 'payload': payload, 'pubkey': MAKER_PUBKEY, 'signature': '00'}
+
+    @staticmethod
+    async def async_verify_signature(data):
+        return data.get('pubkey') == MAKER_PUBKEY
+
+
+class StubSessions:
+    # MakerSessionPool answering every POST with an error, the posted messages are recorded
+    def __init__(self):
+        self.posted = []
+
+    async def post(self, endpoint, data):
+        self.posted.append(json.loads(data))
+        return json.dumps({'error': 'stub maker'})
+
+
+@pytest.fixture
+def stub_counterparty():
+    return StubCounterparty()
+
+
+@pytest.fixture
+def stub_taker(stub_counterparty):
+    # Taker without wallet, db or Tor: quotes maps endpoint -> query_price result
+    def make_taker(quotes=None):
+        taker = Taker.__new__(Taker)
+        taker.maker_endpoint = 'maker.onion'
+        taker.maker_sessions = StubSessions()
+        taker.no_channel = {}
+        taker.signed_message = stub_counterparty.signed_message
+        taker.async_verify_signature = stub_counterparty.async_verify_signature
+
+        async def query_price(swap_type, kas_amount=0, p2p_price=None, endpoint=None, refresh=False):
+            return (quotes or {}).get(endpoint, False)
+
+        taker.query_price = query_price
+        return taker
+    return make_taker
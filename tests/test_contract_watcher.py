@@ -0,0 +1,85 @@
+import asyncio
+
+from klib.krpc import KaspaRpcClient
+from swapper.contract_watcher import ContractWatcher
+from wrpc_standin import StandInKaspad, utxo_entry
+
+ADDRESS = 'kaspa:pzhh76qc82wzduvsrd9xh4zde9qhp0xc8rl7qu2mvl2e42uvdqt75zrcgpm00'
+TX_ID = 'a449ba289c7d7ef8641eb110deead0e334b685a2aafff836321b88851bbba11f'
+
+
+def run_with_watcher(test):
+    async def runner():
+        server = StandInKaspad()
+        await server.start()
+        client = KaspaRpcClient(server.url, request_timeout=5)
+        watcher = ContractWatcher(client, poll_interval=0.05, resync_interval=0.05)
+        try:
+            await test(server, watcher)
+        finally:
+            for address in list(watcher.registrations):
+                watcher.registrations[address] = 1
+                await watcher.unregister(address)
+            await client.close()
+            await server.stop()
+    asyncio.run(runner())
+
+
+def test_failed_fetch_is_unknown_not_empty():
+    async def test(server, watcher):
+        server.fail_methods.add('getUtxosByAddresses')
+        await watcher.register(ADDRESS)
+        assert ADDRESS in watcher.registrations
+        assert watcher.get_utxos(ADDRESS) is None
+        # a removal notification can't turn the unknown set into an empty one
+        entry = utxo_entry(ADDRESS, TX_ID, 100000000)
+        await server.push_utxos_changed(removed=[entry])
+        await asyncio.sleep(0.1)
+        assert watcher.get_utxos(ADDRESS) is None
+
+        server.fail_methods.clear()
+        server.utxos[ADDRESS] = [entry]
+        assert await watcher.wait_change(ADDRESS, timeout=5)
+        assert [utxo['outpoint']['transactionId'] for utxo in watcher.get_utxos(ADDRESS)] == [TX_ID]
+    run_with_watcher(test)
+
+
+def test_fetched_empty_set_is_empty():
+    async def test(server, watcher):
+        await watcher.register(ADDRESS)
+        assert watcher.get_utxos(ADDRESS) == []
+    run_with_watcher(test)
+
+
+def test_nested_registrations_keep_the_address_watched():
+    async def test(server, watcher):
+        await watcher.register(ADDRESS)
+        async with watcher.watch(ADDRESS):
+            assert watcher.registrations[ADDRESS] == 2
+        # the inner holder is gone, the outer one still gets notifications and a cache
+        assert server.subscriptions == {ADDRESS}
+        assert watcher.get_utxos(ADDRESS) == []
+        await server.push_utxos_changed(added=[utxo_entry(ADDRESS, TX_ID, 100000000)])
+        assert await watcher.wait_change(ADDRESS, timeout=5)
+        assert len(watcher.get_utxos(ADDRESS)) == 1
+
+        await watcher.unregister(ADDRESS)
+        assert ADDRESS not in watcher.registrations
+        assert watcher.get_utxos(ADDRESS) is None
+        assert server.subscriptions == set()
+    run_with_watcher(test)
+
+
+def test_poke_refreshes_now():
+    async def test(server, watcher):
+        watcher.poll_interval = watcher.resync_interval = 60
+        await watcher.register(ADDRESS)
+        server.utxos[ADDRESS] = [utxo_entry(ADDRESS, TX_ID, 100000000)]
+        watcher.poke(ADDRESS)
+        watcher.poke('kaspa:unwatched')
+        assert len(watcher.pokes) == 1
+        assert await watcher.wait_change(ADDRESS, timeout=5)
+        assert len(watcher.get_utxos(ADDRESS)) == 1
+        await asyncio.sleep(0.05)
+        assert watcher.pokes == set()
+    run_with_watcher(test)
@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+
+from klib.schnorr_fast import pubkey_gen
+from swapper.counterparty import Counterparty
+
+NODE_PRIVKEY = bytes(31) + b'\x07'
+
+
+def node():
+    # Counterparty without wallet: only the node key is used to sign messages
+    counterparty = Counterparty.__new__(Counterparty)
+    counterparty.node_privkey = NODE_PRIVKEY
+    counterparty.node_pubkey = pubkey_gen(NODE_PRIVKEY)
+    return counterparty
+
+
+def signed(**fields):
+    return {**node().signed_message('init_swap', {'kas_amount': 10}), **fields}
+
+
+@pytest.mark.parametrize('msg', [
+    ['init_swap'],
+    '{"type": "init_swap"',
+    {key: value for key, value in signed().items() if key != 'type'},
+    {key: value for key, value in signed().items() if key != 'payload'},
+    signed(type=['init_swap']),
+    signed(signature=None),
+    signed(pubkey='not hex'),
+    signed(pubkey='00'),
+    signed(payload={'kas_amount': 11}),
+])
+def test_malformed_messages_are_rejected(msg):
+    assert not node().verify_signature(msg)
+    assert not asyncio.run(node().async_verify_signature(msg))
+
+
+def test_signed_message_verifies():
+    assert node().verify_signature(signed())
+    assert asyncio.run(node().async_verify_signature(signed()))
@@ -0,0 +1,58 @@
+import random
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from db.models import db, WalletKey
+from swapper.counterparty import Counterparty
+from swapper.keypool import KeyPool
+
+
+@pytest.fixture
+def keypool_db(tmp_path):
+    path = db.database
+    db.close()
+    db.init(str(tmp_path / 'satkas.db'), timeout=10)
+    db.connect()
+    db.create_tables([WalletKey])
+    yield
+    db.close()
+    db.init(path, timeout=10)
+    db.connect()
+
+
+def test_concurrent_reservations_share_refills(keypool_db, stub_counterparty):
+    counterparty = stub_counterparty
+
+    async def reserve_many():
+        keypool = KeyPool(counterparty, size=4)
+        counterparty.derived_on.clear()
+        return await asyncio.gather(*[keypool.async_reserve() for _ in range(10)])
+
+    keys = asyncio.run(reserve_many())
+    # every refill ran in a worker thread, never on the event loop
+    assert threading.main_thread() not in counterparty.derived_on
+    indices = [key.key_index for key in keys]
+    assert len(set(indices)) == 10
+    assert WalletKey.select().count() == len(set(WalletKey.select(WalletKey.key_index).tuples()))
+
+
+def test_address_counter_never_moves_back(stub_counterparty):
+    saved = []
+    counterparty = Counterparty.__new__(Counterparty)
+    counterparty.counter_lock = threading.RLock()
+    counterparty.keep_unlocked = True
+    counterparty.wallet = SimpleNamespace(address_counter=0)
+    counterparty.wallet.save = lambda: saved.append(counterparty.wallet.address_counter)
+    counterparty.get_next_pubkey = lambda: stub_counterparty.get_next_pubkey(counterparty.wallet.address_counter + 1)
+
+    async def release_all(indices):
+        await asyncio.gather(*[asyncio.to_thread(counterparty.advance_address_counter, i) for i in indices])
+
+    indices = list(range(1, 51))
+    random.shuffle(indices)
+    asyncio.run(release_all(indices))
+    assert counterparty.wallet.address_counter == 50
+    assert saved == sorted(saved)
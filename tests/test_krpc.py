@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from klib.krpc import KaspaRpcClient, KaspaRpcError
+from klib.kdatatype import Transaction, Input, Output, OutPoint, UtxoEntry, ScriptPublicKey
+from klib.serialization import gen_rpc_transaction_dict
+from wrpc_standin import StandInKaspad, utxo_entry
+
+ADDRESS = 'kaspa:qpauqsvk7yf9unexwmxsnmg547mhyga37csh0kj53q6xxgl24ydxjsgzthw5j'
+TX_ID = 'a449ba289c7d7ef8641eb110deead0e334b685a2aafff836321b88851bbba11f'
+
+
+def run_with_server(test):
+    async def runner():
+        server = StandInKaspad()
+        await server.start()
+        client = KaspaRpcClient(server.url, request_timeout=5)
+        try:
+            await test(server, client)
+        finally:
+            await client.close()
+            await server.stop()
+    asyncio.run(runner())
+
+
+def spend_transaction():
+    script = bytes.fromhex('20' + '22' * 32 + 'ac')
+    tx_input = Input(OutPoint(TX_ID, 1), UtxoEntry(500000000, ScriptPublicKey(0, script), 1000, False), 1,
+                     signature_script=b'\x41' + bytes(65))
+    return Transaction([tx_input], [Output(499900000, ScriptPublicKey(0, script))])
+
+
+def test_get_utxos_by_addresses_normalizes_entries():
+    async def test(server, client):
+        server.utxos[ADDRESS] = [utxo_entry(ADDRESS, TX_ID, 100000000)]
+        entries = await client.get_utxos_by_addresses([ADDRESS])
+        assert len(entries) == 1
+        assert entries[0]['outpoint'] == {'transactionId': TX_ID, 'index': 0}
+        assert entries[0]['utxoEntry']['scriptPublicKey'] == {'version': 0, 'scriptPublicKey': '20' + '11' * 32 + 'ac'}
+        assert await client.get_utxos_by_addresses(['kaspa:unknown']) == []
+    run_with_server(test)
+
+
+def test_submit_transaction_sends_wrpc_layout():
+    async def test(server, client):
+        rpc_tx = gen_rpc_transaction_dict(spend_transaction())
+        tx_id = await client.submit_transaction(rpc_tx)
+        submitted, = server.submitted
+        assert tx_id and len(tx_id) == 64
+        assert submitted['outputs'] == [{'value': 499900000, 'scriptPublicKey': '000020' + '22' * 32 + 'ac'}]
+        assert submitted['inputs'] == rpc_tx['inputs']
+        assert submitted['mass'] == 0
+    run_with_server(test)
+
+
+def test_submit_transaction_error():
+    async def test(server, client):
+        server.reject_transactions = 'transaction is already in the mempool'
+        with pytest.raises(KaspaRpcError, match='already in the mempool'):
+            await client.submit_transaction(gen_rpc_transaction_dict(spend_transaction()))
+    run_with_server(test)
+
+
+def test_utxos_changed_notifications():
+    async def test(server, client):
+        changes = asyncio.Queue()
+        callback = lambda address, added, removed: changes.put_nowait((address, added, removed))
+        await client.subscribe_utxos_changed([ADDRESS], callback)
+        assert server.subscriptions == {ADDRESS}
+
+        entry = utxo_entry(ADDRESS, TX_ID, 100000000)
+        await server.push_utxos_changed(added=[entry])
+        address, added, removed = await asyncio.wait_for(changes.get(), 5)
+        assert address == ADDRESS and removed == []
+        assert added[0]['utxoEntry']['scriptPublicKey']['scriptPublicKey'] == '20' + '11' * 32 + 'ac'
+
+        await server.push_utxos_changed(removed=[entry])
+        address, added, removed = await asyncio.wait_for(changes.get(), 5)
+        assert added == [] and removed[0]['outpoint']['transactionId'] == TX_ID
+
+        await client.unsubscribe_utxos_changed([ADDRESS], callback)
+        assert server.subscriptions == set()
+    run_with_server(test)
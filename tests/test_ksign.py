@@ -0,0 +1,174 @@
+import os
+import random
+import struct
+import hashlib
+import concurrent.futures
+
+import pytest
+
+from klib import ksign
+from klib.kdatatype import (SigHashType, OutPoint, ScriptPublicKey, UtxoEntry, Input, Output, Transaction,
+                            SighashReusedValues)
+from klib.ksign import VerificationCache, SigningContext, calculate_signature_hash
+from klib.schnorr_fast import pubkey_gen
+
+
+def signed_hash():
+    priv_key, msg_hash = os.urandom(32), os.urandom(32)
+    return ksign.sign_hash(msg_hash, priv_key), msg_hash, pubkey_gen(priv_key)
+
+
+def test_cache_counters_and_eviction():
+    cache = VerificationCache(size=2)
+    assert not cache.check('a')
+    cache.add('a')
+    cache.add('b')
+    assert cache.check('a') and cache.check('a')
+    # b is now the least recently used
+    cache.add('c')
+    assert not cache.check('b')
+    assert cache.check('c') and cache.check('a')
+    assert cache.stats() == {'size': 2, 'hits': 4, 'misses': 2}
+    cache.clear()
+    assert cache.stats() == {'size': 0, 'hits': 0, 'misses': 0}
+    assert not cache.check('a')
+
+
+def test_verify_signature_caches_valid_signatures_only(monkeypatch):
+    cache = VerificationCache(size=8)
+    monkeypatch.setattr(ksign, 'verify_cache', cache)
+    signature, msg_hash, pubkey = signed_hash()
+    assert ksign.verify_signature(signature, msg_hash, pubkey)
+    assert ksign.verify_signature(signature, msg_hash, pubkey)
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+    forged = bytes(64)
+    assert not ksign.verify_signature(forged, msg_hash, pubkey)
+    assert not ksign.verify_signature(forged, msg_hash, pubkey)
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 3}
+
+    assert ksign.verify_signature(signature, msg_hash, pubkey, check_cache=False)
+    assert cache.stats()['hits'] == 1
+
+    other = signed_hash()
+    assert ksign.verify_signatures([(signature, msg_hash, pubkey), other, (forged, msg_hash, pubkey)]) == [
+        True, True, False]
+    assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 5}
+
+
+def sample_transaction(subnetwork_id=0, payload=b''):
+    spk = [ScriptPublicKey(0, bytes.fromhex('20' + f"{i:02x}" * 32 + 'ac')) for i in range(3)]
+    inputs = [Input(OutPoint(f"{i + 1:02x}" * 32, i), UtxoEntry(1000 * (i + 1), spk[i], 10, False), i, bytes([i + 1]))
+              for i in range(3)]
+    outputs = [Output(1500, spk[0]), Output(4400, ScriptPublicKey(1, spk[1].script[:10]))]
+    return Transaction(inputs, outputs, version=1, locktime=7, subnetwork_id=subnetwork_id, gas=0, payload=payload)
+
+
+def baseline_signature_hash(tx, idx, hashtype):
+    # field by field, the way calculate_signature_hash wrote it before SigningContext
+    def writer():
+        return hashlib.blake2b(key=b'TransactionSigningHash', digest_size=32)
+
+    def spk_fields(spk):
+        return struct.pack('<H', spk.version) + struct.pack('<Q', len(spk.script)) + bytes(spk.script)
+
+    def output_fields(tx_output):
+        return struct.pack('<Q', tx_output.value) + spk_fields(tx_output.script_public_key)
+
+    def digest(*fields):
+        hash_writer = writer()
+        for field in fields:
+            hash_writer.update(field)
+        return hash_writer.digest()
+
+    anyone_can_pay = hashtype.is_sig_hash_anyone_can_pay()
+    single, none = hashtype.is_sig_hash_single(), hashtype.is_sig_hash_none()
+    txin = tx.inputs[idx]
+    previous_outputs = bytes(32) if anyone_can_pay else digest(
+        *(bytes.fromhex(i.previous_outpoint.tx_id) + struct.pack('<I', i.previous_outpoint.index) for i in tx.inputs))
+    sequences = bytes(32) if single or anyone_can_pay or none else digest(
+        *(struct.pack('<Q', i.sequence) for i in tx.inputs))
+    sig_op_counts = bytes(32) if anyone_can_pay else digest(*(i.sig_op_count for i in tx.inputs))
+    if none:
+        outputs = bytes(32)
+    elif single:
+        outputs = digest(output_fields(tx.outputs[idx])) if idx < len(tx.outputs) else bytes(32)
+    else:
+        outputs = digest(*(output_fields(o) for o in tx.outputs))
+    payload = bytes(32) if tx.subnetwork_id == 0 else digest(tx.payload)
+    subnetwork_id = bytearray(20)
+    subnetwork_id[0] = tx.subnetwork_id
+    return digest(struct.pack('<H', tx.version), previous_outputs, sequences, sig_op_counts,
+                  bytes.fromhex(txin.previous_outpoint.tx_id), struct.pack('<I', txin.previous_outpoint.index),
+                  spk_fields(txin.utxo_entry.script_public_key),
+                  struct.pack('<Q', txin.utxo_entry.amount), struct.pack('<Q', txin.sequence), txin.sig_op_count,
+                  outputs, struct.pack('<Q', tx.locktime), bytes(subnetwork_id), struct.pack('<Q', tx.gas),
+                  payload, struct.pack('<B', hashtype.flag))
+
+
+HASH_TYPES = [0x01, 0x02, 0x04, 0x81, 0x82, 0x84]
+
+
+@pytest.mark.parametrize('tx', [sample_transaction(), sample_transaction(subnetwork_id=2, payload=b'\x01\x02')])
+def test_signing_context_matches_the_baseline(tx):
+    # one context for every input and hash type, the cached prefixes and sub-hashes must not leak between them
+    signing_context = SigningContext(tx)
+    for flag in HASH_TYPES:
+        for idx in range(len(tx.inputs)):
+            expected = baseline_signature_hash(tx, idx, SigHashType(flag))
+            assert signing_context.signature_hash(idx, SigHashType(flag)) == expected, (flag, idx)
+            assert calculate_signature_hash(tx, idx, tx.inputs[idx], tx.inputs[idx].utxo_entry.script_public_key,
+                                            SigHashType(flag), SighashReusedValues()) == expected
+    assert len({signing_context.signature_hash(0, SigHashType(flag)) for flag in HASH_TYPES}) == len(HASH_TYPES)
+
+
+def many_inputs_transaction(count):
+    spk = ScriptPublicKey(0, bytes.fromhex('20' + '11' * 32 + 'ac'))
+    inputs = [Input(OutPoint(f"{i:064x}", i), UtxoEntry(1000 + i, spk, 10, False)) for i in range(count)]
+    return Transaction(inputs, [Output(1000, spk)])
+
+
+def signature_checker(tx, priv_keys, hashtype):
+    signing_context = SigningContext(tx)
+
+    def check(idx, signature):
+        assert signature[-1] == hashtype.flag
+        return ksign.verify_signature(signature[:-1], signing_context.signature_hash(idx, hashtype),
+                                      pubkey_gen(priv_keys[idx]), check_cache=False)
+    return check
+
+
+@pytest.mark.parametrize('count', [ksign.PARALLEL_SIGN_MIN_INPUTS - 1, ksign.SIGN_CHUNK_SIZE * 2 + 3])
+def test_sign_inputs_parallel_matches_serial(count, monkeypatch):
+    tx = many_inputs_transaction(count)
+    priv_keys = [os.urandom(32) for _ in range(count)]
+    keys = [(idx, priv_keys[idx]) for idx in random.Random(count).sample(range(count), count)]
+    hashtype = SigHashType(0x01)
+    check = signature_checker(tx, priv_keys, hashtype)
+
+    # sizes of the batches handed to sign_hashes, the pool threads finish them in any order
+    chunks = []
+    sign_hashes = ksign.sign_hashes
+
+    def counting_sign_hashes(items):
+        chunks.append(len(items))
+        return sign_hashes(items)
+    monkeypatch.setattr(ksign, 'sign_hashes', counting_sign_hashes)
+    split = sorted(min(ksign.SIGN_CHUNK_SIZE, count - start) for start in range(0, count, ksign.SIGN_CHUNK_SIZE))
+
+    serial = [SigningContext(tx).sign_input(idx, hashtype, priv_key) for idx, priv_key in keys]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        pooled = ksign.sign_inputs(tx, keys, executor=executor)
+    assert sorted(chunks) == split
+    chunks.clear()
+    default = ksign.sign_inputs(tx, keys)
+    # below PARALLEL_SIGN_MIN_INPUTS everything is signed in one call in the calling thread
+    assert sorted(chunks) == ([count] if count < ksign.PARALLEL_SIGN_MIN_INPUTS else split)
+
+    for signatures in (serial, pooled, default):
+        assert len(signatures) == count
+        assert all(check(idx, signature) for (idx, _), signature in zip(keys, signatures))
+
+    scripts = ksign.sign_inputs(tx, keys, script_builder=lambda idx, signature: (idx, signature))
+    assert [idx for idx, _ in scripts] == [idx for idx, _ in keys]
+    assert all(check(idx, signature) for idx, signature in scripts)
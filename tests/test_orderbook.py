@@ -0,0 +1,64 @@
+import random
+
+from p2p.orderbook import IntervalTree, OrderBook, PriceLevel
+from p2p.p2p_node import Node
+
+
+def offer(price, min_amount, max_amount):
+    return {'price': price, 'min_amount': min_amount, 'max_amount': max_amount}
+
+
+def server(sat2kas=(), kas2sat=()):
+    return {'transport': None, 'last_ping': 0, 'payload': {'sat2kas': list(sat2kas), 'kas2sat': list(kas2sat)}}
+
+
+def test_stab_matches_a_linear_scan():
+    rng = random.Random(13)
+    tree = IntervalTree()
+    intervals = []
+    for i in range(300):
+        start = rng.randint(0, 1000)
+        key = (start, start + rng.randint(0, 200), i)
+        tree.insert(key, i)
+        intervals.append(key)
+    for key in rng.sample(intervals, 100):
+        assert tree.remove(key)
+        intervals.remove(key)
+    assert not tree.remove((-1, -1, -1))
+    assert len(tree) == 200
+    for x in [-1, 0, 1, 500, 999, 1000, 1200, 1201] + [rng.randint(0, 1200) for _ in range(50)]:
+        assert sorted(key for key, _ in tree.stab(x)) == sorted(key for key in intervals if key[0] <= x <= key[1])
+
+
+def test_fillable_follows_maker_updates():
+    book = OrderBook()
+    book.update_maker('a', server(sat2kas=[offer(100, 10, 50), offer(101, 40, 500)]))
+    book.update_maker('b', server(sat2kas=[offer(99, 60, 100)], kas2sat=[offer(90, 1, 1000)]))
+    assert list(book.fillable('sat2kas', 45)) == [100, 101]
+    assert list(book.fillable('sat2kas', 80)) == [99, 101]
+    assert list(book.fillable('kas2sat', 80)) == [90]
+
+    book.update_maker('a', server(sat2kas=[offer(102, 10, 50)]))
+    assert list(book.fillable('sat2kas', 45)) == [102]
+    book.remove_maker('b')
+    assert book.fillable('sat2kas', 80) == {} and book.fillable('kas2sat', 80) == {}
+
+
+def test_snapshot_levels_best_first():
+    book = OrderBook()
+    book.update_maker('a', server(sat2kas=[offer(100, 10, 50)], kas2sat=[offer(90, 5, 20)]))
+    book.update_maker('b', server(sat2kas=[offer(100, 20, 80), offer(98, 1, 10)], kas2sat=[offer(95, 30, 40)]))
+    snapshot = book.snapshot()
+    assert snapshot['sat2kas'] == [PriceLevel(98, 10, 1, 10, ('b',)), PriceLevel(100, 130, 10, 80, ('a', 'b'))]
+    assert snapshot['kas2sat'] == [PriceLevel(95, 40, 30, 40, ('b',)), PriceLevel(90, 20, 5, 20, ('a',))]
+    assert book.snapshot() is snapshot
+
+    assert book.snapshot(selected_amount=60) == {'sat2kas': [PriceLevel(100, 80, 20, 80, ('b',))], 'kas2sat': []}
+    book.remove_maker('b')
+    assert book.snapshot()['sat2kas'] == [PriceLevel(100, 50, 10, 50, ('a',))]
+
+
+def test_format_level():
+    # the columns of the orderbook screen: price, then total and (min-max) in 18 characters
+    assert Node.format_level(PriceLevel(98, 130, 10, 80, ('a', 'b'))) == '    98     130 (10-80)   '
+    assert len(Node.format_level(PriceLevel(123456, 1234567, 1, 9, ('a',)))) == 25
@@ -0,0 +1,139 @@
+import json
+import random
+import asyncio
+
+import pytest
+
+from p2p import wire
+from p2p.p2p_node import StreamFramer, NodeConnection, MAX_UNTERMINATED_SIZE
+from p2p.taker_p2p_node import TakerNode
+
+
+def ping(msg_type='server_ping', size=3):
+    payload = {
+        'onion': 'abc.onion',
+        'sat2kas': [{'price': 1200 + i, 'min_amount': 1, 'max_amount': 10 ** 12, 'note': 'prix \u00e9'}
+                    for i in range(size)],
+        'kas2sat': [],
+        'rate': 0.0125,
+        'delta': -42,
+        'flags': [True, False, None]
+    }
+    return {'type': msg_type, 'payload': payload, 'pubkey': '11' * 32, 'signature': '22' * 64}
+
+
+def decode(frames):
+    return [json.loads(body) if flags is None else wire.decode_body(flags, body, 1024 * 1024)
+            for flags, body in frames]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('msg_type', ['server_ping', 'client_hello', 'custom_type'])
+def test_binary_round_trip(msg_type, compress):
+    msg = ping(msg_type, size=20)
+    frame = wire.encode_message(msg, compress=compress)
+    assert bool(frame[1] & wire.FLAG_ZLIB) == compress
+    decoded, = decode(StreamFramer().feed(frame))
+    assert decoded == msg
+    # the signature was made on the JSON payload, it has to decode to the same text
+    assert json.dumps(decoded['payload']) == json.dumps(msg['payload'])
+
+
+def test_unsupported_values_are_not_encoded():
+    with pytest.raises(wire.WireError):
+        wire.encode_message({**ping(), 'payload': {'key': b'bytes'}})
+    with pytest.raises(wire.WireError):
+        wire.encode_message({**ping(), 'payload': {1: 'int key'}})
+
+
+def test_negotiate():
+    assert wire.negotiate([wire.WIRE_JSON, wire.WIRE_BINARY]) == wire.WIRE_BINARY
+    assert wire.negotiate(list(wire.WIRE_VERSIONS)) == wire.WIRE_BINARY_ZLIB
+    assert wire.negotiate(None) == wire.WIRE_JSON
+    assert wire.negotiate(['bin9']) == wire.WIRE_JSON
+
+
+def test_frames_split_across_chunks():
+    messages = [ping(), ping('client_hello', size=30), ping('server_hello'), ping(size=0)]
+    stream = (wire.encode_message(messages[0]) + json.dumps(messages[1]).encode() + b'\n'
+              + wire.encode_message(messages[2], compress=True) + json.dumps(messages[3]).encode() + b'\n')
+    rng = random.Random(17)
+    for _ in range(20):
+        framer = StreamFramer()
+        frames = []
+        pos = 0
+        while pos < len(stream):
+            size = rng.choice([1, 2, 7, 64, 500])
+            frames += framer.feed(stream[pos:pos + size])
+            pos += size
+        assert decode(frames) == messages
+        assert framer.buffer == bytearray()
+
+
+def test_oversized_json_line_is_dropped():
+    framer = StreamFramer(max_frame_size=100)
+    assert framer.feed(b'{"type": "' + b'x' * 200) == []
+    assert framer.feed(b'x' * 200 + b'"}\n{"type": "ok"}\n') == [(None, b'{"type": "ok"}')]
+
+
+def test_malformed_binary_header_is_rejected():
+    framer = StreamFramer()
+    assert framer.feed(bytes([wire.MAGIC, 0]) + b'\x80' * 5) == []
+    with pytest.raises(wire.WireError, match='too long'):
+        framer.feed(b'\x80' * 10)
+
+
+def test_oversized_binary_frame_is_rejected():
+    framer = StreamFramer(max_frame_size=1000)
+    header = bytearray([wire.MAGIC, 0])
+    wire.write_varint(header, 1001)
+    with pytest.raises(wire.WireError, match='1001 bytes'):
+        framer.feed(bytes(header))
+
+
+def test_unterminated_json_is_bounded():
+    framer = StreamFramer()
+    message = {'type': 'server_ping', 'payload': {'offers': []}}
+    framer.feed(json.dumps(message).encode())
+    assert framer.take_unterminated() == message
+
+    framer.feed(json.dumps({'type': 'server_ping', 'payload': 'x' * MAX_UNTERMINATED_SIZE}).encode())
+    assert framer.take_unterminated() is None
+
+
+class StubTransport:
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def get_protocol(self):
+        return self.protocol
+
+    def close(self):
+        pass
+
+
+class StubSwapnode:
+    node_pubkey = bytes(32)
+
+    def __init__(self, valid):
+        self.valid = valid
+
+    async def async_verify_signature(self, data):
+        return self.valid
+
+
+@pytest.mark.parametrize('valid, encoding', [(False, wire.WIRE_JSON), (True, wire.WIRE_BINARY)])
+def test_only_verified_hellos_switch_the_encoding(valid, encoding):
+    async def test():
+        node = TakerNode(None, swapnode=StubSwapnode(valid))
+        connection = NodeConnection(node)
+        connection.transport = StubTransport(connection)
+        node.connected_peers[connection.transport] = connection.transport
+        hello = {'type': 'server_hello', 'payload': {'wire': wire.WIRE_BINARY}, 'pubkey': '11' * 32,
+                 'signature': '22' * 64}
+        connection.data_received(json.dumps(hello).encode() + b'\n')
+        assert connection.wire == wire.WIRE_JSON
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert connection.wire == encoding
+    asyncio.run(test())
@@ -0,0 +1,60 @@
+import pytest
+
+from p2p.orderbook import OrderBook
+from p2p.quote_engine import FillPlan, fill_plan, spare_legs
+
+
+def book(**makers):
+    # maker_id -> (side, [(price, min_amount, max_amount), ...]), endpoint <maker_id>.onion
+    orderbook = OrderBook()
+    for maker_id, (side, offers) in makers.items():
+        payload = {'onion': f"{maker_id}.onion",
+                   side: [{'price': price, 'min_amount': low, 'max_amount': high} for price, low, high in offers]}
+        orderbook.update_maker(maker_id, {'transport': None, 'last_ping': 0, 'payload': payload})
+    return orderbook
+
+
+def legs(plan):
+    return [(leg.endpoint, leg.price, leg.amount) for leg in plan.legs]
+
+
+def test_fill_takes_the_best_prices_first():
+    orderbook = book(a=('sat2kas', [(100, 1, 50)]), b=('sat2kas', [(101, 1, 100)]), c=('sat2kas', [(99, 1, 10)]))
+    plan = fill_plan(orderbook, 'sat2kas', 120)
+    assert legs(plan) == [('c.onion', 99, 10), ('a.onion', 100, 50), ('b.onion', 101, 60)]
+    assert plan.complete and plan.makers == ['c', 'a', 'b']
+    assert plan.vwap == pytest.approx((99 * 10 + 100 * 50 + 101 * 60) / 120)
+
+    plan = fill_plan(book(a=('kas2sat', [(90, 1, 50)]), b=('kas2sat', [(95, 1, 50)])), 'kas2sat', 70)
+    assert legs(plan) == [('b.onion', 95, 50), ('a.onion', 90, 20)]
+
+
+def test_fill_respects_maker_minimums():
+    # 10 KAS would be left for b, below its minimum: a gives up 10 so that b gets its 20
+    orderbook = book(a=('sat2kas', [(100, 10, 50)]), b=('sat2kas', [(101, 20, 100)]))
+    plan = fill_plan(orderbook, 'sat2kas', 60)
+    assert legs(plan) == [('a.onion', 100, 40), ('b.onion', 101, 20)]
+    assert plan.complete
+    assert all(leg.min_amount <= leg.amount <= leg.max_amount for leg in plan.legs)
+
+
+def test_partial_fills():
+    orderbook = book(a=('sat2kas', [(100, 1, 50)]), b=('sat2kas', [(101, 1, 100)]))
+    plan = fill_plan(orderbook, 'sat2kas', 500)
+    assert not plan.complete and plan.filled == 150
+
+    plan = fill_plan(orderbook, 'sat2kas', 100, max_legs=1)
+    assert legs(plan) == [('a.onion', 100, 50)] and not plan.complete
+
+    assert FillPlan(side='sat2kas', amount=10).vwap == 0
+    assert fill_plan(book(), 'sat2kas', 10).legs == []
+
+
+def test_spare_legs_are_the_unused_offers_best_first():
+    orderbook = book(a=('sat2kas', [(100, 1, 50)]), b=('sat2kas', [(101, 1, 100), (103, 5, 10)]),
+                     c=('sat2kas', [(102, 1, 100)]))
+    plan = fill_plan(orderbook, 'sat2kas', 60)
+    assert legs(plan) == [('a.onion', 100, 50), ('b.onion', 101, 10)]
+    spare = spare_legs(orderbook, plan)
+    assert [(leg.endpoint, leg.price, leg.amount, leg.min_amount, leg.max_amount) for leg in spare] == [
+        ('c.onion', 102, 0, 1, 100), ('b.onion', 103, 0, 5, 10)]
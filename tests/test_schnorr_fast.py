@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+from klib import schnorr_fast as fast
+from klib import schnorr_signature as reference
+from klib.schnorr_signature import p, n, G, point_mul, lift_x, bytes_from_int, int_from_bytes, has_even_y
+
+rng = random.Random(340)
+
+
+def random_bytes():
+    return rng.randbytes(32)
+
+
+def both_verify(msg, pubkey, sig):
+    # the fast engine and the reference agree, the common result is returned
+    result = fast.schnorr_verify(msg, pubkey, sig)
+    assert result == reference.schnorr_verify(msg, pubkey, sig)
+    return result
+
+
+@pytest.mark.parametrize('k', [1, 2, 15, 16, 2 ** 128 + 1, 2 ** 255, n - 2, n - 1])
+def test_g_mul_matches_the_reference(k):
+    assert fast.to_affine(fast.g_mul(k)) == point_mul(G, k)
+
+
+def test_sign_and_verify_match_the_reference():
+    for _ in range(4):
+        seckey, msg, aux_rand = random_bytes(), random_bytes(), random_bytes()
+        pubkey = fast.pubkey_gen(seckey)
+        assert pubkey == reference.pubkey_gen(seckey)
+        sig = fast.schnorr_sign(msg, seckey, aux_rand)
+        assert sig == reference.schnorr_sign(msg, seckey, aux_rand)
+        assert both_verify(msg, pubkey, sig)
+        assert not both_verify(random_bytes(), pubkey, sig)
+
+
+def signed():
+    seckey, msg = random_bytes(), random_bytes()
+    return seckey, msg, fast.pubkey_gen(seckey), fast.schnorr_sign(msg, seckey, random_bytes())
+
+
+def odd_r_signature(seckey, msg):
+    # s = k + e * d with a nonce whose R has an odd y, sG - eP lands on R instead of an even-y point
+    d0 = int_from_bytes(seckey)
+    P = point_mul(G, d0)
+    d = d0 if has_even_y(P) else n - d0
+    k = 1
+    while has_even_y(point_mul(G, k)):
+        k += 1
+    r = bytes_from_int(point_mul(G, k)[0])
+    e = int_from_bytes(reference.tagged_hash('BIP0340/challenge', r + bytes_from_int(P[0]) + msg)) % n
+    return r + bytes_from_int((k + e * d) % n)
+
+
+def not_on_curve():
+    x = 1
+    while lift_x(x) is not None:
+        x += 1
+    return x
+
+
+def test_invalid_signatures():
+    seckey, msg, pubkey, sig = signed()
+    invalid = {
+        'odd y of R': (pubkey, odd_r_signature(seckey, msg)),
+        'r not on the curve': (pubkey, bytes_from_int(not_on_curve()) + sig[32:]),
+        'r equal to p': (pubkey, bytes_from_int(p) + sig[32:]),
+        's equal to n': (pubkey, sig[:32] + bytes_from_int(n)),
+        'negated s': (pubkey, sig[:32] + bytes_from_int(n - int_from_bytes(sig[32:]))),
+        'pubkey not on the curve': (bytes_from_int(not_on_curve()), sig),
+        'pubkey equal to p': (bytes_from_int(p), sig),
+    }
+    valid = signed()[1:]
+    assert fast.schnorr_batch_verify([valid, (msg, pubkey, sig)])
+    for case, (bad_pubkey, bad_sig) in invalid.items():
+        assert not both_verify(msg, bad_pubkey, bad_sig), case
+        assert not fast.schnorr_batch_verify([valid, (msg, bad_pubkey, bad_sig)]), case
+
+
+def test_batch_verify():
+    items = [(msg, pubkey, sig) for _, msg, pubkey, sig in (signed() for _ in range(8))]
+    assert fast.schnorr_batch_verify(items)
+    assert fast.schnorr_batch_verify([])
+    msg, pubkey, sig = items[-1]
+    assert not fast.schnorr_batch_verify(items[:-1] + [(random_bytes(), pubkey, sig)])
+    with pytest.raises(ValueError):
+        fast.schnorr_verify(msg, pubkey[:31], sig)
@@ -0,0 +1,53 @@
+import pytest
+
+from klib import kdatatype as kdt
+from klib.krpc import wrpc_transaction
+from klib.serialization import (serialize_transaction, deserialize_transaction, transaction_id, transaction_hash,
+                                gen_rpc_transaction_dict, transaction_from_rpc_dict)
+
+TX_ID = 'a449ba289c7d7ef8641eb110deead0e334b685a2aafff836321b88851bbba11f'
+
+
+def spend_transaction(signature_script=b''):
+    script = bytes.fromhex('20' + '22' * 32 + 'ac')
+    inputs = [kdt.Input(kdt.OutPoint(TX_ID, index), None, 0, b'\x01', signature_script) for index in range(2)]
+    outputs = [kdt.Output(499900000, kdt.ScriptPublicKey(0, script)), kdt.Output(1000, kdt.ScriptPublicKey(0, script))]
+    return kdt.Transaction(inputs, outputs, payload=b'\x01\x02')
+
+
+def test_empty_transaction_vector():
+    # transaction id of the empty transaction in the rusty-kaspa hashing tests, the hash guards against regressions
+    tx = kdt.Transaction([], [])
+    assert transaction_id(tx) == '2c18d5e59ca8fc4c23d9560da3bf738a8f40935c11c162017fbf2c907b7e665c'
+    assert transaction_hash(tx) == 'c9e29784564c269ce2faaffd3487cb4684383018ace11133de082dce4bb88b0b'
+
+
+def test_binary_round_trip():
+    tx = spend_transaction(signature_script=b'\x41' + bytes(65))
+    data = serialize_transaction(tx)
+    decoded = deserialize_transaction(data)
+    assert serialize_transaction(decoded) == data
+    assert transaction_id(decoded) == transaction_id(tx)
+    assert transaction_hash(decoded) == transaction_hash(tx)
+    with pytest.raises(ValueError):
+        deserialize_transaction(data[:-1])
+    with pytest.raises(ValueError):
+        deserialize_transaction(data + b'\x00')
+
+
+def test_signing_keeps_the_transaction_id():
+    unsigned, signed = spend_transaction(), spend_transaction(signature_script=b'\x41' + bytes(65))
+    assert transaction_id(unsigned) == transaction_id(signed)
+    assert transaction_hash(unsigned) != transaction_hash(signed)
+
+
+def wrpc_transaction_dict(tx):
+    return wrpc_transaction(gen_rpc_transaction_dict(tx))
+
+
+@pytest.mark.parametrize('layout', [gen_rpc_transaction_dict, wrpc_transaction_dict])
+def test_rpc_dict_round_trip(layout):
+    tx = spend_transaction(signature_script=b'\x41' + bytes(65))
+    decoded = transaction_from_rpc_dict(layout(tx))
+    assert serialize_transaction(decoded) == serialize_transaction(tx)
+    assert decoded.tx_id == transaction_id(tx)
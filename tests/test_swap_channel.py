@@ -0,0 +1,127 @@
+import json
+import asyncio
+
+import aiohttp
+
+from swapper.session_pool import MakerSessionPool
+from swapper.swap_channel import SwapChannel, ChannelError
+from swapper.taker import TakerSwap
+
+
+def open_channel(counterparty):
+    channel = SwapChannel(counterparty, None, 'http://maker.onion')
+    channel.maker_pubkey = counterparty.pubkey
+    events = []
+    channel.add_listener(events.append)
+    return channel, events
+
+
+def test_dispatch_drops_malformed_messages(stub_counterparty):
+    async def test():
+        channel, events = open_channel(stub_counterparty)
+        for message in ['[1, 2]', '"hello"', '{"type": "unknown_event", "payload": {}}',
+                        json.dumps(stub_counterparty.signed_message('contract_funded', 'txid')),
+                        json.dumps({'type': 'contract_funded', 'payload': {}}),
+                        json.dumps({'id': [1], 'type': 'init_swap'}),
+                        json.dumps({'id': 7, 'type': 'init_swap'})]:
+            await channel.dispatch(message)
+        assert events == []
+
+        await channel.dispatch(json.dumps(stub_counterparty.signed_message('contract_funded', {'txid': 'aa'})))
+        assert [event['payload'] for event in events] == [{'txid': 'aa'}]
+
+        future = asyncio.get_running_loop().create_future()
+        channel.pending[1] = future
+        await channel.dispatch(json.dumps({'id': 1, 'type': 'init_swap', 'payload': {}}))
+        assert future.result()['error'] == 'Signature verification failed'
+    asyncio.run(test())
+
+
+class StubChannel:
+    def __init__(self, error):
+        self.error = error
+
+    async def request(self, msg_type, payload):
+        raise self.error
+
+
+def test_no_post_fallback_once_sent(stub_taker):
+    taker = stub_taker()
+    res = asyncio.run(taker.ping_maker('init_swap', {}, channel=StubChannel(ChannelError('timed out', sent=True))))
+    assert res['error'] and taker.maker_sessions.posted == []
+
+    res = asyncio.run(taker.ping_maker('init_swap', {}, channel=StubChannel(ChannelError('not connected'))))
+    assert res == {'error': 'stub maker'}
+    assert [msg['type'] for msg in taker.maker_sessions.posted] == ['init_swap']
+
+
+def test_held_sessions_are_not_evicted():
+    async def test():
+        pool = MakerSessionPool(idle_timeout=0.05)
+        try:
+            pool.hold('held.onion')
+            pool.get('idle.onion')
+            await asyncio.sleep(0.2)
+            assert list(pool.sessions) == ['http://held.onion']
+
+            pool.release('held.onion')
+            await asyncio.sleep(0.2)
+            assert pool.sessions == {}
+        finally:
+            await pool.close()
+    asyncio.run(test())
+
+
+def test_channels_do_not_take_request_slots():
+    async def test():
+        pool = MakerSessionPool(limit_per_endpoint=1)
+        try:
+            channel_sessions = {pool.hold('maker.onion'), pool.hold('maker.onion')}
+            session = pool.get('maker.onion')
+            assert len(channel_sessions) == 1 and session not in channel_sessions
+            assert session.connector.limit == 1 and channel_sessions.pop().connector.limit == 0
+            assert session.timeout.total
+        finally:
+            await pool.close()
+        assert pool.channel_sessions == {}
+    asyncio.run(test())
+
+
+def test_channel_url_of_a_bare_onion(stub_counterparty):
+    assert SwapChannel(stub_counterparty, None, 'xyz.onion').url == 'ws://xyz.onion/swap'
+    assert SwapChannel(stub_counterparty, None, 'http://xyz.onion/').url == 'ws://xyz.onion/swap'
+
+
+class NoChannelSession:
+    # maker answering the websocket upgrade with a 404
+    def __init__(self):
+        self.urls = []
+
+    async def ws_connect(self, url, **kwargs):
+        self.urls.append(url)
+        raise aiohttp.WSServerHandshakeError(None, (), status=404)
+
+
+class StubPool:
+    def __init__(self, session):
+        self.session = session
+
+    def hold(self, endpoint):
+        return self.session
+
+    def release(self, endpoint):
+        pass
+
+
+def test_maker_without_channel_is_remembered(stub_taker):
+    async def test():
+        taker = stub_taker()
+        session = NoChannelSession()
+        taker.maker_sessions = StubPool(session)
+        for endpoint in ['xyz.onion', 'http://xyz.onion']:
+            state = TakerSwap(swap_id=1, swap_type='kas2sat', kas_amount=10, maker_endpoint=endpoint)
+            async with state.exit_stack:
+                await taker.open_channel(state)
+            assert state.channel is None
+        assert session.urls == ['ws://xyz.onion/swap']
+    asyncio.run(test())
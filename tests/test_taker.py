@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from p2p.quote_engine import FillLeg
+from swapper.taker import TakerSwap
+
+
+def swap_state(swap_type='kas2sat', kas_amount=10, price=None, endpoint='maker.onion'):
+    return TakerSwap(swap_id=1, swap_type=swap_type, kas_amount=kas_amount, maker_endpoint=endpoint,
+                     p2p_price=12, price=price)
+
+
+@pytest.mark.parametrize('quote, price', [
+    ((0.0125, 1700000000), 0.0125),
+    (([0.0125, 1, 100], 1700000000), 0.0125),
+    (((0.0125, 1, 100), 1700000000), 0.0125),
+    (([0.0125, 20, 100], 1700000000), None),
+    ((['0.0125', 1, 100], 1700000000), None),
+    (({'12': [0.0125, 1, 100]}, 1700000000), None),
+    (([], 1700000000), None),
+    ((0, 1700000000), None),
+    (False, None),
+])
+def test_swap_price(quote, price, stub_taker):
+    taker = stub_taker({'maker.onion': quote})
+    assert asyncio.run(taker.swap_price(swap_state())) == price
+
+
+def test_given_price_skips_the_quote(stub_taker):
+    taker = stub_taker()
+    assert asyncio.run(taker.swap_price(swap_state(price=0.02))) == 0.02
+    assert asyncio.run(taker.swap_price(swap_state(price=[0.02, 1, 100]))) is None
+
+
+@pytest.mark.parametrize('swap_type', ['sat2kas', 'kas2sat'])
+def test_invalid_quote_never_reaches_init_swap(swap_type, stub_taker):
+    taker = stub_taker({'maker.onion': (['not a price', 1, 100], 1700000000)})
+    routine = taker.run_sat2kas if swap_type == 'sat2kas' else taker.run_kas2sat
+    assert not asyncio.run(routine(swap_state(swap_type)))
+    assert taker.maker_sessions.posted == []
+
+
+def split_taker(taker, outcomes):
+    # start_swap stubbed: outcomes maps endpoint -> outcome of its swaps, started swaps are recorded
+    taker.started = []
+
+    def start_swap(swap_type, kas_amount=1, p2p_price=None, price=None, maker_endpoint=None):
+        taker.started.append((maker_endpoint, kas_amount))
+        state = swap_state(swap_type, kas_amount, endpoint=maker_endpoint)
+
+        async def run_swap():
+            state.outcome = outcomes.get(maker_endpoint)
+            if state.outcome is None:
+                raise Exception('stub maker failed')
+            state.result = f"txid-{maker_endpoint}"
+            return state.result
+
+        state.task = asyncio.create_task(run_swap())
+        return state
+
+    taker.start_swap = start_swap
+    return taker
+
+
+def leg(endpoint, amount=0, max_amount=10):
+    return FillLeg(maker_id=str(endpoint), endpoint=endpoint, price=12, amount=amount, min_amount=1,
+                   max_amount=max_amount)
+
+
+def test_split_swap_reroutes_failed_legs(stub_taker):
+    taker = split_taker(stub_taker(), {'a.onion': 'REDEEMED', 'c.onion': 'REDEEMED'})
+    spare = [leg('b.onion'), leg('c.onion', max_amount=3), leg('d.onion')]
+    completed, unfilled = asyncio.run(taker.split_swap('kas2sat', [leg('a.onion', 5), leg('b.onion', 5)], spare))
+    assert sorted((leg.endpoint, leg.amount, result) for leg, result in completed) == [
+        ('a.onion', 5, 'txid-a.onion'), ('c.onion', 3, 'txid-c.onion')]
+    # the spare offer of the failed maker is skipped, what c can't take goes to d, which fails too
+    assert taker.started == [('a.onion', 5), ('b.onion', 5), ('c.onion', 3), ('d.onion', 2)]
+    assert unfilled == 2
+
+
+def test_split_swap_drops_refunded_legs(stub_taker):
+    taker = split_taker(stub_taker(), {'a.onion': 'REFUNDED', 'b.onion': 'REDEEMED'})
+    completed, unfilled = asyncio.run(taker.split_swap('kas2sat', [leg('a.onion', 5)], [leg('b.onion')]))
+    assert [(leg.endpoint, leg.amount) for leg, _ in completed] == [('b.onion', 5)]
+    assert unfilled == 0
+
+
+def test_split_swap_never_starts_legs_without_endpoint(stub_taker):
+    taker = split_taker(stub_taker(), {'b.onion': 'REDEEMED'})
+    completed, unfilled = asyncio.run(taker.split_swap('sat2kas', [leg(None, 5)], [leg(None), leg('b.onion')]))
+    assert taker.started == [('b.onion', 5)]
+    assert [(leg.endpoint, leg.amount) for leg, _ in completed] == [('b.onion', 5)]
+    assert unfilled == 0
+
+    completed, unfilled = asyncio.run(taker.split_swap('sat2kas', [leg(None, 5)]))
+    assert completed == [] and unfilled == 5
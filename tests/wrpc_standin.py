@@ -0,0 +1,112 @@
+import json
+import socket
+import hashlib
+
+from aiohttp import web, WSMsgType
+
+from klib.krpc import UTXOS_CHANGED_NOTIFICATION
+
+
+class StandInKaspad:
+    # Local websocket server speaking the kaspad wRPC JSON framing:
+    # requests {'id', 'method', 'params'}, replies {'id', 'params'} or {'id', 'error'},
+    # notifications {'method', 'params'}. Utxo entries and transactions use the wRPC layout.
+    def __init__(self):
+        self.utxos = {}
+        self.submitted = []
+        self.subscriptions = set()
+        self.reject_transactions = None
+        # methods answered with an error, e.g. to simulate kaspad unable to serve utxos
+        self.fail_methods = set()
+        self.sockets = []
+        self.runner = None
+        self.url = None
+        self.methods = {
+            'getUtxosByAddresses': self.get_utxos_by_addresses,
+            'submitTransaction': self.submit_transaction,
+            'notifyUtxosChanged': self.notify_utxos_changed
+        }
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        await web.SockSite(self.runner, sock).start()
+        self.url = f"ws://127.0.0.1:{sock.getsockname()[1]}"
+
+    async def stop(self):
+        for ws in list(self.sockets):
+            await ws.close()
+        await self.runner.cleanup()
+
+    async def handle(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.append(ws)
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                data = json.loads(msg.data)
+                method = self.methods.get(data.get('method'))
+                try:
+                    if method is None:
+                        raise ValueError(f"Unknown method {data.get('method')}")
+                    if data['method'] in self.fail_methods:
+                        raise ValueError(f"{data['method']} unavailable")
+                    reply = {'id': data['id'], 'params': method(data.get('params') or {})}
+                except (ValueError, KeyError, TypeError) as e:
+                    reply = {'id': data['id'], 'error': {'message': str(e)}}
+                await ws.send_str(json.dumps(reply))
+        finally:
+            self.sockets.remove(ws)
+        return ws
+
+    def get_utxos_by_addresses(self, params):
+        return {'entries': [entry for address in params['addresses'] for entry in self.utxos.get(address, [])]}
+
+    def submit_transaction(self, params):
+        transaction = params['transaction']
+        if self.reject_transactions:
+            raise ValueError(self.reject_transactions)
+        for output in transaction['outputs']:
+            if not isinstance(output['value'], int) or not isinstance(output['scriptPublicKey'], str):
+                raise ValueError('Invalid transaction output')
+        self.submitted.append(transaction)
+        return {'transactionId': hashlib.sha256(json.dumps(transaction, sort_keys=True).encode()).hexdigest()}
+
+    def notify_utxos_changed(self, params):
+        if params['command'] == 'Start':
+            self.subscriptions.update(params['addresses'])
+        else:
+            self.subscriptions.difference_update(params['addresses'])
+        return {}
+
+    async def push_utxos_changed(self, added=(), removed=()):
+        # notify the subscribed addresses, and apply the change to the utxo set
+        for entry in removed:
+            self.utxos[entry['address']] = [utxo for utxo in self.utxos.get(entry['address'], [])
+                                            if utxo['outpoint'] != entry['outpoint']]
+        for entry in added:
+            self.utxos.setdefault(entry['address'], []).append(entry)
+        params = {
+            'added': [entry for entry in added if entry['address'] in self.subscriptions],
+            'removed': [entry for entry in removed if entry['address'] in self.subscriptions]
+        }
+        if not params['added'] and not params['removed']:
+            return
+        for ws in list(self.sockets):
+            await ws.send_str(json.dumps({'method': UTXOS_CHANGED_NOTIFICATION, 'params': params}))
+
+
+def utxo_entry(address, transaction_id, amount, index=0, script='20' + '11' * 32 + 'ac'):
+    # utxo entry as kaspad sends it over wRPC
+    return {
+        'address': address,
+        'outpoint': {'transactionId': transaction_id, 'index': index},
+        'utxoEntry': {'amount': amount, 'scriptPublicKey': f"0000{script}", 'blockDaaScore': 1000,
+                      'isCoinbase': False}
+    }